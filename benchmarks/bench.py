@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+Hylink microbenchmarks
+
+Times the codec and socket hot paths against a synthetic corpus (see hylink.synth), and writes the results
+as JSON so they can be compared between commits:
+
+    benchmarks/bench.py -o before.json
+    ... make changes ...
+    benchmarks/bench.py -o after.json --compare before.json
+
+Codec benchmarks report the time per operation (the best of several repeats, to filter out scheduling noise).
+Socket benchmarks run an ADKSocket on loopback and report throughput and latency percentiles.
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from hylink import synth
+from hylink.dispatch import CallbackDispatcher, PacketClass
+from hylink.packet import *
+from hylink.rtp import RTPPacket
+from hylink.socket import ADKSocket
+from hylink.types import CallType
+
+
+# Frame kinds decoded by the codec benchmarks
+HYT_KINDS = ('syn', 'heartbeat', 'ack', 'rcp', 'rrs', 'tmp')
+
+
+def time_op(fn, repeats, min_time=0.2):
+    """ Time a function. Returns (ns per call for each repeat, calls per repeat). """
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    # Scale up so each repeat runs for at least min_time
+    t = timer.timeit(number)
+    if t < min_time:
+        number = int(number * min_time / max(t, 1e-9)) + 1
+    return [x * 1e9 / number for x in timer.repeat(repeats, number)], number
+
+
+def codec_benchmarks(repeats):
+    """ Codec benchmarks: name -> function """
+    corpus = synth.Corpus(seed=1)
+    frames = {k: corpus.frame(k) for k in HYT_KINDS + ('rtp',)}
+    benches = {}
+
+    # HYTPacket.decode for each kind of frame the repeater sends
+    for kind in HYT_KINDS:
+        data = frames[kind]
+        benches['decode.%s' % kind] = lambda data=data: HYTPacket.decode(data)
+
+    # TxCtrlBase.factory alone
+    for kind in ('rcp', 'rrs', 'tmp'):
+        p = HYTPacket.decode(frames[kind])
+        # Strip the HYT header and the repeater header, leaving the TxCtrl block
+        data = frames[kind][6 + len(p.rptHeader):]
+        assert type(TxCtrlBase.factory(data)) is type(p.txCtrl)
+        benches['factory.%s' % kind] = lambda data=data: TxCtrlBase.factory(data)
+
+    # Serialisation of the packets hylink sends
+    ack = HSTRPAck()
+    ack.hytSeqID = 1234
+    benches['serialise.ack'] = lambda: bytes(ack)
+    hb = HSTRPHeartbeat()
+    benches['serialise.heartbeat'] = lambda: bytes(hb)
+    call = HSTRPToRadio()
+    call.txCtrl = RCPCallRequest()
+    call.txCtrl.callType = CallType.GROUP
+    call.txCtrl.destId = 1
+    benches['serialise.call_request'] = lambda: bytes(call)
+
+    # RTP
+    data = frames['rtp']
+    benches['rtp.parse'] = lambda: RTPPacket(data)
+    rtp = RTPPacket(data)
+    benches['rtp.build'] = lambda: bytes(rtp)
+
+    # The Hytera header extension must be stripped from the payload
+    rtp.extension = {'type': 0x15, 'data': [0, 0, 0]}
+    assert len(RTPPacket(bytes(rtp)).payload) == 160
+    rtp.extension = None
+
+    # A mixed corpus, decoded the way ADKSocket does it
+    mixed = [d for _, d in synth.Corpus(seed=2).generate(1000)]
+
+    def decode_mixed():
+        for d in mixed:
+            try:
+                HYTPacket.decode(d)
+            except HYTBadSignature:
+                RTPPacket(d)
+    benches['decode.mixed_per_packet'] = decode_mixed
+
+    results = {}
+    for name, fn in benches.items():
+        ns, number = time_op(fn, repeats)
+        if name == 'decode.mixed_per_packet':
+            ns = [x / len(mixed) for x in ns]
+        results[name] = {'ns_per_op': min(ns), 'median_ns': statistics.median(ns), 'repeats': ns, 'number': number}
+        print('%-28s %10.0f ns/op' % (name, min(ns)))
+    return results
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def percentiles(values):
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1]}
+
+
+def socket_benchmarks(count):
+    """ Loopback ADKSocket benchmarks """
+    results = {}
+    port = free_port()
+    sock = ADKSocket(port, name="Bench", host='127.0.0.1', rcvbuf=8 << 20,
+                     dispatcher=CallbackDispatcher(depths={PacketClass.RCP: 1 << 16, PacketClass.RTP: 1 << 16}))
+    repeater = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    repeater.bind(('127.0.0.1', 0))
+    repeater.settimeout(2)
+    dest = ('127.0.0.1', port)
+
+    try:
+        # Connect as a repeater
+        repeater.sendto(synth.syn_frame(100), dest)
+        repeater.recvfrom(2048)
+
+        received = [0]
+        done = threading.Event()
+        target = [0]
+
+        def callback(_p):
+            received[0] += 1
+            if received[0] >= target[0]:
+                done.set()
+        sock.set_msg_callback(callback)
+        sock.set_rtp_callback(callback)
+
+        # Receive throughput: a burst of RCP broadcasts, then of RTP frames, as fast as the sender can go
+        corpus = synth.Corpus(seed=3)
+        for kind in ('rcp', 'rtp'):
+            frames = [corpus.frame(kind) for _ in range(count)]
+            received[0] = 0
+            target[0] = count
+            done.clear()
+            t = time.perf_counter()
+            for f in frames:
+                repeater.sendto(f, dest)
+            done.wait(30)
+            elapsed = time.perf_counter() - t
+            results['socket.rx_throughput.%s' % kind] = {'packets_per_sec': received[0] / elapsed,
+                                                        'received': received[0], 'sent': count}
+            print('%-28s %10.0f packets/s (%d/%d delivered)' %
+                  ('socket.rx_throughput.%s' % kind, received[0] / elapsed, received[0], count))
+
+        # Drain the ACKs for the RCP burst
+        repeater.settimeout(0.2)
+        try:
+            while True:
+                repeater.recvfrom(2048)
+        except socket.timeout:
+            pass
+        repeater.settimeout(2)
+
+        # Latency: HSTRPFromRadio -> ACK round trip, and HSTRPFromRadio -> callback, one packet at a time
+        ackLatency = []
+        cbLatency = []
+        for i in range(min(count, 2000)):
+            f = corpus.frame('rcp')
+            received[0] = 0
+            target[0] = 1
+            done.clear()
+            t = time.perf_counter()
+            repeater.sendto(f, dest)
+            repeater.recvfrom(2048)
+            ackLatency.append((time.perf_counter() - t) * 1e6)
+            done.wait(2)
+            cbLatency.append((time.perf_counter() - t) * 1e6)
+        for name, values in (('socket.ack_latency_us', ackLatency), ('socket.callback_latency_us', cbLatency)):
+            results[name] = percentiles(values)
+            print('%-28s %s' % (name, ', '.join('%s %.0f' % kv for kv in results[name].items())))
+    finally:
+        sock.stop()
+        repeater.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Metrics compared by --compare, and whether bigger is better
+_COMPARE_KEYS = (('ns_per_op', False), ('packets_per_sec', True), ('p50', False), ('p99', False))
+
+
+def compare(base, current, threshold):
+    """ Print a comparison of two result sets. Returns the number of regressions worse than threshold. """
+    print("\nComparison with %s (%s):" % (base['meta'].get('commit'), base['meta'].get('time')))
+    regressions = 0
+    for name, res in sorted(current['results'].items()):
+        old = base['results'].get(name)
+        if old is None:
+            continue
+        for key, higherBetter in _COMPARE_KEYS:
+            if key not in res or key not in old or not old[key]:
+                continue
+            change = res[key] / old[key] - 1
+            worse = -change if higherBetter else change
+            flag = ''
+            if worse > threshold:
+                flag = '  <-- REGRESSION'
+                regressions += 1
+            print('%-28s %-16s %12.1f -> %12.1f  %+6.1f%%%s' % (name, key, old[key], res[key], change * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hylink microbenchmarks")
+    parser.add_argument('-o', '--output', help="Write the results to this JSON file")
+    parser.add_argument('--compare', help="Compare the results with an earlier JSON results file")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Fractional slowdown reported as a regression by --compare (default 0.1)")
+    parser.add_argument('--repeats', type=int, default=5, help="Repeats of each codec benchmark")
+    parser.add_argument('--count', type=int, default=20000, help="Packets sent in each socket benchmark")
+    parser.add_argument('--no-socket', action='store_true', help="Skip the socket benchmarks")
+    args = parser.parse_args()
+
+    results = codec_benchmarks(args.repeats)
+    if not args.no_socket:
+        results.update(socket_benchmarks(args.count))
+
+    out = {
+        'meta': {
+            'commit': git_commit(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            base = json.load(f)
+        if compare(base, out, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,447 @@
+"""
+
+ADK Repeater Interface
+
+Channel utilisation analytics
+
+A TransmitStatusStore records the transmit status broadcasts repeaters send (RCPRepeaterBroadcastTransmitStatus
+and RCPBroadcastTransmitStatus) in an append-only store -- a single NumPy structured array, kept sorted by
+time -- and answers capacity planning questions over any time window with vectorised queries:
+
+    store = TransmitStatusStore()
+    store.attach(rcpSocket)                 # Live...
+    store.attach(CaptureReplay('x.pcapng')) # ...or from a replayed capture (uses the capture timestamps)
+    ...
+    store.utilisation(start, end)                           # Busy % per repeater and timeslot
+    store.utilisation(start, end, by=('repeater', 'target'))# ...or per talkgroup
+    store.call_counts(start, end)
+    store.grant_latency(start, end)
+    store.top_talkers(start, end, n=10)
+    store.save('status.npz')
+
+Each broadcast is stored as one row: time, repeater, timeslot, kind (which broadcast it was), raw status,
+channel state (idle, busy or hang time), call type, target and sender. A channel is taken to stay in the
+state of its most recent broadcast until the next one, up to max_gap seconds (so a repeater which goes
+quiet isn't counted as busy for ever).
+
+RCPRepeaterBroadcastTransmitStatus is the authoritative source of a channel's state. RCPBroadcastTransmitStatus
+(which doesn't carry a sender) is only used for channels with no repeater broadcasts in the window, and only
+for utilisation: calls and airtime are always taken from the repeater broadcasts.
+
+Queries find their window with a binary search on the time column and only copy the rows inside it, so a
+short window over a long history stays cheap. Query results are dicts of column name -> array, one element
+per group, sorted by group key.
+
+This module requires NumPy.
+
+"""
+
+import logging
+import threading
+import time
+
+import numpy
+
+from .packet import RCPBroadcastTransmitStatus, RCPRepeaterBroadcastTransmitStatus
+from .types import ProcessType, TxCallStatus
+
+log = logging.getLogger(__name__)
+
+
+# Row layout
+STATUS_DTYPE = numpy.dtype([
+    ('time',        'f8'),      # time.time(), or the capture timestamp for replayed captures
+    ('repeater',    'u4'),      # Repeater radio ID (0 if unknown)
+    ('timeslot',    'u1'),      # Repeater timeslot (0 if unknown)
+    ('kind',        'u1'),      # KIND_REPEATER or KIND_RADIO
+    ('status',      'u2'),      # TxCallStatus (KIND_REPEATER) or ProcessType (KIND_RADIO)
+    ('state',       'u1'),      # STATE_IDLE, STATE_BUSY or STATE_HANG
+    ('callType',    'u1'),      # CallType
+    ('target',      'u4'),      # Target ID (radio or talkgroup)
+    ('sender',      'u4'),      # Sender radio ID (0 for RCPBroadcastTransmitStatus, which doesn't carry one)
+])
+
+# Which broadcast a row came from
+KIND_REPEATER = 0       # RCPRepeaterBroadcastTransmitStatus
+KIND_RADIO = 1          # RCPBroadcastTransmitStatus
+
+# Channel states
+STATE_IDLE = 0
+STATE_BUSY = 1
+STATE_HANG = 2
+
+_REPEATER_STATES = {
+    TxCallStatus.LOCAL_REPEATING:       STATE_BUSY,
+    TxCallStatus.IP_REPEATING:          STATE_BUSY,
+    TxCallStatus.REMOTE_PTT_TX:         STATE_BUSY,
+    TxCallStatus.LOCAL_PTT_TX:          STATE_BUSY,
+    TxCallStatus.LOCAL_HANG_TIME:       STATE_HANG,
+    TxCallStatus.IP_HANG_TIME:          STATE_HANG,
+    TxCallStatus.CHANNEL_HANG_TIME:     STATE_HANG,
+    TxCallStatus.REMOTE_PTT_HANG_TIME:  STATE_HANG,
+    TxCallStatus.LOCAL_PTT_HANG_TIME:   STATE_HANG,
+}
+
+_RADIO_STATES = {
+    ProcessType.VOICE_TX_OR_RX:         STATE_BUSY,
+    ProcessType.EMERGENCY_CALL_TX:      STATE_BUSY,
+    ProcessType.EMERGENCY_ALARM_TX:     STATE_BUSY,
+    ProcessType.HANG_TIME:              STATE_HANG,
+}
+
+# PTT requests, and the statuses which show they were granted (for grant latency)
+_PTT_WAIT = (TxCallStatus.REMOTE_PTT_WAIT_ACK, TxCallStatus.LOCAL_PTT_WAIT_ACK)
+_PTT_GRANTED = (TxCallStatus.REMOTE_PTT_TX, TxCallStatus.LOCAL_PTT_TX)
+
+# Longest time a channel is assumed to stay in one state without a broadcast (seconds)
+ANALYTICS_MAX_GAP = 300.0
+
+# Rows buffered before they're added to the arrays, and the initial array size
+_STAGING_ROWS = 4096
+_INITIAL_ROWS = 65536
+
+
+class TransmitStatusStore(object):
+    """ Append-only store of transmit status broadcasts, with vectorised queries """
+
+    def __init__(self, max_gap=ANALYTICS_MAX_GAP):
+        """
+        Create an empty store
+
+        :param max_gap: Longest time a channel is assumed to stay in one state without a broadcast (seconds)
+        """
+        self.maxGap = max_gap
+        self._lock = threading.Lock()
+        self._rows = numpy.zeros(_INITIAL_ROWS, dtype=STATUS_DTYPE)
+        self._count = 0
+        # False once rows have been added out of time order (sorted again by the next query)
+        self._sorted = True
+        # Rows received but not yet added to the arrays (appending one row at a time to NumPy is slow)
+        self._staging = []
+        self._sources = []
+
+    def __len__(self):
+        return self._count + len(self._staging)
+
+    ################################
+    # Ingest
+    ################################
+
+    def attach(self, source):
+        """
+        Record the broadcasts received by an ADKSocket, or replayed by a CaptureReplay
+
+        :param source: Anything with add_msg_listener() (ADKSocket, CaptureReplay)
+        """
+        source.add_msg_listener(self._msg)
+        self._sources.append(source)
+
+    def detach(self):
+        """ Stop recording """
+        for source in self._sources:
+            source.remove_msg_listener(self._msg)
+        self._sources = []
+
+    def _msg(self, p):
+        txc = p.txCtrl
+        if not isinstance(txc, (RCPRepeaterBroadcastTransmitStatus, RCPBroadcastTransmitStatus)):
+            return
+
+        # Replayed packets carry their capture time
+        t = getattr(p, 'captureTime', None)
+        if t is None:
+            t = time.time()
+
+        hdr = p.rptHeader
+        conn = getattr(p, 'repeater', None)
+        repeater = hdr.synRepeaterRadioID
+        timeslot = hdr.synTimeslot
+        if repeater is None and conn is not None:
+            repeater = conn.radioID
+        if timeslot is None and conn is not None:
+            timeslot = conn.timeslot
+        self.add(txc, t, repeater or 0, timeslot or 0)
+
+    def add(self, txc, t, repeater=0, timeslot=0):
+        """
+        Add a broadcast
+
+        :param txc: RCPRepeaterBroadcastTransmitStatus or RCPBroadcastTransmitStatus
+        :param t: Time (time.time() value)
+        :param repeater: Repeater radio ID
+        :param timeslot: Repeater timeslot
+        """
+        if isinstance(txc, RCPRepeaterBroadcastTransmitStatus):
+            row = (t, repeater, timeslot, KIND_REPEATER, txc.status,
+                   _REPEATER_STATES.get(txc.status, STATE_IDLE), txc.callType, txc.targetID, txc.senderID)
+        else:
+            row = (t, repeater, timeslot, KIND_RADIO, txc.process,
+                   _RADIO_STATES.get(txc.process, STATE_IDLE), txc.callType, txc.targetID, 0)
+
+        with self._lock:
+            self._staging.append(row)
+            if len(self._staging) >= _STAGING_ROWS:
+                self._flush()
+
+    def extend(self, rows):
+        """
+        Add rows in bulk
+
+        :param rows: Array with dtype STATUS_DTYPE (or anything which converts to one)
+        """
+        rows = numpy.asarray(rows, dtype=STATUS_DTYPE)
+        with self._lock:
+            self._flush()
+            self._append(rows)
+
+    def _append(self, rows):
+        """ Append rows to the arrays, growing them if needed. Caller must hold _lock. """
+        need = self._count + len(rows)
+        if need > len(self._rows):
+            size = len(self._rows)
+            while size < need:
+                size *= 2
+            grown = numpy.zeros(size, dtype=STATUS_DTYPE)
+            grown[:self._count] = self._rows[:self._count]
+            self._rows = grown
+        # Live rows arrive in time order, but replays and bulk loads may not
+        if len(rows):
+            t = rows['time']
+            if (self._count and t[0] < self._rows['time'][self._count - 1]) or numpy.any(t[1:] < t[:-1]):
+                self._sorted = False
+        self._rows[self._count:need] = rows
+        self._count = need
+
+    def _flush(self):
+        """ Move the staged rows into the arrays. Caller must hold _lock. """
+        if self._staging:
+            self._append(numpy.array(self._staging, dtype=STATUS_DTYPE))
+            self._staging = []
+
+    def _sort(self):
+        """ Flush the staged rows, and sort the arrays by time if they're out of order. Caller must hold _lock. """
+        self._flush()
+        if not self._sorted:
+            rows = self._rows[:self._count]
+            self._rows[:self._count] = rows[numpy.argsort(rows['time'], kind='stable')]
+            self._sorted = True
+
+    def rows(self, start=None, end=None):
+        """
+        Returns the rows in a time window, as a structured array sorted by time (a copy, safe to keep)
+
+        :param start: Window start (None for the first row)
+        :param end: Window end, exclusive (None for every row after start)
+        """
+        with self._lock:
+            self._sort()
+            t = self._rows['time'][:self._count]
+            lo = 0 if start is None else numpy.searchsorted(t, start)
+            hi = self._count if end is None else numpy.searchsorted(t, end)
+            return self._rows[lo:hi].copy()
+
+    def span(self):
+        """ Returns the times of the first and last rows, or (0, 0) if the store is empty """
+        with self._lock:
+            self._sort()
+            if not self._count:
+                return 0, 0
+            return self._rows['time'][0], self._rows['time'][self._count - 1]
+
+    def save(self, filename):
+        """ Save the store as a compressed NumPy .npz file """
+        numpy.savez_compressed(filename, rows=self.rows())
+
+    def load(self, filename):
+        """ Add the rows saved in a .npz file by save() """
+        with numpy.load(filename) as f:
+            self.extend(f['rows'])
+
+    ################################
+    # Queries
+    ################################
+
+    def _intervals(self, start, end):
+        """
+        Turn the rows into state intervals, clipped to [start, end).
+
+        Returns (rows, duration, start, end): the rows sorted by channel (repeater, timeslot) then time, the
+        time each row's state lasted within the window, and the window (with None replaced by the first/last
+        row's time).
+
+        KIND_RADIO rows are dropped on channels which have KIND_REPEATER rows, so they don't split the repeater's
+        intervals.
+        """
+        if start is None or end is None:
+            first, last = self.span()
+            if start is None:
+                start = first
+            if end is None:
+                end = last
+
+        # Only rows in the window, or early enough to carry a state into it, matter
+        rows = self.rows(start - self.maxGap, end)
+
+        # Sort by channel, then time (lexsort sorts by the last key first)
+        order = numpy.lexsort((rows['time'], rows['timeslot'], rows['repeater']))
+        rows = rows[order]
+
+        if len(rows):
+            newChannel = numpy.ones(len(rows), dtype=bool)
+            newChannel[1:] = (rows['repeater'][1:] != rows['repeater'][:-1]) | \
+                             (rows['timeslot'][1:] != rows['timeslot'][:-1])
+            channel = numpy.cumsum(newChannel) - 1
+            repeaterRows = rows['kind'] == KIND_REPEATER
+            hasRepeater = numpy.bincount(channel, weights=repeaterRows) > 0
+            rows = rows[repeaterRows | ~hasRepeater[channel]]
+        t = rows['time']
+
+        # Each state lasts until the next broadcast on the same channel, or the end of the window
+        nxt = numpy.empty_like(t)
+        nxt[:-1] = t[1:]
+        if len(t):
+            nxt[-1] = end
+            last = numpy.ones(len(t), dtype=bool)
+            last[:-1] = (rows['repeater'][1:] != rows['repeater'][:-1]) | \
+                        (rows['timeslot'][1:] != rows['timeslot'][:-1])
+            nxt[last] = end
+        nxt = numpy.minimum(nxt, t + self.maxGap)
+
+        duration = numpy.clip(numpy.minimum(nxt, end) - numpy.maximum(t, start), 0, None)
+        return rows, duration, start, end
+
+    @staticmethod
+    def _group(rows, by, mask=None):
+        """ Group rows by columns. Returns (keys dict, group index of each row, number of groups). """
+        if mask is not None:
+            rows = rows[mask]
+        if not len(rows):
+            return {k: numpy.zeros(0, dtype=STATUS_DTYPE[k]) for k in by}, numpy.zeros(0, dtype=numpy.intp), 0
+
+        # Sort by the group columns, then number the runs of equal keys (much faster than numpy.unique
+        # on a record array)
+        cols = [rows[k] for k in by]
+        order = numpy.lexsort(cols[::-1])
+        change = numpy.zeros(len(rows), dtype=bool)
+        change[0] = True
+        for c in cols:
+            sc = c[order]
+            change[1:] |= sc[1:] != sc[:-1]
+        starts = order[change]
+        inverse = numpy.empty(len(rows), dtype=numpy.intp)
+        inverse[order] = numpy.cumsum(change) - 1
+        return {k: c[starts] for k, c in zip(by, cols)}, inverse, len(starts)
+
+    def utilisation(self, start=None, end=None, by=('repeater', 'timeslot'), include_hang=False):
+        """
+        Busy time for each group over a window.
+
+        :param start: Window start (time.time() value; None for the first row)
+        :param end: Window end (None for the last row)
+        :param by: Columns to group by, e.g. ('repeater', 'timeslot'), ('repeater', 'target') or ('sender',)
+        :param include_hang: Count hang time as busy
+        :return: Dict of group columns plus 'busy' (seconds) and 'utilisation' (percent of the window)
+        """
+        rows, duration, start, end = self._intervals(start, end)
+        busy = rows['state'] == STATE_BUSY
+        if include_hang:
+            busy |= rows['state'] == STATE_HANG
+        keys, inverse, n = self._group(rows, by, busy)
+        seconds = numpy.bincount(inverse, weights=duration[busy], minlength=n)
+        window = max(end - start, 1e-9)
+        keys['busy'] = seconds
+        keys['utilisation'] = seconds * 100.0 / window
+        return keys
+
+    def _call_starts(self, rows):
+        """
+        Mask of the rows which start a call: busy repeater broadcasts, after idle/hang or a different call on the
+        same channel. Rows must come from _intervals() (so a channel's rows are all of one kind).
+        """
+        busy = (rows['state'] == STATE_BUSY) & (rows['kind'] == KIND_REPEATER)
+        new = numpy.ones(len(rows), dtype=bool)
+        if len(rows) > 1:
+            same = (rows['repeater'][1:] == rows['repeater'][:-1]) & (rows['timeslot'][1:] == rows['timeslot'][:-1])
+            cont = same & busy[:-1] & (rows['target'][1:] == rows['target'][:-1]) & \
+                (rows['sender'][1:] == rows['sender'][:-1])
+            new[1:] = ~cont
+        return busy & new
+
+    def call_counts(self, start=None, end=None, by=('repeater', 'timeslot')):
+        """
+        Number of calls started in a window, for each group.
+
+        :param start: Window start (None for the first row)
+        :param end: Window end (None for the last row)
+        :param by: Columns to group by
+        :return: Dict of group columns plus 'calls'
+        """
+        rows, _, start, end = self._intervals(start, end)
+        t = rows['time']
+        mask = self._call_starts(rows) & (t >= start) & (t < end)
+        keys, inverse, n = self._group(rows, by, mask)
+        keys['calls'] = numpy.bincount(inverse, minlength=n)
+        return keys
+
+    def grant_latency(self, start=None, end=None, limit=10.0):
+        """
+        Time from a PTT request (REMOTE/LOCAL_PTT_WAIT_ACK) to the transmission starting (REMOTE/LOCAL_PTT_TX)
+        on the same channel, for requests made in a window.
+
+        :param start: Window start (None for the first row)
+        :param end: Window end (None for the last row)
+        :param limit: Requests not granted within this many seconds are left out
+        :return: Dict of 'time', 'repeater', 'timeslot', 'latency' (one element per granted request), plus
+            'p50', 'p90', 'p99' and 'max' (None if there were no grants)
+        """
+        rows, _, start, end = self._intervals(start, end)
+        repeaterRows = rows['kind'] == KIND_REPEATER
+        status = rows['status']
+        t = rows['time']
+
+        waits = numpy.flatnonzero(repeaterRows & numpy.isin(status, _PTT_WAIT) & (t >= start) & (t < end))
+        grants = numpy.flatnonzero(repeaterRows & numpy.isin(status, _PTT_GRANTED))
+
+        # The first grant after each request; rows are sorted by channel then time, so it must be on the
+        # same channel to count
+        idx = numpy.searchsorted(grants, waits)
+        ok = idx < len(grants)
+        waits, idx = waits[ok], idx[ok]
+        g = grants[idx]
+        ok = (rows['repeater'][g] == rows['repeater'][waits]) & (rows['timeslot'][g] == rows['timeslot'][waits])
+        latency = t[g] - t[waits]
+        ok &= latency <= limit
+        waits, latency = waits[ok], latency[ok]
+
+        result = {'time': t[waits], 'repeater': rows['repeater'][waits], 'timeslot': rows['timeslot'][waits],
+                  'latency': latency}
+        if len(latency):
+            p50, p90, p99 = numpy.percentile(latency, (50, 90, 99))
+            result.update({'p50': p50, 'p90': p90, 'p99': p99, 'max': latency.max()})
+        else:
+            result.update({'p50': None, 'p90': None, 'p99': None, 'max': None})
+        return result
+
+    def top_talkers(self, start=None, end=None, n=10, by=('sender',)):
+        """
+        The groups (by default, senders) with the most airtime in a window. Only repeater broadcasts count,
+        as RCPBroadcastTransmitStatus doesn't say who was talking.
+
+        :param start: Window start (None for the first row)
+        :param end: Window end (None for the last row)
+        :param n: Number of groups to return
+        :param by: Columns to group by (e.g. ('target',) for the busiest talkgroups)
+        :return: Dict of group columns plus 'busy' (seconds) and 'calls', busiest first
+        """
+        rows, duration, start, end = self._intervals(start, end)
+        busy = (rows['state'] == STATE_BUSY) & (rows['kind'] == KIND_REPEATER)
+        keys, inverse, count = self._group(rows, by, busy)
+        seconds = numpy.bincount(inverse, weights=duration[busy], minlength=count)
+        inWindow = (rows['time'] >= start) & (rows['time'] < end)
+        calls = numpy.bincount(inverse, weights=(self._call_starts(rows) & inWindow)[busy], minlength=count)
+
+        top = numpy.argsort(-seconds, kind='stable')[:n]
+        result = {k: v[top] for k, v in keys.items()}
+        result['busy'] = seconds[top]
+        result['calls'] = calls[top].astype(numpy.int64)
+        return result
@@ -0,0 +1,481 @@
+"""
+
+ADK Repeater Interface
+
+Announcement scheduler
+
+An AnnouncementScheduler queues automated voice announcements for any number of repeater channels, and
+plays each one when its channel is free:
+
+    sched = AnnouncementScheduler()
+    ch1 = sched.add_channel(rcp1, rtp1, repeater=100)      # Repeater 100, timeslot 1
+    ch2 = sched.add_channel(rcp2, rtp2, repeater=100)      # Repeater 100, timeslot 2
+    a = sched.announce(ch1, CallType.GROUP, 10000, frames)  # frames: 20ms G.711 payloads (160 bytes each)
+    sched.announce(ch2, CallType.GROUP, 10001, frames)
+    if not a.wait(60):
+        ...
+
+Each channel has its own queue and thread, so announcements on different repeaters and timeslots are
+played in parallel, and one at a time (in order) on each channel.
+
+The scheduler follows each channel's RCPRepeaterBroadcastTransmitStatus broadcasts, and only keys up once
+the channel has been idle for a guard time, so announcements don't cut across live users (or their replies
+during hang time). A call or PTT request the repeater refuses (CHANNEL_BUSY, TX_DENY, or a failed PTT) is
+retried with exponential backoff and jitter; the announcement stays at the head of its channel's queue
+until it has been played, or it runs out of retries or passes its deadline.
+
+"""
+
+import collections
+import logging
+import random
+import threading
+
+from .clock import SYSTEM_CLOCK
+from .exceptions import ADKException
+from .packet import RCPBroadcastTransmitStatus, RCPRepeaterBroadcastTransmitStatus
+from .rcp import RCPCorrelator, RCPError, RCP_RESPONSE_TIMEOUT
+from .rtp import RTPPacket, RTPPayloadType
+from .types import ResultCode, SuccessFailResult, TxCallStatus
+
+log = logging.getLogger(__name__)
+
+
+# Time a channel must have been idle before an announcement keys up (seconds)
+ANNOUNCE_IDLE_GUARD = 1.0
+
+# Attempts to play an announcement before giving up, and the backoff between them (seconds)
+ANNOUNCE_RETRIES = 10
+ANNOUNCE_BACKOFF = 0.5
+ANNOUNCE_BACKOFF_MAX = 15.0
+
+# Time to wait for the repeater to report that it is transmitting after PTT (seconds)
+ANNOUNCE_KEYUP_TIMEOUT = 2.0
+
+# Silence sent before and after each announcement, so the start and end aren't clipped (seconds)
+ANNOUNCE_PADDING = 0.2
+
+# RTP frame: 160 samples (20ms) at 8kHz
+ANNOUNCE_FRAME_SAMPLES = 160
+ANNOUNCE_FRAME_TIME = 0.02
+
+# Channel states which count as idle. CHANNEL_HANG_TIME is the repeater sending idle bursts after a call's
+# hang time has run out, so the channel is free.
+_IDLE_STATUSES = frozenset((TxCallStatus.SLEEP, TxCallStatus.CHANNEL_HANG_TIME,
+                            TxCallStatus.REMOTE_PTT_TX_END, TxCallStatus.LOCAL_PTT_TX_END))
+
+# Call results which mean "try again later", rather than a permanent failure
+_BUSY_RESULTS = frozenset((ResultCode.CHANNEL_BUSY, ResultCode.TX_DENY))
+
+# Broadcast results which mean our transmission was refused or cut off
+_ABORT_RESULTS = frozenset((ResultCode.CHANNEL_BUSY, ResultCode.TX_DENY, ResultCode.TX_INTERRUPTED))
+
+# Silent G.711 payload bytes
+_SILENCE = {RTPPayloadType.HYTERA_PCMU: b'\xff', RTPPayloadType.HYTERA_PCMA: b'\xd5'}
+
+
+class AnnouncementFailed(ADKException):
+    """ An announcement couldn't be played """
+    pass
+
+
+class _ChannelBusy(Exception):
+    """ The channel was busy, or the repeater refused to transmit -- back off and try again """
+    pass
+
+
+class Announcement(object):
+    """ A queued voice announcement """
+
+    def __init__(self, callType, destId, frames, payload_type=RTPPayloadType.HYTERA_PCMU, deadline=None,
+                 callback=None):
+        """
+        :param callType: CallType
+        :param destId: Destination radio or talkgroup ID
+        :param frames: 20ms G.711 payloads (bytes, 160 each)
+        :param payload_type: RTPPayloadType of the frames
+        :param deadline: If given, give up if the announcement hasn't started by this time (clock monotonic())
+        :param callback: If given, called as callback(announcement) when the announcement is played or fails
+        """
+        self.callType = callType
+        self.destId = destId
+        # Kept as a tuple, so the announcement can be replayed from the start after an interruption
+        self.frames = tuple(frames)
+        self.payloadType = payload_type
+        self.deadline = deadline
+        self.callback = callback
+
+        # Attempts made, and the outcome -- ok is None until the announcement is done, error is the
+        # exception it failed with
+        self.attempts = 0
+        self.ok = None
+        self.error = None
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return "<%s: %s to %d, %d frames, attempts %d, %s>" % \
+               (type(self).__name__, self.callType, self.destId, len(self.frames), self.attempts,
+                "pending" if self.ok is None else "ok" if self.ok else "failed")
+
+    def done(self):
+        """ Returns True if the announcement has been played, or has failed """
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait for the announcement to finish. Returns True if it was played, False if it failed or timed out. """
+        self._event.wait(timeout)
+        return bool(self.ok)
+
+    def _complete(self, ok, error=None):
+        self.ok = ok
+        self.error = error
+        self._event.set()
+        if self.callback is not None:
+            # noinspection PyBroadException
+            try:
+                self.callback(self)
+            except Exception:
+                log.exception("Exception in announcement callback")
+
+
+class AnnouncementChannel(object):
+    """ One repeater channel (RCP and RTP port pair), with its queue of announcements """
+
+    def __init__(self, sched, rcp, rtp, repeater, correlator):
+        self.rcp = rcp
+        self.rtp = rtp
+        self.repeater = repeater
+        self._sched = sched
+        self._rcp = correlator
+        self.clock = sched.clock
+
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+
+        # Channel state: last reported TxCallStatus, when the channel last became idle (clock monotonic(),
+        # None while busy), and the last result code reported by an RCPBroadcastTransmitStatus
+        self.callStatus = None
+        self.idleSince = self.clock.monotonic()
+        self.broadcastResult = None
+
+        # RTP stream state
+        self._rtpSeq = random.getrandbits(16)
+        self._rtpTimestamp = random.getrandbits(32)
+        self._rtpSSRC = random.getrandbits(32)
+
+        # Counters
+        self.played = 0
+        self.failed = 0
+        self.busy = 0
+        self.interrupted = 0
+
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="Announce-%s" % repeater, daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return "<%s: repeater %s, %d queued, status %s (played %d, failed %d, busy %d)>" % \
+               (type(self).__name__, self.repeater, len(self._queue), self.callStatus, self.played, self.failed,
+                self.busy)
+
+    def pending(self):
+        """ Returns the number of announcements queued (including one being played) """
+        return len(self._queue)
+
+    def _put(self, announcement):
+        with self._cond:
+            if not self._running:
+                raise AnnouncementFailed("Announcement channel closed")
+            self._queue.append(announcement)
+            self._cond.notify_all()
+
+    def _close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        while self._queue:
+            self._queue.popleft()._complete(False, AnnouncementFailed("Announcement channel closed"))
+
+    ################################
+    # Channel state
+    ################################
+
+    def _status(self, txc):
+        """ Called by the scheduler with each transmit status broadcast from the channel's repeater """
+        with self._cond:
+            if isinstance(txc, RCPRepeaterBroadcastTransmitStatus):
+                self.callStatus = txc.status
+                if txc.status in _IDLE_STATUSES:
+                    if self.idleSince is None:
+                        self.idleSince = self.clock.monotonic()
+                else:
+                    self.idleSince = None
+            else:
+                self.broadcastResult = txc.source
+            self._cond.notify_all()
+
+    def _sleep(self, seconds):
+        """ Wait, returning early if the channel is closed. Returns False if it was. """
+        end = self.clock.monotonic() + seconds
+        with self._cond:
+            while self._running:
+                remaining = end - self.clock.monotonic()
+                if remaining <= 0:
+                    return True
+                self.clock.wait(self._cond, remaining)
+        return False
+
+    def _wait_idle(self, deadline):
+        """ Wait for the channel to be idle for the guard time. Returns False if closed or past the deadline. """
+        guard = self._sched.idleGuard
+        with self._cond:
+            while self._running:
+                now = self.clock.monotonic()
+                if deadline is not None and now >= deadline:
+                    return False
+                if self.idleSince is not None and now - self.idleSince >= guard:
+                    return True
+                # Idle, but not for long enough -- wait out the rest of the guard time. Busy -- wait for a broadcast.
+                timeout = self.idleSince + guard - now if self.idleSince is not None else None
+                if deadline is not None:
+                    timeout = min(timeout, deadline - now) if timeout is not None else deadline - now
+                self.clock.wait(self._cond, timeout)
+        return False
+
+    ################################
+    # Playing announcements
+    ################################
+
+    def _thread_proc(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                announcement = self._queue[0]
+
+            ok, error = self._play_with_retries(announcement)
+            if ok is None:
+                # Closed while playing -- _close() fails what's left in the queue
+                return
+            with self._cond:
+                self._queue.popleft()
+            if ok:
+                self.played += 1
+            else:
+                self.failed += 1
+                log.warning("Announcement %r on repeater %s failed: %s", announcement, self.repeater, error)
+            announcement._complete(ok, error)
+
+    def _play_with_retries(self, announcement):
+        """ Play an announcement, retrying while the channel is busy. Returns (ok, error); ok is None if closed. """
+        sched = self._sched
+        while True:
+            if not self._wait_idle(announcement.deadline):
+                if not self._running:
+                    return None, None
+                return False, AnnouncementFailed("Deadline passed before the channel was free")
+
+            announcement.attempts += 1
+            try:
+                self._play(announcement)
+                if not self._running:
+                    return None, None
+                return True, None
+            except _ChannelBusy as e:
+                self.busy += 1
+                log.debug("Repeater %s busy (%s), backing off", self.repeater, e)
+                error = AnnouncementFailed("Channel busy: %s" % e)
+            except RCPError as e:
+                # No response, or the repeater disconnected
+                log.debug("Announcement request to repeater %s failed: %s", self.repeater, e)
+                error = AnnouncementFailed(str(e))
+            except AnnouncementFailed as e:
+                return False, e
+
+            if not self._running:
+                return None, None
+            if announcement.attempts >= sched.retries:
+                return False, error
+
+            # Exponential backoff, with jitter so channels which were refused together don't retry together
+            delay = min(sched.backoffMax, sched.backoff * (2 ** (announcement.attempts - 1)))
+            delay *= random.uniform(0.5, 1.0)
+            if announcement.deadline is not None and self.clock.monotonic() + delay >= announcement.deadline:
+                return False, error
+            if not self._sleep(delay):
+                return None, None
+
+    def _play(self, announcement):
+        """ Key up, send the audio and key down. Raises _ChannelBusy if the repeater refuses or is interrupted. """
+        sched = self._sched
+        reply = self._rcp.call(announcement.callType, announcement.destId, repeater=self.repeater).result()
+        if reply.result in _BUSY_RESULTS:
+            raise _ChannelBusy("call request refused: %s" % reply.result)
+        if reply.result != ResultCode.OK:
+            raise AnnouncementFailed("Call request refused: %s" % reply.result)
+
+        with self._cond:
+            self.broadcastResult = None
+        try:
+            reply = self._rcp.ptt(True, repeater=self.repeater).result()
+            if reply.result != SuccessFailResult.SUCCESS:
+                raise _ChannelBusy("PTT refused")
+
+            # Wait for the repeater to start transmitting (carry on if it doesn't say, as some don't)
+            with self._cond:
+                self.clock.wait_for(self._cond, lambda: self.callStatus == TxCallStatus.REMOTE_PTT_TX or
+                                    self.broadcastResult in _ABORT_RESULTS or not self._running,
+                                    sched.keyupTimeout)
+                if self.broadcastResult in _ABORT_RESULTS:
+                    raise _ChannelBusy("transmit refused: %s" % self.broadcastResult)
+                if self.callStatus != TxCallStatus.REMOTE_PTT_TX:
+                    log.debug("Repeater %s didn't report remote PTT transmit, continuing anyway", self.repeater)
+
+            self._stream(announcement)
+        finally:
+            # Key down, even if we were refused or interrupted. Don't wait for the response.
+            self._rcp.ptt(False, repeater=self.repeater)
+
+    def _stream(self, announcement):
+        """ Send an announcement's audio, paced at one frame every 20ms """
+        silence = _SILENCE.get(announcement.payloadType, b'\xff') * ANNOUNCE_FRAME_SAMPLES
+        padding = (silence,) * int(round(ANNOUNCE_PADDING / ANNOUNCE_FRAME_TIME))
+        frames = padding + announcement.frames + padding
+
+        nextTime = self.clock.monotonic()
+        for i, payload in enumerate(frames):
+            # Check the channel between frames: stop if closed, or if the repeater reports we were cut off
+            with self._cond:
+                if not self._running:
+                    return
+                if self.broadcastResult in _ABORT_RESULTS:
+                    self.interrupted += 1
+                    raise _ChannelBusy("transmission interrupted: %s" % self.broadcastResult)
+
+            # A new packet for each frame: ADKSocket queues packets, rather than serialising them straight away
+            pkt = RTPPacket()
+            pkt.payloadType = announcement.payloadType
+            # NOTE: Extension must be correct or the repeater won't repeat the audio
+            pkt.extension = {'type': 0x15, 'data': [0, 0, 0]}
+            pkt.marker = i == 0
+            self._rtpSeq = (self._rtpSeq + 1) & 0xFFFF
+            self._rtpTimestamp = (self._rtpTimestamp + ANNOUNCE_FRAME_SAMPLES) & 0xFFFFFFFF
+            pkt.seq = self._rtpSeq
+            pkt.timestamp = self._rtpTimestamp
+            pkt.ssrc = self._rtpSSRC
+            pkt.payload = payload
+            if self.rtp.get_session(self.repeater) is None:
+                raise RCPError("Not connected to repeater %s RTP port" % self.repeater)
+            self.rtp.send(pkt, repeater=self.repeater)
+
+            nextTime += ANNOUNCE_FRAME_TIME
+            self.clock.sleep(nextTime - self.clock.monotonic())
+
+
+class AnnouncementScheduler(object):
+    """ Queues voice announcements per repeater channel, and plays them when the channels are free """
+
+    def __init__(self, idle_guard=ANNOUNCE_IDLE_GUARD, retries=ANNOUNCE_RETRIES, backoff=ANNOUNCE_BACKOFF,
+                 backoff_max=ANNOUNCE_BACKOFF_MAX, keyup_timeout=ANNOUNCE_KEYUP_TIMEOUT, timeout=RCP_RESPONSE_TIMEOUT,
+                 clock=None):
+        """
+        Create an announcement scheduler
+
+        :param idle_guard: Time a channel must have been idle before keying up (seconds)
+        :param retries: Attempts to play an announcement before giving up
+        :param backoff: Delay before the first retry (seconds); doubled for each retry after that
+        :param backoff_max: Maximum delay between retries (seconds)
+        :param keyup_timeout: Time to wait for the repeater to report that it is transmitting (seconds)
+        :param timeout: Time to wait for RCP responses (seconds)
+        :param clock: hylink.clock.Clock for the idle guard, backoff and RTP pacing (defaults to the system clock)
+        """
+        self.idleGuard = idle_guard
+        self.retries = retries
+        self.backoff = backoff
+        self.backoffMax = backoff_max
+        self.keyupTimeout = keyup_timeout
+        self.timeout = timeout
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        self._lock = threading.Lock()
+        # Channels by (RCP socket, repeater)
+        self._channels = {}
+        # RCP correlators, by RCP socket
+        self._correlators = {}
+
+    def close(self):
+        """ Stop all channels (failing any queued announcements) and detach from the sockets """
+        with self._lock:
+            channels = list(self._channels.values())
+            correlators = list(self._correlators.items())
+            self._channels = {}
+            self._correlators = {}
+        for ch in channels:
+            ch._close()
+        for sock, correlator in correlators:
+            sock.remove_msg_listener(self._msg)
+            correlator.close()
+
+    def add_channel(self, rcp, rtp, repeater=None):
+        """
+        Add a repeater channel. Returns the AnnouncementChannel (pass it to announce()).
+
+        :param rcp: ADKSocket bound to the channel's RCP port
+        :param rtp: ADKSocket bound to the channel's RTP port
+        :param repeater: Repeater radio ID (see ADKSocket.get_session)
+        """
+        with self._lock:
+            ch = self._channels.get((rcp, repeater))
+            if ch is not None:
+                return ch
+            correlator = self._correlators.get(rcp)
+            if correlator is None:
+                correlator = RCPCorrelator(rcp, self.timeout, self.clock)
+                self._correlators[rcp] = correlator
+                rcp.add_msg_listener(self._msg)
+            ch = AnnouncementChannel(self, rcp, rtp, repeater, correlator)
+            self._channels[(rcp, repeater)] = ch
+        return ch
+
+    def channels(self):
+        """ Returns a list of the AnnouncementChannels """
+        return list(self._channels.values())
+
+    def announce(self, channel, callType, destId, frames, payload_type=RTPPayloadType.HYTERA_PCMU, deadline=None,
+                 callback=None):
+        """
+        Queue an announcement. Returns the Announcement.
+
+        :param channel: AnnouncementChannel (from add_channel)
+        :param callType: CallType
+        :param destId: Destination radio or talkgroup ID
+        :param frames: 20ms G.711 payloads (bytes, 160 each)
+        :param payload_type: RTPPayloadType of the frames
+        :param deadline: If given, give up if the announcement hasn't started within this many seconds
+        :param callback: If given, called as callback(announcement) when the announcement is played or fails
+        """
+        if deadline is not None:
+            deadline = self.clock.monotonic() + deadline
+        announcement = Announcement(callType, destId, frames, payload_type, deadline, callback)
+        channel._put(announcement)
+        return announcement
+
+    def pending(self):
+        """ Returns the number of announcements queued on all channels """
+        return sum(ch.pending() for ch in self.channels())
+
+    def _msg(self, p):
+        txc = p.txCtrl
+        if not isinstance(txc, (RCPRepeaterBroadcastTransmitStatus, RCPBroadcastTransmitStatus)):
+            return
+        conn = getattr(p, 'repeater', None)
+        if conn is None:
+            return
+
+        for (sock, repeater), ch in list(self._channels.items()):
+            # Match on the connection, so a channel added with repeater=None follows the repeater it sends to
+            if ch.rcp.get_session(repeater) is conn:
+                ch._status(txc)
@@ -0,0 +1,392 @@
+"""
+
+ADK Repeater Interface
+
+Capture index
+
+Finding the packets involving one radio or talkgroup in a multi-gigabyte capture means decoding the whole
+capture. build_index() does that once, and writes a compact index file next to the capture: a fixed-size
+record per Hytera datagram (timestamp, repeater, port, direction, HYT type, message header, opcode, source
+and target IDs, file offset), followed by a sorted radio ID -> record table.
+
+Queries memory-map the index. Lookups by radio ID are a binary search of the ID table, and time ranges a
+binary search of the records (so they assume the capture's timestamps don't go backwards); matching packets
+are then read straight from their offsets in the capture:
+
+    index = open_index('site.pcapng')               # builds the index if it's missing or out of date
+    for rec in index.query(radio_id=1234, start=t0, end=t1):
+        print(rec)
+    for rec, packet in index.packets(index.query(talkgroup=9)):
+        print(packet)
+
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import mmap
+import os
+import socket
+import struct
+from array import array
+
+from .exceptions import ADKException
+from .packet import *
+from .pcap import CaptureReader, frame_to_udp
+from .ports import ADKDefaultPorts
+from .rtp import RTPPacket
+
+log = logging.getLogger(__name__)
+
+
+class CaptureIndexError(ADKException):
+    """ Index file is invalid, or doesn't match its capture """
+    pass
+
+
+INDEX_MAGIC = b'HYLIDX\x00\x01'
+INDEX_SUFFIX = '.hyidx'
+
+# Header: magic, record size, capture size, capture mtime (ns), record count, ID table offset, ID table count,
+#         context count. Followed by the records, the ID table, and the pcapng context offsets (Q each).
+_HEADER = struct.Struct('<8sLQqQQQQ')
+
+# Record: timestamp, capture file offset, repeater IP, repeater radio ID, UDP port (hylink side),
+#         direction (0 = from repeater, 1 = to repeater), HYT type, message header, opcode, source ID, target ID
+_RECORD = struct.Struct('<dQ4sLHBBBxHLL')
+
+# ID table entry: radio ID, record number
+_IDENTRY = struct.Struct('<LL')
+
+# While indexing, ID table entries are kept as (radio ID << 32 | record number) in arrays of 64-bit ints, which
+# are sorted in runs of this many entries and merged when the table is written
+_ID_RUN = 1 << 20
+
+# Values used when a field doesn't apply
+NO_ID = 0xFFFFFFFF
+TYPE_RTP = 0xFE                 # HYT type field for RTP frames
+TYPE_UNKNOWN = 0xFF             # HYT type field for undecodable datagrams
+DIR_FROM_REPEATER = 0
+DIR_TO_REPEATER = 1
+
+IndexRecord = collections.namedtuple('IndexRecord', 'timestamp offset repeaterIP repeaterID port direction hytType '
+                                                    'msgHdr opcode srcID targetID')
+
+# Packet attributes holding the source and target radio/talkgroup IDs, in order of preference
+_SRC_ATTRS = ('senderID', 'srcID', 'radioID')
+_TARGET_ATTRS = ('targetID', 'destID', 'destId')
+
+
+def _first_attr(obj, names):
+    for name in names:
+        v = getattr(obj, name, None)
+        if isinstance(v, int):
+            return v & 0xFFFFFFFF
+    return NO_ID
+
+
+def index_path(capture):
+    """ Return the default index file name for a capture """
+    return capture + INDEX_SUFFIX
+
+
+def build_index(capture, index=None, ports=None):
+    """
+    Index a capture file in one pass.
+
+    :param capture: Capture file name (pcap or pcapng)
+    :param index: Index file name (default: the capture name plus '.hyidx')
+    :param ports: UDP ports carrying Hytera traffic (default: every ADKDefaultPorts port)
+    :return: The index file name
+    """
+    if index is None:
+        index = index_path(capture)
+    ports = frozenset(int(x) for x in (ports if ports is not None else ADKDefaultPorts))
+
+    st = os.stat(capture)
+    # Repeater IP -> radio ID, learned from SYNs and repeater headers
+    repeaterIDs = {}
+    ids = array('Q')
+    idRuns = []
+    count = 0
+
+    tmp = index + '.tmp'
+    with CaptureReader(capture) as reader, open(tmp, 'wb') as out:
+        out.write(b'\0' * _HEADER.size)
+        records = []
+
+        for frame in reader:
+            dgram = frame_to_udp(frame)
+            if dgram is None or not dgram.payload:
+                continue
+
+            # Which side is the repeater? Known repeaters first, then whichever side isn't on a Hytera port
+            # (the repeater side may be too, in which case the packet type decides below).
+            if dgram.src in repeaterIDs and dgram.dport in ports:
+                direction, repeaterIP, port = DIR_FROM_REPEATER, dgram.src, dgram.dport
+            elif dgram.dst in repeaterIDs and dgram.sport in ports:
+                direction, repeaterIP, port = DIR_TO_REPEATER, dgram.dst, dgram.sport
+            elif dgram.dport in ports:
+                direction, repeaterIP, port = DIR_FROM_REPEATER, dgram.src, dgram.dport
+            elif dgram.sport in ports:
+                direction, repeaterIP, port = DIR_TO_REPEATER, dgram.dst, dgram.sport
+            else:
+                continue
+
+            hytType, msgHdr, opcode, srcID, targetID = TYPE_UNKNOWN, 0, 0, NO_ID, NO_ID
+            # noinspection PyBroadException
+            try:
+                p = HYTPacket.decode(dgram.payload)
+            except HYTBadSignature:
+                try:
+                    RTPPacket(dgram.payload)
+                    hytType = TYPE_RTP
+                except Exception:
+                    pass
+                p = None
+            except Exception:
+                p = None
+
+            if p is not None:
+                hytType = p.hytPktType
+                if isinstance(p, HSTRPToRadio):
+                    direction = DIR_TO_REPEATER
+                    repeaterIP = dgram.dst
+                elif isinstance(p, (HSTRPSyn, HSTRPFromRadio)):
+                    direction = DIR_FROM_REPEATER
+                    repeaterIP = dgram.src
+                    repeaterIDs[repeaterIP] = p.rptHeader.synRepeaterRadioID
+
+                txc = getattr(p, 'txCtrl', None)
+                if txc is not None:
+                    msgHdr = int(txc.txcMsgHdr)
+                    opcode = txc.txcOpcode
+                    srcID = _first_attr(txc, _SRC_ATTRS)
+                    targetID = _first_attr(txc, _TARGET_ATTRS)
+
+            repeaterID = repeaterIDs.get(repeaterIP)
+            records.append(_RECORD.pack(dgram.timestamp, dgram.offset, socket.inet_aton(repeaterIP),
+                                        NO_ID if repeaterID is None else repeaterID, port, direction, hytType,
+                                        msgHdr, opcode, srcID, targetID))
+            for x in {srcID, targetID}:
+                if x != NO_ID:
+                    ids.append((x << 32) | count)
+            count += 1
+            if len(ids) >= _ID_RUN:
+                idRuns.append(array('Q', sorted(ids)))
+                ids = array('Q')
+
+            if len(records) >= 4096:
+                out.write(b''.join(records))
+                records = []
+        out.write(b''.join(records))
+
+        # Radio ID table
+        idRuns.append(array('Q', sorted(ids)))
+        del ids
+        idCount = sum(len(r) for r in idRuns)
+        idOffset = out.tell()
+        merged = heapq.merge(*idRuns)
+        while True:
+            chunk = b''.join(_IDENTRY.pack(x >> 32, x & 0xFFFFFFFF) for x in itertools.islice(merged, 4096))
+            if not chunk:
+                break
+            out.write(chunk)
+        del idRuns
+
+        # pcapng context (offsets of the section header and interface blocks)
+        context = getattr(reader, 'context', [])
+        out.write(struct.pack('<%dQ' % len(context), *context))
+
+        # Now the counts are known, fill in the header
+        out.seek(0)
+        out.write(_HEADER.pack(INDEX_MAGIC, _RECORD.size, st.st_size, st.st_mtime_ns, count, idOffset, idCount,
+                               len(context)))
+
+    os.replace(tmp, index)
+    log.info("Indexed %d datagrams in %s", count, capture)
+    return index
+
+
+class CaptureIndex(object):
+    """ A memory-mapped capture index """
+
+    def __init__(self, index, capture=None):
+        """
+        Open an index
+
+        :param index: Index file name
+        :param capture: Capture file name (default: the index name without '.hyidx'). If the capture exists and
+            has changed since it was indexed, CaptureIndexError is raised.
+        """
+        if capture is None and index.endswith(INDEX_SUFFIX):
+            capture = index[:-len(INDEX_SUFFIX)]
+        self.capture = capture
+        self._reader = None
+
+        self._file = open(index, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, recsize, capSize, capMtime, self.count, self._idOffset, self._idCount, ctxCount = \
+                _HEADER.unpack_from(self._mm)
+        except struct.error:
+            self.close()
+            raise CaptureIndexError("Index file %s is truncated" % index)
+        if magic != INDEX_MAGIC or recsize != _RECORD.size:
+            self.close()
+            raise CaptureIndexError("%s is not a capture index, or was written by a different version" % index)
+
+        if capture is not None and os.path.exists(capture):
+            st = os.stat(capture)
+            if st.st_size != capSize or st.st_mtime_ns != capMtime:
+                self.close()
+                raise CaptureIndexError("Capture %s has changed since it was indexed" % capture)
+
+        ctxOffset = self._idOffset + self._idCount * _IDENTRY.size
+        self._context = list(struct.unpack_from('<%dQ' % ctxCount, self._mm, ctxOffset))
+
+    def close(self):
+        if self._reader is not None:
+            self._reader.close()
+            self._reader = None
+        self._mm.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self.count
+
+    def record(self, n):
+        """ Return record number n """
+        if not 0 <= n < self.count:
+            raise IndexError(n)
+        return self._unpack(n)
+
+    def _unpack(self, n):
+        r = _RECORD.unpack_from(self._mm, _HEADER.size + n * _RECORD.size)
+        return IndexRecord(r[0], r[1], socket.inet_ntoa(r[2]), *r[3:])
+
+    def _timestamp(self, n):
+        return struct.unpack_from('<d', self._mm, _HEADER.size + n * _RECORD.size)[0]
+
+    def _time_range(self, start, end):
+        """ Binary search the records for a time range. Returns (first, last + 1) record numbers. """
+        lo, hi = 0, self.count
+        if start is not None:
+            a, b = 0, self.count
+            while a < b:
+                m = (a + b) // 2
+                if self._timestamp(m) < start:
+                    a = m + 1
+                else:
+                    b = m
+            lo = a
+        if end is not None:
+            a, b = lo, self.count
+            while a < b:
+                m = (a + b) // 2
+                if self._timestamp(m) < end:
+                    a = m + 1
+                else:
+                    b = m
+            hi = a
+        return lo, hi
+
+    def _records_for_id(self, radioID):
+        """ Binary search the ID table. Returns the matching record numbers, in order. """
+        def key(i):
+            return _IDENTRY.unpack_from(self._mm, self._idOffset + i * _IDENTRY.size)
+
+        a, b = 0, self._idCount
+        while a < b:
+            m = (a + b) // 2
+            if key(m)[0] < radioID:
+                a = m + 1
+            else:
+                b = m
+        result = []
+        while a < self._idCount:
+            rid, n = key(a)
+            if rid != radioID:
+                break
+            result.append(n)
+            a += 1
+        return result
+
+    def query(self, radio_id=None, talkgroup=None, repeater=None, port=None, hyt_type=None, msghdr=None,
+              opcode=None, start=None, end=None):
+        """
+        Find the records matching every given filter
+
+        :param radio_id: Radio ID, matching either the source or target of a message
+        :param talkgroup: Talkgroup (or other target) ID, matching the target of a message
+        :param repeater: Repeater radio ID, or repeater IP address (string)
+        :param port: UDP port on the hylink side
+        :param hyt_type: HYT packet type (e.g. HSTRPFromRadio.TYPE), or TYPE_RTP
+        :param msghdr: TxCtrl message header (MessageHeader)
+        :param opcode: TxCtrl opcode
+        :param start: Earliest timestamp (inclusive)
+        :param end: Latest timestamp (exclusive)
+        :return: List of IndexRecords, in capture order
+        """
+        lookup = radio_id if radio_id is not None else talkgroup
+        if lookup is not None:
+            candidates = self._records_for_id(lookup)
+            if start is not None or end is not None:
+                lo, hi = self._time_range(start, end)
+                candidates = [n for n in candidates if lo <= n < hi]
+        else:
+            candidates = range(*self._time_range(start, end))
+
+        result = []
+        for n in candidates:
+            r = self._unpack(n)
+            if talkgroup is not None and r.targetID != talkgroup:
+                continue
+            if repeater is not None and repeater not in (r.repeaterID, r.repeaterIP):
+                continue
+            if port is not None and r.port != port:
+                continue
+            if hyt_type is not None and r.hytType != hyt_type:
+                continue
+            if msghdr is not None and r.msgHdr != msghdr:
+                continue
+            if opcode is not None and r.opcode != opcode:
+                continue
+            result.append(r)
+        return result
+
+    def read(self, record):
+        """ Read a record's datagram from the capture. Returns a hylink.pcap.UDPDatagram. """
+        if self._reader is None:
+            if self.capture is None:
+                raise CaptureIndexError("No capture file for this index")
+            self._reader = CaptureReader(self.capture)
+        return frame_to_udp(self._reader.read_at(record.offset, self._context))
+
+    def packets(self, records):
+        """ Generator: yield (record, decoded packet) for each record, reading the packets from the capture """
+        for r in records:
+            data = self.read(r).payload
+            if r.hytType == TYPE_RTP:
+                yield r, RTPPacket(data)
+            else:
+                yield r, HYTPacket.decode(data)
+
+
+def open_index(capture, rebuild=False, ports=None):
+    """ Open a capture's index, building it first if it's missing, out of date, or rebuild is True """
+    path = index_path(capture)
+    if not rebuild and os.path.exists(path):
+        try:
+            return CaptureIndex(path, capture)
+        except CaptureIndexError as e:
+            log.info("Rebuilding index: %s", e)
+    build_index(capture, path, ports)
+    return CaptureIndex(path, capture)
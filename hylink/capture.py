@@ -0,0 +1,250 @@
+"""
+
+ADK Repeater Interface
+
+Live packet capture
+
+A CaptureTap writes every datagram sent and received by one or more sockets to a pcapng file, with
+nanosecond timestamps. Each socket appears as its own pcapng interface (named after the socket), and
+each datagram is wrapped in IPv4/UDP headers carrying the local and remote addresses and ports, with
+its direction in the packet flags -- so the file opens in Wireshark alongside the application's logs.
+
+    tap = CaptureTap('hylink.pcapng', max_bytes=100 << 20, max_files=10)
+    sock.set_capture(tap)
+    ...
+    tap.close()
+
+Recording a datagram only appends a reference to a queue; a background thread formats and writes the
+queued datagrams in batches, so capturing adds no I/O to the socket threads. If the writer falls behind
+and the queue fills up, datagrams are dropped from the capture (and counted) rather than slowing the
+sockets down.
+
+Files can be rotated by size and/or age. Rotated files are named <name>.<n><ext> (e.g. hylink.00001.pcapng),
+and with max_files set, the oldest are deleted. Every file holds at least one datagram, however small
+max_bytes is, so a file can go over the limit by up to one datagram (and the interface descriptions).
+
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+
+from .pcap import PcapngWriter, udp_ipv4, LINKTYPE_IPV4, EPB_INBOUND, EPB_OUTBOUND
+
+log = logging.getLogger(__name__)
+
+
+# Default maximum number of datagrams waiting to be written
+CAPTURE_QUEUE_DEPTH = 65536
+
+# Interval between writes (seconds); the writer also wakes early when this many datagrams are waiting
+CAPTURE_FLUSH_INTERVAL = 0.25
+CAPTURE_FLUSH_BATCH = 4096
+
+# Smallest max_bytes allowed (rotating much below this would mostly write file headers)
+CAPTURE_MIN_BYTES = 4096
+
+_DIRECTION_FLAGS = {'rx': EPB_INBOUND, 'tx': EPB_OUTBOUND}
+
+
+class CaptureInterface(object):
+    """ One socket's connection to a CaptureTap -- returned by CaptureTap.interface() """
+
+    __slots__ = ('tap', 'ifid', 'name', 'local')
+
+    def __init__(self, tap, ifid, name, local):
+        self.tap = tap
+        self.ifid = ifid
+        self.name = name
+        self.local = local
+
+    def record(self, direction, addr, data):
+        """
+        Record a datagram. Safe to call from any thread.
+
+        :param direction: 'rx' or 'tx'
+        :param addr: Remote socket address
+        :param data: Datagram payload (bytes)
+        """
+        tap = self.tap
+        if len(tap._queue) >= tap.queueDepth:
+            tap.dropped += 1
+            return
+        tap._queue.append((time.time_ns(), self, direction, addr, data))
+        if len(tap._queue) >= CAPTURE_FLUSH_BATCH:
+            tap._wakeup.set()
+
+
+class CaptureTap(object):
+    """ Writes sockets' traffic to rotating pcapng files, from a background thread """
+
+    def __init__(self, filename, max_bytes=None, max_seconds=None, max_files=None, snaplen=65535,
+                 queue_depth=CAPTURE_QUEUE_DEPTH, flush_interval=CAPTURE_FLUSH_INTERVAL):
+        """
+        Create a capture tap and start its writer thread
+
+        :param filename: Capture file name
+        :param max_bytes: Start a new file when the current one reaches this size (None for no limit; at least
+            CAPTURE_MIN_BYTES)
+        :param max_seconds: Start a new file when the current one is this old (None for no limit)
+        :param max_files: Number of rotated files to keep (None to keep them all)
+        :param snaplen: Maximum number of bytes of each datagram to capture
+        :param queue_depth: Maximum number of datagrams waiting to be written
+        :param flush_interval: Interval between writes (seconds)
+        """
+        if max_bytes is not None and max_bytes < CAPTURE_MIN_BYTES:
+            raise ValueError("max_bytes must be at least %d" % CAPTURE_MIN_BYTES)
+
+        self.filename = filename
+        self.maxBytes = max_bytes
+        self.maxSeconds = max_seconds
+        self.maxFiles = max_files
+        self.snaplen = snaplen
+        self.queueDepth = queue_depth
+        self.flushInterval = flush_interval
+
+        # Rotation is enabled if there's a size or age limit
+        self._rotating = max_bytes is not None or max_seconds is not None
+        self._fileIndex = 0
+        self._files = collections.deque()
+
+        # Interfaces, in ID order. Only ever appended to.
+        self._interfaces = []
+        self._ifLock = threading.Lock()
+
+        # Datagrams waiting to be written: (time_ns, interface, direction, addr, data).
+        # deque.append and popleft are atomic, so the socket threads never take a lock.
+        self._queue = collections.deque()
+        self._wakeup = threading.Event()
+
+        # Counters
+        self.written = 0
+        self.dropped = 0
+
+        self._writer = None
+        self._open_file()
+
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="CaptureTap", daemon=True)
+        self._thread.start()
+
+    def interface(self, name, local=('', 0)):
+        """
+        Register a socket with the tap. Returns a CaptureInterface, whose record() method the socket
+        calls for every datagram it sends or receives.
+
+        :param name: Interface name shown in the capture (e.g. the socket name and port)
+        :param local: Local socket address, used as the source/destination in the IPv4/UDP headers
+        """
+        with self._ifLock:
+            iface = CaptureInterface(self, len(self._interfaces), name, local)
+            self._interfaces.append(iface)
+        self._wakeup.set()
+        return iface
+
+    def close(self):
+        """ Write everything which has been recorded, and close the capture file """
+        if not self._running:
+            return
+        self._running = False
+        self._wakeup.set()
+        self._thread.join()
+        self._writer.close()
+
+    ################################
+    # Writer thread
+    ################################
+
+    def _current_name(self):
+        if not self._rotating:
+            return self.filename
+        base, ext = os.path.splitext(self.filename)
+        return '%s.%05d%s' % (base, self._fileIndex, ext)
+
+    def _open_file(self):
+        """ Start a new capture file """
+        if self._writer is not None:
+            self._writer.close()
+
+        self._fileIndex += 1
+        name = self._current_name()
+        self._writer = PcapngWriter(name, snaplen=self.snaplen)
+        self._fileOpened = time.monotonic()
+        self._ifWritten = 0
+        self._fileBlocks = 0
+        log.debug("Capturing to %s", name)
+
+        # Delete the oldest files
+        self._files.append(name)
+        while self.maxFiles is not None and len(self._files) > self.maxFiles:
+            old = self._files.popleft()
+            try:
+                os.remove(old)
+            except OSError as e:
+                log.warning("Couldn't remove old capture file %s: %s", old, e)
+
+    def _need_rotate(self):
+        if not self._fileBlocks:
+            # Nothing in this file yet
+            return False
+        if self.maxBytes is not None and self._writer.bytesWritten >= self.maxBytes:
+            return True
+        if self.maxSeconds is not None and time.monotonic() - self._fileOpened >= self.maxSeconds:
+            return True
+        return False
+
+    def _write_batch(self):
+        """ Write every queued datagram """
+        q = self._queue
+        while True:
+            if self._rotating and q and self._need_rotate():
+                self._open_file()
+
+            writer = self._writer
+            # Interface description blocks go before any packets from the interface (and into every new file)
+            interfaces = self._interfaces
+            while self._ifWritten < len(interfaces):
+                iface = interfaces[self._ifWritten]
+                writer.write(writer.interface_block(LINKTYPE_IPV4, iface.name,
+                                                    "%s:%d" % (iface.local[0] or '0.0.0.0', iface.local[1])))
+                self._ifWritten += 1
+
+            # Build a batch of blocks, up to the rotation size limit, and write them in one go. A new file
+            # always gets at least one block, even if its header already takes it to the limit -- otherwise a
+            # small limit would start new files for ever without writing anything.
+            blocks = []
+            size = 0
+            limit = None if self.maxBytes is None else self.maxBytes - writer.bytesWritten
+            while q and (limit is None or size < limit or (not blocks and not self._fileBlocks)):
+                ts, iface, direction, addr, data = q.popleft()
+                if direction == 'rx':
+                    frame = udp_ipv4(addr, iface.local, data)
+                else:
+                    frame = udp_ipv4(iface.local, addr, data)
+                block = writer.packet_block(iface.ifid, ts, frame, _DIRECTION_FLAGS.get(direction))
+                blocks.append(block)
+                size += len(block)
+
+            if blocks:
+                writer.write(b''.join(blocks))
+                self.written += len(blocks)
+                self._fileBlocks += len(blocks)
+            if not q:
+                break
+
+        self._writer.flush()
+
+    def _thread_proc(self):
+        while self._running:
+            self._wakeup.wait(self.flushInterval)
+            self._wakeup.clear()
+            # noinspection PyBroadException
+            try:
+                self._write_batch()
+            except Exception:
+                log.exception("Capture write failed")
+
+        # Write anything recorded before close()
+        self._write_batch()
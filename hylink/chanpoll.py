@@ -0,0 +1,385 @@
+"""
+
+ADK Repeater Interface
+
+Channel status polling
+
+A ChannelPoller polls channel status and parameters (RSSI, carrier status, power level and so on) from any
+number of repeaters, and keeps the results as fixed-size time series:
+
+    poller = ChannelPoller()
+    poller.add(rcpSocket, 100, (StatusParameter.RSSI, StatusParameter.CARRIER_STATUS), interval=0.5)
+    poller.add(rcpSocket, 101, (StatusParameter.RSSI,), interval=2)
+    ...
+    times, values = poller.series(100, StatusParameter.RSSI).snapshot()
+    poller.close()
+
+Requests are coalesced: a repeater polled for more than one parameter is sent a single
+STATUS_OF_ALL_CHANNELS request, and every target/value pair in the response is recorded, rather than
+one request (and one ACK) per parameter.
+
+Polls are spread out rather than sent in bursts. Each repeater's first poll is offset by a fraction of
+its interval, each repeater link has at most one request outstanding, and requests on a link are spaced
+by at least 1/link_rate seconds. A poll which would break the budget is put back until the link is free,
+so a slow or disconnected repeater can't flood its control channel.
+
+Other code on the same socket (an RCPCorrelator, say) may ask for channel status too, and the repeater
+answers with the same response. A response only completes the outstanding poll if it carries the parameters
+that poll asked for; anything else is left alone and counted in ChannelPoller.unmatched. (A failure carries
+no parameters, so it can't be told apart, and is taken as the answer to the poll.)
+
+Time series are ring buffers. NumPy arrays are used if NumPy is installed, so dashboards can take
+snapshots cheaply; otherwise the standard library's array module is used.
+
+"""
+
+import array
+import heapq
+import logging
+import threading
+
+from .clock import SYSTEM_CLOCK
+from .packet import HSTRPToRadio, RCPChannelStatusOrParameterCheckRequest, RCPChannelStatusOrParameterCheckResponse
+from .types import StatusParameter, StatusValueType, SuccessFailResult
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger(__name__)
+
+
+# Default number of samples kept for each repeater/parameter
+POLL_HISTORY = 3600
+
+# Default maximum request rate on one repeater link (requests per second)
+POLL_LINK_RATE = 5.0
+
+# Time to wait for a response before giving up on a poll (seconds)
+POLL_TIMEOUT = 2.0
+
+
+class RingSeries(object):
+    """ Fixed-size time series of (time, value) samples """
+
+    def __init__(self, capacity=POLL_HISTORY):
+        """
+        Create a time series
+
+        :param capacity: Number of samples kept; older samples are overwritten
+        """
+        self.capacity = capacity
+        if numpy is not None:
+            self._times = numpy.zeros(capacity, dtype=numpy.float64)
+            self._values = numpy.zeros(capacity, dtype=numpy.int32)
+        else:
+            self._times = array.array('d', bytes(8 * capacity))
+            self._values = array.array('l', bytes(array.array('l').itemsize * capacity))
+        # Index of the next sample, and total number of samples ever appended
+        self._next = 0
+        self.count = 0
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def append(self, t, value):
+        """ Add a sample, overwriting the oldest if the series is full """
+        i = self._next
+        self._times[i] = t
+        self._values[i] = value
+        self._next = (i + 1) % self.capacity
+        self.count += 1
+
+    def latest(self):
+        """ Returns the most recent (time, value), or None if the series is empty """
+        if self.count == 0:
+            return None
+        i = (self._next - 1) % self.capacity
+        return self._times[i], self._values[i]
+
+    def snapshot(self):
+        """ Returns (times, values), oldest first. NumPy arrays if NumPy is installed, otherwise arrays. """
+        n = len(self)
+        if n < self.capacity:
+            return self._times[:n], self._values[:n]
+        i = self._next
+        if numpy is not None:
+            return numpy.concatenate((self._times[i:], self._times[:i])), \
+                   numpy.concatenate((self._values[i:], self._values[:i]))
+        return self._times[i:] + self._times[:i], self._values[i:] + self._values[:i]
+
+
+class PollTarget(object):
+    """ One repeater being polled """
+
+    def __init__(self, sock, repeater, params, interval, valueType):
+        self.sock = sock
+        self.repeater = repeater
+        self.params = tuple(params)
+        self.interval = interval
+        self.valueType = valueType
+
+        # Parameter requested: STATUS_OF_ALL_CHANNELS covers several parameters in one request
+        if len(self.params) == 1:
+            self.request = self.params[0]
+        else:
+            self.request = StatusParameter.STATUS_OF_ALL_CHANNELS
+
+        # Time of the next poll, and whether the target has been removed
+        self.due = 0
+        self.removed = False
+
+        # Counters
+        self.polls = 0
+        self.responses = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.deferred = 0
+
+    def __repr__(self):
+        return "<%s: repeater %s, every %.1fs, %s (polls %d, responses %d, timeouts %d)>" % \
+               (type(self).__name__, self.repeater, self.interval, ', '.join(p.name for p in self.params),
+                self.polls, self.responses, self.timeouts)
+
+
+class _Link(object):
+    """ Request budget for one repeater link (socket and repeater) """
+
+    __slots__ = ('outstanding', 'sent', 'deadline')
+
+    def __init__(self):
+        # Target with a request in flight (or None), and when it was sent
+        self.outstanding = None
+        self.sent = 0
+        self.deadline = 0
+
+
+class ChannelPoller(object):
+    """ Polls channel status from repeaters on a schedule, and records the results """
+
+    def __init__(self, link_rate=POLL_LINK_RATE, timeout=POLL_TIMEOUT, history=POLL_HISTORY, clock=None):
+        """
+        Create a channel poller and start its thread
+
+        :param link_rate: Maximum request rate on one repeater link (requests per second)
+        :param timeout: Time to wait for a response (seconds)
+        :param history: Number of samples kept for each repeater/parameter
+        :param clock: hylink.clock.Clock for the schedule, timeouts and sample times (defaults to the system clock)
+        """
+        self.linkRate = link_rate
+        self.timeout = timeout
+        self.history = history
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        self._cond = threading.Condition()
+        # Targets by (socket, repeater)
+        self._targets = {}
+        # Links by (socket, repeater)
+        self._links = {}
+        # Timer heap: (due, count, target)
+        self._timers = []
+        self._timerCount = 0
+        # Time series by (repeater, parameter)
+        self._series = {}
+        # Message listeners, by socket
+        self._listeners = {}
+        # Responses which didn't match an outstanding poll
+        self.unmatched = 0
+
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="ChannelPoller", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """ Stop polling and detach from the sockets """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        for sock, listener in self._listeners.items():
+            sock.remove_msg_listener(listener)
+        self._listeners = {}
+
+    ################################
+    # Targets
+    ################################
+
+    def add(self, sock, repeater, params=(StatusParameter.RSSI,), interval=1.0, value_type=StatusValueType.DB_VALUE):
+        """
+        Start polling a repeater. Replaces any earlier add() for the same socket and repeater.
+
+        :param sock: ADKSocket bound to the repeater's RCP port
+        :param repeater: Repeater radio ID (see ADKSocket.get_session)
+        :param params: StatusParameters to poll
+        :param interval: Interval between polls (seconds)
+        :param value_type: StatusValueType to request (LEVEL or DB_VALUE)
+        """
+        target = PollTarget(sock, repeater, params, interval, value_type)
+        key = (sock, repeater)
+        with self._cond:
+            old = self._targets.get(key)
+            if old is not None:
+                old.removed = True
+            self._targets[key] = target
+            self._links.setdefault(key, _Link())
+
+            if sock not in self._listeners:
+                listener = lambda p, sock=sock: self._msg(sock, p)
+                self._listeners[sock] = listener
+                sock.add_msg_listener(listener)
+
+            # Stagger the first polls across the interval, so targets added together aren't polled together.
+            # Golden ratio steps keep the offsets evenly spread however many targets are added.
+            phase = (len(self._targets) * 0.618034) % 1.0
+            self._schedule(target, self.clock.monotonic() + phase * interval)
+        return target
+
+    def remove(self, sock, repeater):
+        """ Stop polling a repeater """
+        with self._cond:
+            target = self._targets.pop((sock, repeater), None)
+            if target is not None:
+                target.removed = True
+
+    def targets(self):
+        """ Returns a list of the PollTargets """
+        return list(self._targets.values())
+
+    def series(self, repeater, param):
+        """ Returns the RingSeries for a repeater and parameter, or None if nothing has been recorded """
+        return self._series.get((repeater, param))
+
+    def latest(self, repeater, param):
+        """ Returns the most recent (time, value) for a repeater and parameter, or None """
+        s = self._series.get((repeater, param))
+        return None if s is None else s.latest()
+
+    ################################
+    # Scheduling
+    ################################
+
+    def _schedule(self, target, due):
+        """ Schedule a poll. Caller must hold _cond. """
+        target.due = due
+        self._timerCount += 1
+        heapq.heappush(self._timers, (due, self._timerCount, target))
+        self._cond.notify_all()
+
+    def _next_due(self, now):
+        """ Find the polls to send now. Caller must hold _cond. Returns a list of targets. """
+        batch = []
+        while self._timers and self._timers[0][0] <= now:
+            due, _, target = heapq.heappop(self._timers)
+            if target.removed or due != target.due:
+                continue
+            link = self._links[(target.sock, target.repeater)]
+
+            # Give up on a request which hasn't been answered
+            if link.outstanding is not None and now >= link.deadline:
+                link.outstanding.timeouts += 1
+                log.debug("Channel status poll of repeater %s timed out", link.outstanding.repeater)
+                link.outstanding = None
+
+            # Keep to the link budget -- one request in flight, and requests spaced by 1/linkRate
+            earliest = link.sent + 1.0 / self.linkRate
+            if link.outstanding is not None or now < earliest:
+                target.deferred += 1
+                retry = max(earliest, now + 1.0 / self.linkRate) if link.outstanding is not None else earliest
+                self._schedule(target, min(retry, link.deadline) if link.outstanding is not None else retry)
+                continue
+
+            link.outstanding = target
+            link.sent = now
+            link.deadline = now + self.timeout
+            target.polls += 1
+            self._schedule(target, now + target.interval)
+            batch.append(target)
+        return batch
+
+    def _send(self, target):
+        req = RCPChannelStatusOrParameterCheckRequest()
+        req.target = target.request
+        req.valueType = target.valueType
+        p = HSTRPToRadio()
+        p.txCtrl = req
+        if target.sock.send(p, callback=_ignore_ack, repeater=target.repeater) is None:
+            # Not connected -- free the link straight away, rather than waiting for the timeout
+            with self._cond:
+                link = self._links.get((target.sock, target.repeater))
+                if link is not None and link.outstanding is target:
+                    link.outstanding = None
+
+    def _thread_proc(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = self.clock.monotonic()
+                batch = self._next_due(now)
+                if not batch:
+                    timeout = self._timers[0][0] - now if self._timers else None
+                    self.clock.wait(self._cond, timeout)
+                    continue
+
+            for target in batch:
+                # noinspection PyBroadException
+                try:
+                    self._send(target)
+                except Exception:
+                    log.exception("Error sending channel status poll to repeater %s", target.repeater)
+
+    ################################
+    # Responses
+    ################################
+
+    def _msg(self, sock, p):
+        txc = p.txCtrl
+        if not isinstance(txc, RCPChannelStatusOrParameterCheckResponse):
+            return
+
+        repeater = p.repeater.radioID if getattr(p, 'repeater', None) is not None else None
+        with self._cond:
+            link = self._links.get((sock, repeater))
+            if link is None:
+                # Polling the default repeater (repeater=None)
+                link = self._links.get((sock, None))
+                repeater = None
+            if link is None or link.outstanding is None:
+                return
+            target = link.outstanding
+            if not _answers(target, txc):
+                # Somebody else's request, or a late answer to one of ours which asked for something else
+                self.unmatched += 1
+                return
+            link.outstanding = None
+            # The link is free -- wake the thread in case a poll was deferred
+            self._cond.notify_all()
+
+        if txc.result != SuccessFailResult.SUCCESS:
+            target.failures += 1
+            return
+        target.responses += 1
+
+        now = self.clock.time()
+        key = target.repeater if target.repeater is not None else repeater
+        for param, value in txc.response:
+            s = self._series.get((key, param))
+            if s is None:
+                s = self._series.setdefault((key, param), RingSeries(self.history))
+            s.append(now, value)
+
+
+def _answers(target, txc):
+    """ Returns True if a response can be the answer to a target's poll: it has every parameter polled """
+    if txc.result != SuccessFailResult.SUCCESS and not txc.response:
+        return True
+    got = set(param for param, _ in txc.response)
+    return all(param in got for param in target.params if param != StatusParameter.STATUS_OF_ALL_CHANNELS)
+
+
+def _ignore_ack(_seq):
+    """ ACK callback for polls (keeps send() from blocking) """
+    pass
@@ -0,0 +1,248 @@
+"""
+
+ADK Repeater Interface
+
+Clocks
+
+Everything in the socket layer which depends on time -- heartbeats, the watchdog, ACK timeouts, transmit
+deadlines, ingress quarantines -- gets the time and waits through a Clock, rather than calling the time
+module directly. So do RCP response timeouts, the RTP pacing in hylink.fanout and hylink.announce, TMS
+answer timeouts and backoff, radio registry expiry, the channel poller's schedule, replay pacing and the
+repeater simulator.
+
+The default clock (SYSTEM_CLOCK) is the real time. A VirtualClock only moves when it's told to, so tests
+and simulations can fast-forward through hours of protocol behaviour in seconds:
+
+    clock = VirtualClock()
+    sock = ADKSocket(port, clock=clock)
+    ...
+    clock.advance(HEARTBEAT_TIMEOUT + 1)    # The watchdog expires, without waiting 30 seconds
+
+Timed waits have to go through the clock for this to work: Clock.wait() and wait_for() replace
+Condition.wait() and wait_for(), Clock.sleep() replaces time.sleep(), and Clock.queue_get() replaces
+queue.Queue.get(). Waits without a timeout, and I/O (select, recvfrom), are unaffected.
+
+"""
+
+import heapq
+import queue
+import threading
+import time
+
+
+class Clock(object):
+    """ The system clock """
+
+    def monotonic(self):
+        """ Returns the monotonic time (seconds), like time.monotonic() """
+        return time.monotonic()
+
+    def time(self):
+        """ Returns the wall clock time (seconds since the epoch), like time.time() """
+        return time.time()
+
+    def sleep(self, seconds):
+        """ Sleep for a number of seconds """
+        if seconds > 0:
+            time.sleep(seconds)
+
+    def wait(self, cond, timeout=None):
+        """
+        Wait on a condition variable, like cond.wait(timeout). The caller must hold the condition's lock.
+
+        :return: False if the timeout expired, otherwise True
+        """
+        return cond.wait(timeout)
+
+    def wait_for(self, cond, predicate, timeout=None):
+        """
+        Wait until a condition is true, like cond.wait_for(predicate, timeout). The caller must hold the
+        condition's lock.
+
+        :return: The last value of the predicate
+        """
+        result = predicate()
+        if result or timeout is not None and timeout <= 0:
+            return result
+        end = None if timeout is None else self.monotonic() + timeout
+        while not result:
+            if end is not None:
+                remaining = end - self.monotonic()
+                if remaining <= 0:
+                    break
+                self.wait(cond, remaining)
+            else:
+                self.wait(cond)
+            result = predicate()
+        return result
+
+    def queue_get(self, q, timeout=None):
+        """ Get an item from a queue.Queue, like q.get(timeout=timeout) """
+        return q.get(timeout=timeout)
+
+
+# The default clock
+SYSTEM_CLOCK = Clock()
+
+
+class _Waiter(object):
+    """ A thread waiting on a VirtualClock """
+
+    __slots__ = ('deadline', 'cond', 'thread', 'active')
+
+    def __init__(self, deadline, cond):
+        self.deadline = deadline
+        self.cond = cond
+        self.thread = threading.get_ident()
+        self.active = True
+
+
+class VirtualClock(Clock):
+    """ A clock which only moves when advance() is called """
+
+    def __init__(self, start=0.0, epoch=None, settle=0.05):
+        """
+        Create a virtual clock
+
+        :param start: Initial monotonic time
+        :param epoch: Wall clock time (time.time() value) at the initial monotonic time. Defaults to the
+            real time now.
+        :param settle: Maximum real time (seconds) advance() gives the threads it wakes to get back to waiting
+            before it moves the clock on again
+        """
+        self._now = float(start)
+        self._epoch = (time.time() if epoch is None else epoch) - self._now
+        self.settle = settle
+
+        self._lock = threading.Condition()
+        # Timed waits: heap of (deadline, count, _Waiter)
+        self._waiters = []
+        self._count = 0
+        # Threads blocked in a wait (so advance() can tell when the threads it woke are waiting again)
+        self._blocked = set()
+
+    def __repr__(self):
+        return "<%s: %.3f, %d waiting>" % (type(self).__name__, self._now, len(self._waiters))
+
+    def monotonic(self):
+        return self._now
+
+    def time(self):
+        return self._epoch + self._now
+
+    def next_deadline(self):
+        """ Returns the time of the earliest timed wait, or None if nothing is waiting """
+        with self._lock:
+            self._prune()
+            return self._waiters[0][0] if self._waiters else None
+
+    def _prune(self):
+        """ Drop finished waits from the top of the heap. Caller must hold _lock. """
+        while self._waiters and not self._waiters[0][2].active:
+            heapq.heappop(self._waiters)
+
+    ################################
+    # Waiting
+    ################################
+
+    def wait(self, cond, timeout=None):
+        me = threading.get_ident()
+        if timeout is None:
+            with self._lock:
+                self._blocked.add(me)
+                self._lock.notify_all()
+            try:
+                return cond.wait()
+            finally:
+                self._unblock(me)
+
+        # Register the wait before releasing cond, so advance() can't notify before we're waiting
+        # (advance() takes cond's lock to notify)
+        waiter = _Waiter(self._now + max(timeout, 0), cond)
+        with self._lock:
+            if waiter.deadline <= self._now:
+                return False
+            self._count += 1
+            heapq.heappush(self._waiters, (waiter.deadline, self._count, waiter))
+            self._blocked.add(me)
+            self._lock.notify_all()
+        try:
+            cond.wait()
+        finally:
+            waiter.active = False
+            self._unblock(me)
+        return self._now < waiter.deadline
+
+    def _unblock(self, thread):
+        with self._lock:
+            self._blocked.discard(thread)
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        cond = threading.Condition()
+        end = self._now + seconds
+        with cond:
+            while self._now < end:
+                self.wait(cond, end - self._now)
+
+    def queue_get(self, q, timeout=None):
+        if timeout is None:
+            return q.get()
+        # Wait on the queue's own condition. _qsize() and _get() are queue.Queue's extension points.
+        end = self._now + timeout
+        with q.not_empty:
+            while not q._qsize():
+                remaining = end - self._now
+                if remaining <= 0:
+                    raise queue.Empty()
+                self.wait(q.not_empty, remaining)
+            item = q._get()
+            q.not_full.notify()
+            return item
+
+    ################################
+    # Moving the clock
+    ################################
+
+    def advance(self, seconds):
+        """
+        Move the clock forward. Timed waits are woken in deadline order, with the clock set to each deadline
+        in turn, and given up to 'settle' seconds of real time to get back to waiting before the clock moves on.
+
+        :param seconds: Time to move forward
+        """
+        target = self._now + seconds
+        while True:
+            with self._lock:
+                self._prune()
+                if not self._waiters or self._waiters[0][0] > target:
+                    break
+                deadline = self._waiters[0][0]
+                self._now = max(self._now, deadline)
+                due = []
+                while self._waiters and self._waiters[0][0] <= self._now:
+                    waiter = heapq.heappop(self._waiters)[2]
+                    if waiter.active:
+                        due.append(waiter)
+                        # Not blocked any more, as far as _settle() is concerned
+                        self._blocked.discard(waiter.thread)
+
+            # Wake the waiters without holding _lock (they take it when they wait again)
+            for waiter in due:
+                with waiter.cond:
+                    waiter.cond.notify_all()
+            self._settle({w.thread for w in due})
+
+        with self._lock:
+            self._now = max(self._now, target)
+
+    def _settle(self, threads):
+        """ Give woken threads a chance to run, until they're all waiting again (or 'settle' passes) """
+        end = time.monotonic() + self.settle
+        with self._lock:
+            while not threads <= self._blocked:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
@@ -0,0 +1,124 @@
+"""
+
+ADK Repeater Interface
+
+Callback dispatcher
+
+Decouples the receive thread from application callbacks. Received packets are queued in bounded
+per-class queues and handed to the callbacks by a pool of worker threads, so a slow callback can't
+stall the socket.
+
+RCP messages are never dropped: if their queue fills up, the receive thread waits (backpressure).
+RTP frames are dropped oldest-first instead, as stale audio is worthless.
+
+Events -- connection changes and ACK callbacks -- have a queue of their own, which never blocks, as they're
+raised by the transmit thread as well as the receive thread (a transmit thread waiting on a slow callback
+would stop the heartbeats, and every repeater would disconnect). They're delivered before any waiting
+messages, so a connection is always announced before its first message.
+
+With more than one worker thread, packets of the same class may be delivered out of order.
+
+"""
+
+import logging
+import threading
+from enum import IntEnum
+
+from .queues import LaneQueue, OverflowPolicy
+
+log = logging.getLogger(__name__)
+
+
+class PacketClass(IntEnum):
+    """ Dispatch classes, highest priority first """
+    EVENT = 0       # Connection events and ACK callbacks
+    RCP = 1         # Messages from the repeater (HSTRPFromRadio)
+    RTP = 2         # RTP voice frames
+
+
+# Default maximum queue depth and overflow policy for each packet class
+DISPATCH_QUEUE_DEPTHS = {
+    PacketClass.EVENT:  4096,
+    PacketClass.RCP:    1024,
+    PacketClass.RTP:    256,
+}
+DISPATCH_POLICIES = {
+    PacketClass.EVENT:  OverflowPolicy.DROP_OLDEST,
+    PacketClass.RCP:    OverflowPolicy.BLOCK,
+    PacketClass.RTP:    OverflowPolicy.DROP_OLDEST,
+}
+
+
+class CallbackDispatcher(object):
+    """ Runs packet callbacks on a pool of worker threads """
+
+    def __init__(self, workers=1, depths=None, policies=None, name="ADKDispatch"):
+        """
+        Create a callback dispatcher
+
+        :param workers: Number of worker threads. If 0, callbacks are called inline by submit().
+        :param depths: Dict of PacketClass -> maximum queue depth (defaults to DISPATCH_QUEUE_DEPTHS)
+        :param policies: Dict of PacketClass -> OverflowPolicy (defaults to DISPATCH_POLICIES)
+        :param name: Name used for the worker thread names
+        """
+        d = dict(DISPATCH_QUEUE_DEPTHS)
+        d.update(depths or {})
+        pol = dict(DISPATCH_POLICIES)
+        pol.update(policies or {})
+
+        self._queue = LaneQueue([d[x] for x in PacketClass], [pol[x] for x in PacketClass])
+
+        # Per-class counters
+        self.dispatched = [0] * len(PacketClass)
+        self.errors = [0] * len(PacketClass)
+
+        self._threads = []
+        for i in range(workers):
+            t = threading.Thread(target=self._worker_proc, name="%s-%d" % (name, i), daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, pclass, callback, packet):
+        """
+        Queue a packet for a callback.
+
+        Returns True if the packet was queued (or dispatched inline), or False if it was dropped.
+        """
+        if not self._threads:
+            self._call(pclass, callback, packet)
+            return True
+
+        return self._queue.put((pclass, callback, packet), pclass)
+
+    def _call(self, pclass, callback, packet):
+        # noinspection PyBroadException
+        try:
+            callback(packet)
+        except Exception:
+            self.errors[pclass] += 1
+            log.exception("Exception in %s callback", pclass.name)
+        self.dispatched[pclass] += 1
+
+    def _worker_proc(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            self._call(*item)
+
+    def stats(self):
+        """ Return a dict of counters for each packet class: queue depth, dispatched, dropped and errors """
+        return {
+            pclass.name: {
+                'depth': self._queue.depth(pclass),
+                'dispatched': self.dispatched[pclass],
+                'dropped': self._queue.dropped[pclass],
+                'errors': self.errors[pclass],
+            } for pclass in PacketClass
+        }
+
+    def stop(self):
+        """ Stop the worker threads. Packets still waiting in the queues are discarded. """
+        self._queue.close()
+        for t in self._threads:
+            t.join()
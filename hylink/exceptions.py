@@ -18,3 +18,7 @@ class HYTPacketDataError(ADKException):
     """ Hytera data: packet is not valid """
     pass
 
+
+class ADKQueueFull(ADKException):
+    """ A bounded queue is full and its overflow policy doesn't allow the item to be dropped """
+    pass
@@ -0,0 +1,288 @@
+"""
+
+ADK Repeater Interface
+
+RTP broadcast fan-out
+
+An RTPFanout sends one audio stream to any number of repeaters at once, for site-wide announcements:
+
+    fanout = RTPFanout()
+    for radioID in repeaters:
+        fanout.add(rtpSocket, radioID)
+    stream = fanout.play(g711_frames(ulawAudio))
+    stream.wait()
+    fanout.close()
+
+The audio is encoded once (by the caller), and each RTP frame is serialised once, when the stream is
+queued. For each repeater, only the sequence number, timestamp and SSRC are patched into a copy of the
+frame, which is handed to the ADKSocket as bytes -- no per-repeater RTPPacket objects or serialisation.
+
+A single thread sends the frames for every repeater on a shared 20ms tick, so the pacing costs the same
+however many repeaters there are, and all of them get each frame at the same time.
+
+The fan-out only sends audio: keying up the repeaters (call request and PTT) is done separately, e.g. with
+RepeaterSession or RCPCorrelator.
+
+"""
+
+import collections
+import logging
+import random
+import struct
+import threading
+
+from .clock import SYSTEM_CLOCK
+from .rtp import RTPPacket, RTPPayloadType
+
+log = logging.getLogger(__name__)
+
+
+# RTP frame: 160 samples (20ms) at 8kHz
+FANOUT_FRAME_SAMPLES = 160
+FANOUT_FRAME_TIME = 0.02
+
+# If the tick thread falls this many frames behind (e.g. the process was suspended), it skips ahead
+# rather than sending a burst of late frames
+FANOUT_MAX_LAG = 5
+
+# Hytera RTP header extension -- the repeater won't repeat the audio without it
+FANOUT_EXTENSION = {'type': 0x15, 'data': [0, 0, 0]}
+
+# Sequence number, timestamp and SSRC, at offset 2 of the RTP header
+_PATCH = struct.Struct('!HLL')
+_PATCH_OFFSET = 2
+
+# Silent G.711 payload bytes
+_SILENCE = {RTPPayloadType.HYTERA_PCMU: b'\xff', RTPPayloadType.HYTERA_PCMA: b'\xd5'}
+
+
+def g711_frames(data, payloadType=RTPPayloadType.HYTERA_PCMU):
+    """
+    Split G.711 audio into 20ms frames, padding the last one with silence
+
+    :param data: G.711 encoded audio (one byte per sample)
+    :param payloadType: RTPPayloadType of the audio (for the padding)
+    :return: List of 160-byte payloads
+    """
+    data = bytes(data)
+    frames = [data[i:i + FANOUT_FRAME_SAMPLES] for i in range(0, len(data), FANOUT_FRAME_SAMPLES)]
+    if frames and len(frames[-1]) < FANOUT_FRAME_SAMPLES:
+        frames[-1] += _SILENCE.get(payloadType, b'\xff') * (FANOUT_FRAME_SAMPLES - len(frames[-1]))
+    return frames
+
+
+class FanoutTarget(object):
+    """ One repeater receiving the fan-out, with its own RTP sequence number, timestamp and SSRC """
+
+    __slots__ = ('sock', 'repeater', 'seq', 'timestamp', 'ssrc', 'sent', 'dropped')
+
+    def __init__(self, sock, repeater):
+        self.sock = sock
+        self.repeater = repeater
+        self.seq = random.getrandbits(16)
+        self.timestamp = random.getrandbits(32)
+        self.ssrc = random.getrandbits(32)
+
+        # Counters -- frames sent, and frames dropped because the repeater wasn't connected
+        self.sent = 0
+        self.dropped = 0
+
+    def __repr__(self):
+        return "<%s: repeater %s, ssrc %08X (sent %d, dropped %d)>" % \
+               (type(self).__name__, self.repeater, self.ssrc, self.sent, self.dropped)
+
+
+class FanoutStream(object):
+    """ An audio stream queued on an RTPFanout """
+
+    def __init__(self, frames, callback=None):
+        # Serialised RTP frames, with zero sequence number, timestamp and SSRC
+        self.frames = frames
+        self.callback = callback
+        # Frames sent so far
+        self.position = 0
+        self._event = threading.Event()
+
+    def __repr__(self):
+        return "<%s: %d/%d frames>" % (type(self).__name__, self.position, len(self.frames))
+
+    def done(self):
+        """ Returns True if every frame has been sent (or the fan-out was closed) """
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        """ Wait for the stream to finish. Returns True if it finished, False on timeout. """
+        return self._event.wait(timeout)
+
+    def _complete(self):
+        self._event.set()
+        if self.callback is not None:
+            # noinspection PyBroadException
+            try:
+                self.callback(self)
+            except Exception:
+                log.exception("Exception in fan-out stream callback")
+
+
+class RTPFanout(object):
+    """ Sends one audio stream to many repeaters, on a shared 20ms tick """
+
+    def __init__(self, payload_type=RTPPayloadType.HYTERA_PCMU, extension=FANOUT_EXTENSION, clock=None):
+        """
+        Create a fan-out sender and start its thread
+
+        :param payload_type: RTPPayloadType of the audio
+        :param extension: RTP header extension (see RTPPacket)
+        :param clock: hylink.clock.Clock which paces the frames (defaults to the system clock)
+        """
+        self.payloadType = payload_type
+        self.extension = extension
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        self._cond = threading.Condition()
+        # Targets by (socket, repeater). The tick thread works from a tuple, which is replaced (not modified)
+        # when targets are added or removed.
+        self._targets = {}
+        self._targetList = ()
+        # Streams waiting to be sent, oldest first
+        self._streams = collections.deque()
+
+        # Counters
+        self.ticks = 0
+        self.late = 0
+
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="RTPFanout", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """ Stop the fan-out. Streams which haven't finished are abandoned (and marked done). """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        while self._streams:
+            self._streams.popleft()._complete()
+
+    ################################
+    # Targets and streams
+    ################################
+
+    def add(self, sock, repeater=None):
+        """
+        Add a repeater. It starts receiving from the next frame.
+
+        :param sock: ADKSocket bound to the repeater's RTP port
+        :param repeater: Repeater radio ID (see ADKSocket.get_session)
+        """
+        with self._cond:
+            target = self._targets.get((sock, repeater))
+            if target is None:
+                target = FanoutTarget(sock, repeater)
+                self._targets[(sock, repeater)] = target
+                self._targetList = tuple(self._targets.values())
+        return target
+
+    def remove(self, sock, repeater=None):
+        """ Remove a repeater """
+        with self._cond:
+            if self._targets.pop((sock, repeater), None) is not None:
+                self._targetList = tuple(self._targets.values())
+
+    def targets(self):
+        """ Returns a list of the FanoutTargets """
+        return list(self._targetList)
+
+    def pending(self):
+        """ Returns the number of streams waiting to be sent (including one being sent) """
+        return len(self._streams)
+
+    def play(self, frames, callback=None):
+        """
+        Queue an audio stream. Streams are sent one after another.
+
+        :param frames: 20ms G.711 payloads (bytes, 160 each -- see g711_frames)
+        :param callback: If given, called as callback(stream) when the last frame has been sent
+        :return: FanoutStream
+        """
+        # Serialise each frame once. The marker bit is set on the first frame of the stream.
+        pkt = RTPPacket()
+        pkt.payloadType = self.payloadType
+        pkt.extension = self.extension
+        encoded = []
+        for i, payload in enumerate(frames):
+            pkt.marker = i == 0
+            pkt.payload = payload
+            encoded.append(bytes(pkt))
+
+        stream = FanoutStream(encoded, callback)
+        with self._cond:
+            if not self._running:
+                raise ValueError("Fan-out closed")
+            self._streams.append(stream)
+            self._cond.notify_all()
+        return stream
+
+    ################################
+    # Transmit
+    ################################
+
+    def _send_frame(self, frame):
+        """ Send one frame to every target, patching in each target's sequence number, timestamp and SSRC """
+        for target in self._targetList:
+            target.seq = (target.seq + 1) & 0xFFFF
+            target.timestamp = (target.timestamp + FANOUT_FRAME_SAMPLES) & 0xFFFFFFFF
+
+            # A new buffer for each target: the socket queues it, so it can't be reused
+            buf = bytearray(frame)
+            _PATCH.pack_into(buf, _PATCH_OFFSET, target.seq, target.timestamp, target.ssrc)
+            if target.sock.get_session(target.repeater) is None:
+                target.dropped += 1
+                continue
+            target.sock.send(buf, repeater=target.repeater)
+            target.sent += 1
+
+    def _thread_proc(self):
+        clock = self.clock
+        nextTick = None
+        while True:
+            with self._cond:
+                # Sleep until there's something to send
+                while self._running and not self._streams:
+                    nextTick = None
+                    self._cond.wait()
+                if not self._running:
+                    return
+
+                now = clock.monotonic()
+                if nextTick is None:
+                    nextTick = now
+                elif now < nextTick:
+                    clock.wait(self._cond, nextTick - now)
+                    continue
+                elif now - nextTick > FANOUT_MAX_LAG * FANOUT_FRAME_TIME:
+                    # Fell well behind -- skip ahead, rather than sending a burst of frames
+                    self.late += 1
+                    log.warning("Fan-out fell %.0fms behind, skipping ahead", (now - nextTick) * 1000)
+                    nextTick = now
+
+                stream = self._streams[0]
+                frame = stream.frames[stream.position] if stream.position < len(stream.frames) else None
+                stream.position += 1
+                finished = stream.position >= len(stream.frames)
+                if finished:
+                    self._streams.popleft()
+
+            if frame is not None:
+                # noinspection PyBroadException
+                try:
+                    self._send_frame(frame)
+                except Exception:
+                    log.exception("Error sending fan-out frame")
+            if finished:
+                stream._complete()
+
+            self.ticks += 1
+            nextTick += FANOUT_FRAME_TIME
@@ -0,0 +1,259 @@
+"""
+
+ADK Repeater Interface
+
+Ingress filtering
+
+Anything on the network can send datagrams to an ADKSocket's port. An IngressFilter drops unwanted
+traffic before it's decoded:
+
+    ingress = IngressFilter(allow=['192.168.1.10', '192.168.1.11'])
+    rcpSocket.set_ingress_filter(ingress)
+    rtpSocket.set_ingress_filter(ingress)       # Filters can be shared between sockets
+
+  * Source address allowlist. Datagrams from hosts which aren't on the list are dropped unread. Hosts
+    can be configured, and (unless learning is turned off) a host is added when a repeater on it sends a
+    SYN -- SYNs are recognised from their first four bytes, so no decoding is done for unknown hosts.
+
+  * Rate-limited error logging. Each source host has a token bucket for decode errors: while it has
+    tokens, errors are logged in full; once it runs dry, errors are only counted, with a summary logged
+    every so often.
+
+  * Quarantine. A host which keeps sending undecodable datagrams after its bucket has run dry is
+    quarantined -- everything it sends is dropped unread -- for a while. Configured hosts are never
+    quarantined.
+
+Per-host state is kept for a bounded number of hosts, so a flood from spoofed addresses can't use up memory.
+
+A shared filter is called from several sockets' receive threads at once, so its host state is guarded by
+a lock. The common case -- a datagram from an allowed host which isn't quarantined -- doesn't take it.
+
+"""
+
+import collections
+import logging
+import threading
+
+from .clock import SYSTEM_CLOCK
+
+log = logging.getLogger(__name__)
+
+
+# Decode error token bucket: errors logged per second per host, and the burst allowed
+INGRESS_ERROR_RATE = 1.0
+INGRESS_ERROR_BURST = 5
+
+# Errors a host can send with an empty bucket before it's quarantined, and the quarantine period (seconds)
+INGRESS_QUARANTINE_AFTER = 50
+INGRESS_QUARANTINE_TIME = 300
+
+# Maximum number of hosts with error or quarantine state
+INGRESS_MAX_HOSTS = 1024
+
+# Interval between summaries of suppressed errors and dropped datagrams (seconds)
+INGRESS_SUMMARY_INTERVAL = 60
+
+# First bytes of a SYN: the HYT signature, then the SYN packet type
+_SYN_PREFIX = b'\x32\x42\x00\x24'
+
+
+class _HostState(object):
+    """ Decode error state for one host """
+
+    __slots__ = ('tokens', 'updated', 'strikes', 'suppressed', 'quarantinedUntil', 'lastSummary')
+
+    def __init__(self, now, burst):
+        self.tokens = float(burst)
+        self.updated = now
+        # Errors since the bucket ran dry
+        self.strikes = 0
+        # Errors not logged since the last summary
+        self.suppressed = 0
+        self.quarantinedUntil = 0
+        self.lastSummary = now
+
+
+class IngressFilter(object):
+    """ Early-drop stage for the ADKSocket receive path """
+
+    def __init__(self, allow=(), learn=True, error_rate=INGRESS_ERROR_RATE, error_burst=INGRESS_ERROR_BURST,
+                 quarantine_after=INGRESS_QUARANTINE_AFTER, quarantine_time=INGRESS_QUARANTINE_TIME,
+                 max_hosts=INGRESS_MAX_HOSTS, clock=None):
+        """
+        Create an ingress filter
+
+        :param allow: Host addresses (strings) which are always accepted
+        :param learn: If True, hosts which send a SYN are added to the allowlist. If False, only the
+            configured hosts are accepted.
+        :param error_rate: Decode errors logged per second for each host
+        :param error_burst: Decode errors which can be logged in a burst for each host
+        :param quarantine_after: Errors a host can send after its error bucket is empty before it is quarantined
+            (None to never quarantine)
+        :param quarantine_time: Quarantine period (seconds)
+        :param max_hosts: Maximum number of hosts to keep error state for
+        :param clock: hylink.clock.Clock for the token buckets and quarantine periods (defaults to the system clock)
+        """
+        self.learn = learn
+        self.errorRate = error_rate
+        self.errorBurst = error_burst
+        self.quarantineAfter = quarantine_after
+        self.quarantineTime = quarantine_time
+        self.maxHosts = max_hosts
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        # Guards the allowlist, host state and quarantines
+        self._lock = threading.Lock()
+        self._configured = set(allow)
+        self._allowed = set(allow)
+        # Hosts with error state, least recently seen first (host -> _HostState)
+        self._hosts = collections.OrderedDict()
+        # Quarantined hosts (host -> end of quarantine, clock monotonic())
+        self._quarantined = {}
+
+        # Counters
+        self.droppedUnknown = 0
+        self.droppedQuarantined = 0
+        self.decodeErrors = 0
+        self.suppressed = 0
+        self.quarantines = 0
+        self._lastDropLog = 0
+        self._dropsSinceLog = 0
+
+    def __repr__(self):
+        return "<%s: %d allowed, %d quarantined, dropped %d unknown / %d quarantined>" % \
+               (type(self).__name__, len(self._allowed), len(self._quarantined), self.droppedUnknown,
+                self.droppedQuarantined)
+
+    ################################
+    # Allowlist
+    ################################
+
+    def allow(self, host):
+        """ Add a host to the configured allowlist (and lift any quarantine) """
+        with self._lock:
+            self._configured.add(host)
+            self._allowed.add(host)
+            self._quarantined.pop(host, None)
+
+    def learn_host(self, host):
+        """ Add a host to the allowlist because a repeater on it has connected. Called by ADKSocket. """
+        if self.learn and host not in self._allowed:
+            log.debug("Ingress: learned repeater host %s", host)
+            with self._lock:
+                self._allowed.add(host)
+
+    def forget(self, host):
+        """ Remove a learned host from the allowlist """
+        with self._lock:
+            if host not in self._configured:
+                self._allowed.discard(host)
+
+    def allowed(self):
+        """ Returns the set of allowed hosts """
+        with self._lock:
+            return set(self._allowed)
+
+    def quarantined(self):
+        """ Returns a dict of quarantined host -> seconds until the quarantine ends """
+        now = self.clock.monotonic()
+        with self._lock:
+            return {h: until - now for h, until in self._quarantined.items() if until > now}
+
+    ################################
+    # Receive path
+    ################################
+
+    def accept(self, data, addr):
+        """
+        Decide whether to process a datagram. Called by the ADKSocket receive thread before decoding.
+
+        :param data: Datagram
+        :param addr: Source address (host, port)
+        :return: True to process the datagram, False to drop it
+        """
+        host = addr[0]
+        if self._quarantined and host in self._quarantined:
+            with self._lock:
+                until = self._quarantined.get(host)
+                if until is not None and self.clock.monotonic() < until:
+                    self.droppedQuarantined += 1
+                    return False
+                released = self._quarantined.pop(host, None) is not None
+            if released:
+                log.info("Ingress: %s released from quarantine", host)
+
+        if host in self._allowed:
+            return True
+
+        # A SYN from an unknown host is let through, so the repeater can connect (and be learned)
+        if self.learn and data[:4] == _SYN_PREFIX:
+            return True
+
+        self.droppedUnknown += 1
+        self._dropsSinceLog += 1
+        now = self.clock.monotonic()
+        if now - self._lastDropLog >= INGRESS_SUMMARY_INTERVAL:
+            log.warning("Ingress: dropped %d datagram(s) from hosts not on the allowlist (latest from %s)",
+                        self._dropsSinceLog, addr)
+            self._lastDropLog = now
+            self._dropsSinceLog = 0
+        return False
+
+    def decode_error(self, addr):
+        """
+        Record a decode error. Called by the ADKSocket receive thread.
+
+        :param addr: Source address (host, port)
+        :return: True if the error should be logged in full, False if it should be suppressed
+        """
+        host = addr[0]
+        now = self.clock.monotonic()
+        with self._lock:
+            self.decodeErrors += 1
+            return self._decode_error(host, now)
+
+    def _decode_error(self, host, now):
+        """ Caller must hold _lock """
+        state = self._hosts.get(host)
+        if state is None:
+            state = _HostState(now, self.errorBurst)
+            self._hosts[host] = state
+            if len(self._hosts) > self.maxHosts:
+                self._hosts.popitem(last=False)
+        else:
+            self._hosts.move_to_end(host)
+
+        # Refill the bucket
+        state.tokens = min(float(self.errorBurst), state.tokens + (now - state.updated) * self.errorRate)
+        state.updated = now
+
+        if state.tokens >= 1:
+            state.tokens -= 1
+            state.strikes = 0
+            return True
+
+        # Bucket is empty -- count the error, and log a summary now and then
+        self.suppressed += 1
+        state.suppressed += 1
+        state.strikes += 1
+        if now - state.lastSummary >= INGRESS_SUMMARY_INTERVAL:
+            log.warning("Ingress: %d decode error(s) from %s not logged", state.suppressed, host)
+            state.suppressed = 0
+            state.lastSummary = now
+
+        if self.quarantineAfter is not None and state.strikes >= self.quarantineAfter and \
+                host not in self._configured:
+            self._quarantine(host, now)
+        return False
+
+    def _quarantine(self, host, now):
+        """ Caller must hold _lock """
+        if len(self._quarantined) >= self.maxHosts:
+            # Make room, oldest quarantine first
+            del self._quarantined[min(self._quarantined, key=self._quarantined.get)]
+        self._quarantined[host] = now + self.quarantineTime
+        self._allowed.discard(host)
+        self._hosts.pop(host, None)
+        self.quarantines += 1
+        log.warning("Ingress: quarantined %s for %ds after repeated undecodable datagrams", host,
+                    self.quarantineTime)
@@ -0,0 +1,227 @@
+"""
+
+ADK Repeater Interface
+
+Metrics
+
+Counters and histograms maintained by ADKSocket and the decode path. Each socket owns a SocketMetrics
+object which is only ever written by the socket's own threads, without locks; snapshot() copies the
+current values without stopping them.
+
+Every socket registers its metrics with the global REGISTRY. The registry can render all of them in the
+Prometheus text exposition format, and start_http_server() serves that on a local port. Nothing is
+formatted unless something asks for it.
+
+"""
+
+import bisect
+import collections
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+log = logging.getLogger(__name__)
+
+
+# Default ACK round trip time histogram buckets (seconds)
+ACK_RTT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Histogram(object):
+    """ Fixed-bucket histogram """
+
+    def __init__(self, buckets):
+        """
+        Create a histogram
+
+        :param buckets: Sequence of bucket upper bounds. Values above the last bound go in an overflow bucket.
+        """
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        """ Add a value to the histogram """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """ Return a copy of the histogram as a dict """
+        return {'buckets': self.buckets, 'counts': list(self.counts), 'sum': self.sum, 'count': self.count}
+
+
+class SocketMetrics(object):
+    """ Metrics for one ADKSocket """
+
+    def __init__(self):
+        # Packets and bytes, per packet class (class name)
+        self.rxPackets = collections.Counter()
+        self.rxBytes = collections.Counter()
+        self.txPackets = collections.Counter()
+        self.txBytes = collections.Counter()
+
+        # Decode failures, per exception type (class name)
+        self.decodeErrors = collections.Counter()
+
+        # Packets which couldn't be sent, per exception type (class name)
+        self.txErrors = collections.Counter()
+
+        # Connection events
+        self.connects = 0
+        self.reconnects = 0
+        self.watchdogExpiries = 0
+        self.resumes = 0
+        self.resumesConfirmed = 0
+
+        # Round trip time between sending an HSTRPToRadio and receiving its ACK (seconds)
+        self.ackRtt = Histogram(ACK_RTT_BUCKETS)
+
+        # Gauges: name -> function returning the current value (a number, or a dict of label -> number)
+        self.gauges = {}
+
+    def snapshot(self):
+        """ Return a copy of the current values as a dict of plain Python types """
+        snap = {
+            'rx_packets': dict(self.rxPackets),
+            'rx_bytes': dict(self.rxBytes),
+            'tx_packets': dict(self.txPackets),
+            'tx_bytes': dict(self.txBytes),
+            'decode_errors': dict(self.decodeErrors),
+            'tx_errors': dict(self.txErrors),
+            'connects': self.connects,
+            'reconnects': self.reconnects,
+            'watchdog_expiries': self.watchdogExpiries,
+            'resumes': self.resumes,
+            'resumes_confirmed': self.resumesConfirmed,
+            'ack_rtt_seconds': self.ackRtt.snapshot(),
+        }
+        for name, fn in list(self.gauges.items()):
+            snap[name] = fn()
+        return snap
+
+
+# Prometheus metadata for the values in a snapshot: name -> (type, label name, help text)
+_PROM_METRICS = {
+    'rx_packets':           ('counter',   'class', "Packets received"),
+    'rx_bytes':             ('counter',   'class', "Bytes received"),
+    'tx_packets':           ('counter',   'class', "Packets transmitted"),
+    'tx_bytes':             ('counter',   'class', "Bytes transmitted"),
+    'decode_errors':        ('counter',   'exception', "Received packets which failed to decode"),
+    'tx_errors':            ('counter',   'exception', "Packets which couldn't be sent"),
+    'connects':             ('counter',   None,    "Repeater connections (SYNs)"),
+    'reconnects':           ('counter',   None,    "Connections from repeaters which had connected before"),
+    'watchdog_expiries':    ('counter',   None,    "Repeaters disconnected by the watchdog"),
+    'resumes':              ('counter',   None,    "Sessions resumed from the state file"),
+    'resumes_confirmed':    ('counter',   None,    "Resumed sessions which the repeater answered"),
+    'ack_rtt_seconds':      ('histogram', None,    "Round trip time from HSTRPToRadio transmit to ACK"),
+    'sessions':             ('gauge',     None,    "Connected repeaters"),
+    'rx_truncated':         ('counter',   None,    "Received datagrams discarded because they were too large"),
+    'tx_queue_depth':       ('gauge',     'lane',  "Packets waiting in each transmit lane"),
+    'tx_dropped':           ('counter',   'lane',  "Packets dropped because their transmit lane was full"),
+    'tx_expired':           ('counter',   'lane',  "Packets dropped because their transmit deadline passed"),
+    'tx_dropped_disconnected': ('counter', None,   "Packets dropped because the repeater wasn't connected"),
+    'dispatch_queue_depth': ('gauge',     'class', "Packets waiting for a callback"),
+    'dispatch_dropped':     ('counter',   'class', "Packets dropped because the callback queue was full"),
+}
+
+
+class MetricsRegistry(object):
+    """ A collection of named metrics sources """
+
+    def __init__(self, prefix='hylink'):
+        self.prefix = prefix
+        self._sources = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, source):
+        """ Register a metrics source (anything with a snapshot() method) under a name """
+        with self._lock:
+            self._sources[name] = source
+
+    def unregister(self, name):
+        """ Remove a metrics source """
+        with self._lock:
+            self._sources.pop(name, None)
+
+    def snapshot(self):
+        """ Return a dict of source name -> snapshot """
+        with self._lock:
+            sources = list(self._sources.items())
+        return {name: source.snapshot() for name, source in sources}
+
+    def render_prometheus(self):
+        """ Render every source's metrics in the Prometheus text exposition format """
+        # Group samples by metric name, so each metric's HELP/TYPE lines are only written once
+        samples = collections.OrderedDict()
+        for source, snap in sorted(self.snapshot().items()):
+            for name, value in snap.items():
+                samples.setdefault(name, []).append((source, value))
+
+        lines = []
+        for name, values in samples.items():
+            mtype, label, helptext = _PROM_METRICS.get(name, ('gauge', 'key', name))
+            fullname = '%s_%s' % (self.prefix, name)
+            if mtype == 'counter':
+                fullname += '_total'
+            lines.append('# HELP %s %s' % (fullname, helptext))
+            lines.append('# TYPE %s %s' % (fullname, mtype))
+
+            for source, value in values:
+                src = 'socket="%s"' % _escape(source)
+                if mtype == 'histogram':
+                    cumulative = 0
+                    bounds = [repr(float(b)) for b in value['buckets']] + ['+Inf']
+                    for le, n in zip(bounds, value['counts']):
+                        cumulative += n
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (fullname, src, le, cumulative))
+                    lines.append('%s_sum{%s} %s' % (fullname, src, repr(float(value['sum']))))
+                    lines.append('%s_count{%s} %d' % (fullname, src, value['count']))
+                elif isinstance(value, dict):
+                    for key, n in sorted(value.items(), key=lambda kv: str(kv[0])):
+                        lines.append('%s{%s,%s="%s"} %s' % (fullname, src, label or 'key', _escape(key), n))
+                else:
+                    lines.append('%s{%s} %s' % (fullname, src, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(s):
+    return str(s).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# Global registry -- every ADKSocket registers its metrics here
+REGISTRY = MetricsRegistry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, host='127.0.0.1', registry=REGISTRY):
+    """
+    Serve the registry's metrics in Prometheus text format on http://host:port/metrics
+
+    The server runs on a daemon thread. Call shutdown() on the returned server to stop it.
+    """
+    class _Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            log.debug("Metrics request from %s: " + fmt, self.address_string(), *args)
+
+    server = _ThreadingHTTPServer((host, port), _Handler)
+    t = threading.Thread(target=server.serve_forever, name="hylink-metrics.%d" % port, daemon=True)
+    t.start()
+    return server
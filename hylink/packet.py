@@ -2,8 +2,10 @@
 ADK transport layer (HYT)
 """
 
+import functools
 import logging
 import struct
+import time
 from .types import *
 from .exceptions import *
 from .utils import *
@@ -20,6 +22,10 @@ CFG_RETURN_NONE_ON_UNKNOWN_PCLASS = False
 # If False -- raises a HYTUnhandledType exception
 CFG_RETURN_NONE_ON_UNKNOWN_TXCTRL_OPCODE = False
 
+# Profiling hook -- if set, called as FACTORY_PROFILE_HOOK(elapsed_ns) after every TxCtrlBase.factory() call.
+# Installed by hylink.profiling.StageProfiler.
+FACTORY_PROFILE_HOOK = None
+
 
 class HYTPacket(object):
 
@@ -397,6 +403,17 @@ class TxCtrlBase(object):
 
     @staticmethod
     def factory(data):
+        if FACTORY_PROFILE_HOOK is None:
+            return TxCtrlBase._factory(data)
+
+        t = time.perf_counter_ns()
+        try:
+            return TxCtrlBase._factory(data)
+        finally:
+            FACTORY_PROFILE_HOOK(time.perf_counter_ns() - t)
+
+    @staticmethod
+    def _factory(data):
         # Decode as a TxCtrl base packet first
         txcp = TxCtrlBase(data)
 
@@ -763,6 +780,26 @@ class RRSRegister(TxCtrlBase):
 #
 #############################################################################
 
+@functools.lru_cache(maxsize=1024)
+def tmp_encode_text(text):
+    """
+    Encode a text message in the TMP wire format (UTF-16LE).
+
+    Cached, so a message sent to many radios (or resent) is only encoded once.
+    """
+    return text.encode('utf-16le')
+
+
+def tmp_radio_ip(ip, radioID):
+    """
+    Returns the DMR IP to send for a radio ID: the current IP if it belongs to that radio (e.g. it was decoded,
+    and may be on a network other than 10.x.x.x), otherwise the radio's default IP.
+    """
+    if ip is not None and dmr_ip_to_id(ip) == radioID:
+        return ip
+    return dmr_id_to_ip(radioID)
+
+
 class TMPPrivateMessageNeedAck(TxCtrlBase):
     # Hytera API: TMP_PRIVATE_NEED_ACK_REQUEST
 
@@ -778,7 +815,13 @@ class TMPPrivateMessageNeedAck(TxCtrlBase):
 
         if txc is None:
             # empty packet
-            raise NotImplemented()
+            self.msgSeq  = 0
+            self.destID  = 0
+            self.srcID   = 0
+            self.destIP  = dmr_id_to_ip(self.destID)
+            self.srcIP   = dmr_id_to_ip(self.srcID)
+            self.message = ''
+            return
 
         # valid packet
         self.msgSeq, self.destIP, self.srcIP = struct.unpack_from('>III', self.txcPayload)
@@ -788,7 +831,10 @@ class TMPPrivateMessageNeedAck(TxCtrlBase):
 
     def __bytes__(self):
         """ Convert this packet into a byte sequence """
-        raise NotImplemented()
+        self.destIP = tmp_radio_ip(self.destIP, self.destID)
+        self.srcIP  = tmp_radio_ip(self.srcIP, self.srcID)
+        self.txcPayload = struct.pack('>III', self.msgSeq, self.destIP, self.srcIP) + tmp_encode_text(self.message)
+        return super().__bytes__()
 
     def __repr__(self):
         """ Convert this packet into a string representation """
@@ -811,20 +857,40 @@ class TMPPrivateMessageAnswer(TxCtrlBase):
 
         if txc is None:
             # empty packet
-            raise NotImplemented()
+            self.msgSeq = 0
+            self.destID = 0
+            self.srcID  = 0
+            self.destIP = dmr_id_to_ip(self.destID)
+            self.srcIP  = dmr_id_to_ip(self.srcID)
+            self.result = TMSResultCode.OK
+            return
 
         # valid packet
         self.msgSeq, self.destIP, self.srcIP = struct.unpack_from('>III', self.txcPayload)
         self.destID  = dmr_ip_to_id(self.destIP)
         self.srcID   = dmr_ip_to_id(self.srcIP)
- 
+
+        # Result code, if the repeater sent one
+        self.result = None
+        if len(self.txcPayload) > 12:
+            try:
+                self.result = TMSResultCode(self.txcPayload[12])
+            except ValueError:
+                self.result = int(self.txcPayload[12])
+
     def __bytes__(self):
         """ Convert this packet into a byte sequence """
-        raise NotImplemented()
+        self.destIP = tmp_radio_ip(self.destIP, self.destID)
+        self.srcIP  = tmp_radio_ip(self.srcIP, self.srcID)
+        self.txcPayload = struct.pack('>III', self.msgSeq, self.destIP, self.srcIP)
+        if self.result is not None:
+            self.txcPayload += struct.pack('B', self.result)
+        return super().__bytes__()
 
     def __repr__(self):
         """ Convert this packet into a string representation """
-        return "<%s: msgseq=%d, from %d to %d>" % (type(self).__name__, self.msgSeq, self.srcID, self.destID)
+        return "<%s: msgseq=%d, from %d to %d, result %s>" % \
+               (type(self).__name__, self.msgSeq, self.srcID, self.destID, self.result)
 
 
 class TMPGroupMessage(TxCtrlBase):
@@ -842,7 +908,13 @@ class TMPGroupMessage(TxCtrlBase):
 
         if txc is None:
             # empty packet
-            raise NotImplemented()
+            self.msgSeq  = 0
+            self.destID  = 0
+            self.srcID   = 0
+            self.destIP  = dmr_id_to_ip(self.destID)
+            self.srcIP   = dmr_id_to_ip(self.srcID)
+            self.message = ''
+            return
 
         # valid packet
         self.msgSeq, self.destIP, self.srcIP = struct.unpack_from('>III', self.txcPayload)
@@ -852,7 +924,10 @@ class TMPGroupMessage(TxCtrlBase):
 
     def __bytes__(self):
         """ Convert this packet into a byte sequence """
-        raise NotImplemented()
+        self.destIP = tmp_radio_ip(self.destIP, self.destID)
+        self.srcIP  = tmp_radio_ip(self.srcIP, self.srcID)
+        self.txcPayload = struct.pack('>III', self.msgSeq, self.destIP, self.srcIP) + tmp_encode_text(self.message)
+        return super().__bytes__()
 
     def __repr__(self):
         """ Convert this packet into a string representation """
@@ -875,20 +950,40 @@ class TMPGroupMessageAnswer(TxCtrlBase):
 
         if txc is None:
             # empty packet
-            raise NotImplemented()
+            self.msgSeq = 0
+            self.destID = 0
+            self.srcID  = 0
+            self.destIP = dmr_id_to_ip(self.destID)
+            self.srcIP  = dmr_id_to_ip(self.srcID)
+            self.result = TMSResultCode.OK
+            return
 
         # valid packet
         self.msgSeq, self.destIP, self.srcIP = struct.unpack_from('>III', self.txcPayload)
         self.destID  = dmr_ip_to_id(self.destIP)
         self.srcID   = dmr_ip_to_id(self.srcIP)
- 
+
+        # Result code, if the repeater sent one
+        self.result = None
+        if len(self.txcPayload) > 12:
+            try:
+                self.result = TMSResultCode(self.txcPayload[12])
+            except ValueError:
+                self.result = int(self.txcPayload[12])
+
     def __bytes__(self):
         """ Convert this packet into a byte sequence """
-        raise NotImplemented()
+        self.destIP = tmp_radio_ip(self.destIP, self.destID)
+        self.srcIP  = tmp_radio_ip(self.srcIP, self.srcID)
+        self.txcPayload = struct.pack('>III', self.msgSeq, self.destIP, self.srcIP)
+        if self.result is not None:
+            self.txcPayload += struct.pack('B', self.result)
+        return super().__bytes__()
 
     def __repr__(self):
         """ Convert this packet into a string representation """
-        return "<%s: msgseq=%d, from %d to %d>" % (type(self).__name__, self.msgSeq, self.srcID, self.destID)
+        return "<%s: msgseq=%d, from %d to %d, result %s>" % \
+               (type(self).__name__, self.msgSeq, self.srcID, self.destID, self.result)
 
 
 class TMPPrivateMessageNoAck(TxCtrlBase):
@@ -906,7 +1001,13 @@ class TMPPrivateMessageNoAck(TxCtrlBase):
 
         if txc is None:
             # empty packet
-            raise NotImplemented()
+            self.msgSeq  = 0
+            self.destID  = 0
+            self.srcID   = 0
+            self.destIP  = dmr_id_to_ip(self.destID)
+            self.srcIP   = dmr_id_to_ip(self.srcID)
+            self.message = ''
+            return
 
         # valid packet
         self.msgSeq, self.destIP, self.srcIP = struct.unpack_from('>III', self.txcPayload)
@@ -916,7 +1017,10 @@ class TMPPrivateMessageNoAck(TxCtrlBase):
 
     def __bytes__(self):
         """ Convert this packet into a byte sequence """
-        raise NotImplemented()
+        self.destIP = tmp_radio_ip(self.destIP, self.destID)
+        self.srcIP  = tmp_radio_ip(self.srcIP, self.srcID)
+        self.txcPayload = struct.pack('>III', self.msgSeq, self.destIP, self.srcIP) + tmp_encode_text(self.message)
+        return super().__bytes__()
 
     def __repr__(self):
         """ Convert this packet into a string representation """
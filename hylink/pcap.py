@@ -0,0 +1,461 @@
+"""
+
+ADK Repeater Interface
+
+Minimal pcap / pcapng reader and writer
+
+Streams packets from classic libpcap and pcapng capture files without loading the whole file, and
+extracts IPv4 UDP datagrams from them. Only the link types seen on Hytera networks are supported:
+Ethernet (with 802.1Q VLAN tags), Linux cooked capture (SLL and SLL2), BSD loopback and raw IP.
+
+IP fragments are skipped (Hytera traffic is never fragmented).
+
+PcapngWriter writes pcapng files of UDP datagrams, wrapped in synthesised IPv4/UDP headers so the files
+open in Wireshark and can be read back by CaptureReader.
+
+"""
+
+import bisect
+import collections
+import socket
+import struct
+
+from .exceptions import ADKException
+
+
+class CaptureFormatError(ADKException):
+    """ Capture file is not a valid pcap/pcapng file, or uses an unsupported feature """
+    pass
+
+
+# Link types
+LINKTYPE_NULL       = 0         # BSD loopback
+LINKTYPE_ETHERNET   = 1
+LINKTYPE_RAW        = 101       # Raw IPv4/IPv6
+LINKTYPE_LINUX_SLL  = 113
+LINKTYPE_IPV4       = 228
+LINKTYPE_LINUX_SLL2 = 276
+
+# pcapng block types
+_PCAPNG_SHB = 0x0A0D0D0A        # Section header
+_PCAPNG_IDB = 0x00000001        # Interface description
+_PCAPNG_PB  = 0x00000002        # Packet (obsolete)
+_PCAPNG_SPB = 0x00000003        # Simple packet
+_PCAPNG_EPB = 0x00000006        # Enhanced packet
+_PCAPNG_BOM = 0x1A2B3C4D
+
+# pcapng option codes
+_OPT_END        = 0
+_OPT_COMMENT    = 1
+_IF_NAME        = 2
+_IF_DESCRIPTION = 3
+_IF_TSRESOL     = 9
+_SHB_USERAPPL   = 4
+_EPB_FLAGS      = 2
+
+# EPB flags: packet direction
+EPB_INBOUND     = 1
+EPB_OUTBOUND    = 2
+
+# Classic pcap magic numbers: (byte order, timestamp units per second)
+_PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 1000000),
+    b'\xa1\xb2\xc3\xd4': ('>', 1000000),
+    b'\x4d\x3c\xb2\xa1': ('<', 1000000000),
+    b'\xa1\xb2\x3c\x4d': ('>', 1000000000),
+}
+
+
+# A captured frame: offset of its record in the file, timestamp (float seconds since the epoch),
+# link type, and the frame data
+CaptureFrame = collections.namedtuple('CaptureFrame', 'offset timestamp linktype data')
+
+# A UDP datagram extracted from a frame. Addresses are dotted-quad strings.
+UDPDatagram = collections.namedtuple('UDPDatagram', 'offset timestamp src sport dst dport payload')
+
+
+class CaptureReader(object):
+    """ Stream frames from a pcap or pcapng file """
+
+    def __init__(self, f):
+        """
+        :param f: File name, or a binary file object (must be seekable for read_at())
+        """
+        if isinstance(f, (str, bytes)):
+            self._f = open(f, 'rb')
+            self._ownFile = True
+        else:
+            self._f = f
+            self._ownFile = False
+
+        magic = self._f.read(4)
+        if magic == struct.pack('<L', _PCAPNG_SHB):
+            self.format = 'pcapng'
+            self._f.seek(-4, 1)
+            # Per-section state
+            self._endian = '<'
+            self._interfaces = []
+            # File offsets of the section header and interface description blocks read so far. Passing these
+            # to read_at() lets another reader decode packets without reading the file from the start.
+            self.context = []
+            self._contextApplied = None
+        elif magic in _PCAP_MAGIC:
+            self.format = 'pcap'
+            self._endian, self._tsunits = _PCAP_MAGIC[magic]
+            hdr = self._f.read(20)
+            if len(hdr) < 20:
+                raise CaptureFormatError("Truncated pcap header")
+            _vmaj, _vmin, _tz, _sigfigs, _snaplen, self._linktype = struct.unpack(self._endian + 'HHlLLL', hdr)
+        else:
+            raise CaptureFormatError("Not a pcap or pcapng file (magic %r)" % magic)
+
+    def close(self):
+        if self._ownFile:
+            self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self):
+        if self.format == 'pcap':
+            return self._iter_pcap()
+        return self._iter_pcapng()
+
+    def read_at(self, offset, context=None):
+        """
+        Read the frame whose record starts at a file offset (as given in CaptureFrame.offset)
+
+        :param offset: File offset of the record
+        :param context: For pcapng files which haven't been read up to this offset by this reader: the context
+            list of a reader which has (the offsets of the section header and interface description blocks)
+        """
+        if self.format == 'pcap':
+            self._f.seek(offset)
+            return self._read_pcap_record()
+
+        if context is not None:
+            self._apply_context(context, offset)
+        self._f.seek(offset)
+        while True:
+            frame = self._read_pcapng_block()
+            if frame is not False:
+                return frame
+
+    def _apply_context(self, context, offset):
+        """ Re-read the section header and interface blocks which precede a file offset """
+        needed = bisect.bisect_left(context, offset)
+        applied = self._contextApplied
+        if applied is not None and applied[0] is context and applied[1] <= needed:
+            start = applied[1]
+        else:
+            start = 0
+            self._interfaces = []
+        for ofs in context[start:needed]:
+            self._f.seek(ofs)
+            self._read_pcapng_block()
+        self._contextApplied = (context, needed)
+
+    ################################
+    # Classic pcap
+    ################################
+
+    def _read_pcap_record(self):
+        offset = self._f.tell()
+        hdr = self._f.read(16)
+        if len(hdr) < 16:
+            return None
+        ts_sec, ts_frac, incl_len, _orig_len = struct.unpack(self._endian + 'LLLL', hdr)
+        data = self._f.read(incl_len)
+        if len(data) < incl_len:
+            return None
+        return CaptureFrame(offset, ts_sec + ts_frac / self._tsunits, self._linktype, data)
+
+    def _iter_pcap(self):
+        while True:
+            frame = self._read_pcap_record()
+            if frame is None:
+                return
+            yield frame
+
+    ################################
+    # pcapng
+    ################################
+
+    def _read_pcapng_block(self):
+        """ Read one block. Returns a CaptureFrame, None at end of file, or False for a non-packet block. """
+        offset = self._f.tell()
+        hdr = self._f.read(8)
+        if len(hdr) < 8:
+            return None
+
+        if hdr[:4] == struct.pack('<L', _PCAPNG_SHB):
+            # Section header -- work out the byte order from the byte-order magic
+            bom = self._f.read(4)
+            if bom == struct.pack('<L', _PCAPNG_BOM):
+                self._endian = '<'
+            elif bom == struct.pack('>L', _PCAPNG_BOM):
+                self._endian = '>'
+            else:
+                raise CaptureFormatError("Bad pcapng byte-order magic at offset %d" % offset)
+            self._interfaces = []
+            btype, blen = struct.unpack(self._endian + 'LL', hdr)
+            body = bom + self._f.read(blen - 12)
+            self._add_context(offset)
+        else:
+            btype, blen = struct.unpack(self._endian + 'LL', hdr)
+            if blen < 12:
+                raise CaptureFormatError("Bad pcapng block length at offset %d" % offset)
+            body = self._f.read(blen - 8)
+
+        if len(body) < blen - 8:
+            return None
+        # Strip the trailing block length
+        body = body[:-4]
+
+        if btype == _PCAPNG_IDB:
+            linktype, _reserved, _snaplen = struct.unpack_from(self._endian + 'HHL', body)
+            self._interfaces.append((linktype, self._parse_tsresol(body[8:])))
+            self._add_context(offset)
+            return False
+
+        if btype == _PCAPNG_EPB:
+            ifid, ts_hi, ts_lo, caplen, _origlen = struct.unpack_from(self._endian + 'LLLLL', body)
+            linktype, tsunits = self._interface(ifid)
+            ts = ((ts_hi << 32) | ts_lo) / tsunits
+            return CaptureFrame(offset, ts, linktype, body[20:20 + caplen])
+
+        if btype == _PCAPNG_PB:
+            ifid, _drops, ts_hi, ts_lo, caplen, _origlen = struct.unpack_from(self._endian + 'HHLLLL', body)
+            linktype, tsunits = self._interface(ifid)
+            ts = ((ts_hi << 32) | ts_lo) / tsunits
+            return CaptureFrame(offset, ts, linktype, body[20:20 + caplen])
+
+        if btype == _PCAPNG_SPB:
+            # Simple packets have no timestamp, and always come from interface 0
+            origlen = struct.unpack_from(self._endian + 'L', body)[0]
+            linktype, _tsunits = self._interface(0)
+            return CaptureFrame(offset, 0., linktype, body[4:4 + origlen])
+
+        # Some other block type -- ignore it
+        return False
+
+    def _add_context(self, offset):
+        # Only record blocks read in file order (not re-read by read_at)
+        if not self.context or offset > self.context[-1]:
+            self.context.append(offset)
+
+    def _interface(self, ifid):
+        try:
+            return self._interfaces[ifid]
+        except IndexError:
+            raise CaptureFormatError("Packet refers to undefined interface %d" % ifid)
+
+    def _parse_tsresol(self, options):
+        """ Find the if_tsresol option in an IDB's options; returns timestamp units per second """
+        ofs = 0
+        while ofs + 4 <= len(options):
+            code, length = struct.unpack_from(self._endian + 'HH', options, ofs)
+            if code == 0:
+                break
+            if code == 9 and length >= 1:
+                v = options[ofs + 4]
+                return 2 ** (v & 0x7F) if v & 0x80 else 10 ** v
+            ofs += 4 + ((length + 3) & ~3)
+        # Default resolution is microseconds
+        return 1000000
+
+    def _iter_pcapng(self):
+        while True:
+            frame = self._read_pcapng_block()
+            if frame is None:
+                return
+            if frame is not False:
+                yield frame
+
+
+################################
+# Link / network layer decoding
+################################
+
+def frame_to_ip(linktype, data):
+    """ Strip the link-layer header from a frame. Returns the IPv4 packet, or None if it isn't one. """
+    if linktype == LINKTYPE_ETHERNET:
+        ofs = 12
+        ethertype = struct.unpack_from('>H', data, ofs)[0]
+        # Skip any 802.1Q / 802.1ad VLAN tags
+        while ethertype in (0x8100, 0x88A8) and len(data) >= ofs + 6:
+            ofs += 4
+            ethertype = struct.unpack_from('>H', data, ofs)[0]
+        return data[ofs + 2:] if ethertype == 0x0800 else None
+
+    if linktype == LINKTYPE_LINUX_SLL:
+        return data[16:] if struct.unpack_from('>H', data, 14)[0] == 0x0800 else None
+
+    if linktype == LINKTYPE_LINUX_SLL2:
+        return data[20:] if struct.unpack_from('>H', data, 0)[0] == 0x0800 else None
+
+    if linktype == LINKTYPE_NULL:
+        # Address family in host byte order -- accept either
+        family = struct.unpack_from('<L', data)[0]
+        return data[4:] if family == 2 or family == 0x02000000 else None
+
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4):
+        return data if data and (data[0] >> 4) == 4 else None
+
+    return None
+
+
+def ip_to_udp(ip):
+    """ Decode an IPv4 packet. Returns (src, sport, dst, dport, payload) if it's an unfragmented UDP datagram. """
+    if len(ip) < 20 or (ip[0] >> 4) != 4:
+        return None
+
+    ihl = (ip[0] & 0x0F) * 4
+    total_len, = struct.unpack_from('>H', ip, 2)
+    flags_frag, = struct.unpack_from('>H', ip, 6)
+    if ip[9] != 17 or (flags_frag & 0x3FFF) != 0:
+        # Not UDP, or a fragment
+        return None
+
+    sport, dport, ulen = struct.unpack_from('>HHH', ip, ihl)
+    payload = ip[ihl + 8:min(ihl + ulen, total_len)]
+    return socket.inet_ntoa(ip[12:16]), sport, socket.inet_ntoa(ip[16:20]), dport, payload
+
+
+def frame_to_udp(frame):
+    """ Extract the UDP datagram from a CaptureFrame. Returns a UDPDatagram, or None. """
+    try:
+        ip = frame_to_ip(frame.linktype, frame.data)
+        if ip is None:
+            return None
+        udp = ip_to_udp(ip)
+    except struct.error:
+        # Truncated frame
+        return None
+    if udp is None:
+        return None
+    return UDPDatagram(frame.offset, frame.timestamp, *udp)
+
+
+def read_udp(f):
+    """ Generator: yield every IPv4 UDP datagram in a capture file, as UDPDatagram tuples """
+    with CaptureReader(f) as reader:
+        for frame in reader:
+            dgram = frame_to_udp(frame)
+            if dgram is not None:
+                yield dgram
+
+
+################################
+# pcapng writer
+################################
+
+def _option(code, value):
+    if isinstance(value, str):
+        value = value.encode('utf-8')
+    return struct.pack('<HH', code, len(value)) + value + b'\0' * (-len(value) % 4)
+
+
+def _block(btype, body):
+    body += b'\0' * (-len(body) % 4)
+    length = len(body) + 12
+    return struct.pack('<LL', btype, length) + body + struct.pack('<L', length)
+
+
+def udp_ipv4(src, dst, payload):
+    """
+    Wrap a UDP payload in IPv4 and UDP headers (checksums are left at zero)
+
+    :param src: Source (host, port); the host may be '' for INADDR_ANY
+    :param dst: Destination (host, port)
+    """
+    ulen = 8 + len(payload)
+    ip = struct.pack('>BBHHHBBH4s4s', 0x45, 0, 20 + ulen, 0, 0x4000, 64, 17, 0,
+                     socket.inet_aton(src[0] or '0.0.0.0'), socket.inet_aton(dst[0] or '0.0.0.0'))
+    return ip + struct.pack('>HHHH', src[1], dst[1], ulen, 0) + payload
+
+
+class PcapngWriter(object):
+    """ Write a pcapng file (little-endian, nanosecond timestamps) """
+
+    def __init__(self, f, snaplen=65535, application='hylink'):
+        """
+        :param f: File name, or a binary file object
+        :param snaplen: Maximum number of bytes of each packet to write
+        :param application: Written to the section header's shb_userappl option
+        """
+        if isinstance(f, (str, bytes)):
+            self._f = open(f, 'wb')
+            self._ownFile = True
+        else:
+            self._f = f
+            self._ownFile = False
+
+        self.snaplen = snaplen
+        self.interfaces = 0
+        self.bytesWritten = 0
+        self.write(self.section_header(application))
+
+    def close(self):
+        if self._ownFile:
+            self._f.close()
+        else:
+            self._f.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        """ Write pre-built blocks (see section_header(), interface_block(), packet_block()) """
+        self._f.write(data)
+        self.bytesWritten += len(data)
+
+    def flush(self):
+        self._f.flush()
+
+    @staticmethod
+    def section_header(application=None):
+        """ Build a section header block """
+        opts = b''
+        if application:
+            opts = _option(_SHB_USERAPPL, application) + _option(_OPT_END, b'')
+        return _block(_PCAPNG_SHB, struct.pack('<LHHq', _PCAPNG_BOM, 1, 0, -1) + opts)
+
+    def interface_block(self, linktype=LINKTYPE_IPV4, name=None, description=None):
+        """ Build an interface description block, with nanosecond timestamps """
+        opts = _option(_IF_TSRESOL, b'\x09')
+        if name:
+            opts += _option(_IF_NAME, name)
+        if description:
+            opts += _option(_IF_DESCRIPTION, description)
+        opts += _option(_OPT_END, b'')
+        return _block(_PCAPNG_IDB, struct.pack('<HHL', linktype, 0, self.snaplen) + opts)
+
+    def add_interface(self, linktype=LINKTYPE_IPV4, name=None, description=None):
+        """ Write an interface description block. Returns the interface ID. """
+        self.write(self.interface_block(linktype, name, description))
+        self.interfaces += 1
+        return self.interfaces - 1
+
+    def packet_block(self, ifid, timestamp_ns, data, flags=None, comment=None):
+        """ Build an enhanced packet block """
+        caplen = min(len(data), self.snaplen)
+        opts = b''
+        if flags is not None:
+            opts += _option(_EPB_FLAGS, struct.pack('<L', flags))
+        if comment:
+            opts += _option(_OPT_COMMENT, comment)
+        if opts:
+            opts += _option(_OPT_END, b'')
+        body = struct.pack('<LLLLL', ifid, timestamp_ns >> 32, timestamp_ns & 0xFFFFFFFF, caplen, len(data))
+        return _block(_PCAPNG_EPB, body + data[:caplen] + b'\0' * (-caplen % 4) + opts)
+
+    def write_packet(self, ifid, timestamp_ns, data, flags=None, comment=None):
+        """ Write one packet """
+        self.write(self.packet_block(ifid, timestamp_ns, data, flags, comment))
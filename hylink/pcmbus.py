@@ -0,0 +1,432 @@
+"""
+
+ADK Repeater Interface
+
+Shared-memory PCM bus
+
+A PCMBus decodes the G.711 audio received on an RTP socket to 16-bit PCM, and publishes it into a
+shared-memory ring buffer for each repeater. Any number of local processes -- recorders, speech-to-text
+engines, monitors -- can then read the audio at their own pace, without their own hylink socket and
+without the audio being pickled through a pipe:
+
+    # In the process which owns the sockets
+    bus = PCMBus(rtpSocket, rcpSocket)
+
+    # In a consumer process
+    reader = PCMReader(pcm_stream_name(100))
+    while True:
+        pcm = reader.read()
+        meta = reader.metadata()
+        ...
+
+Each ring buffer is one multiprocessing.shared_memory block: a small header holding the write position
+and the current stream's metadata (RTP sequence number and timestamp, SSRC, payload type, and the call
+type, source and destination from the repeater's transmit status broadcasts), followed by the audio --
+8kHz mono signed 16-bit little-endian PCM.
+
+There's one writer and no locks between processes. (Within the writing process, the PCMBus serialises the
+RTP and RCP sockets' callback threads, which both write to the streams, with a lock.) The writer stores the audio, then advances the write position; readers
+copy from their own read position up to the write position, and skip forward if the writer has lapped
+them. The metadata is guarded by a sequence counter, which is odd while the writer is updating it.
+
+G.711 is decoded with two bytes.translate() tables (one for the low byte of each sample and one for the
+high byte), so decoding a frame never loops over its samples in Python.
+
+"""
+
+import logging
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+
+from .packet import RCPRepeaterBroadcastTransmitStatus
+from .rtp import RTPPayloadType
+
+log = logging.getLogger(__name__)
+
+
+# Audio format: 8kHz mono, signed 16-bit little-endian
+PCM_SAMPLE_RATE = 8000
+PCM_SAMPLE_BYTES = 2
+
+# Default ring buffer size (seconds of audio)
+PCM_BUFFER_SECONDS = 10
+
+# Lost RTP frames are filled with silence, up to this many frames; longer gaps are left as they are
+PCM_MAX_GAP_FRAMES = 10
+
+# Default shared memory block name prefix
+PCM_NAME_PREFIX = 'hylink-pcm'
+
+PCM_MAGIC = b'HYLPCM\x00\x01'
+
+# Header: magic, header size, buffer capacity (bytes), sample rate, metadata sequence counter,
+# write position (total bytes ever written), frames written, last write time (time.time()),
+# RTP sequence number, RTP payload type, RTP timestamp, SSRC, repeater ID, call type, source ID, destination ID
+_HEADER = struct.Struct('<8sLLLLQQdHHLLLLLL')
+_HEADER_SIZE = 128
+
+# Offsets of the fields the writer updates
+_OFS_METASEQ = 20
+_OFS_WRITEPOS = 24
+_OFS_META = 32
+_META = struct.Struct('<QdHHLLLLLL')       # frames, write time, seq, payload type, timestamp, ssrc, repeater,
+                                            # call type, source, destination
+_U32 = struct.Struct('<L')
+_U64 = struct.Struct('<Q')
+
+_META_FIELDS = ('frames', 'time', 'seq', 'payloadType', 'timestamp', 'ssrc', 'repeater', 'callType', 'srcID',
+                'destID')
+
+
+def _ulaw_to_linear(u):
+    u = ~u & 0xFF
+    sample = (((u & 0x0F) << 3) + 0x84) << ((u >> 4) & 0x07)
+    sample -= 0x84
+    return -sample if u & 0x80 else sample
+
+
+def _alaw_to_linear(a):
+    a ^= 0x55
+    exponent = (a >> 4) & 0x07
+    mantissa = a & 0x0F
+    if exponent == 0:
+        sample = (mantissa << 4) + 8
+    else:
+        sample = ((mantissa << 4) + 0x108) << (exponent - 1)
+    return sample if a & 0x80 else -sample
+
+
+def _tables(fn):
+    """ Build (low byte, high byte) translate tables for a G.711 decoder """
+    samples = [fn(x) & 0xFFFF for x in range(256)]
+    return bytes(s & 0xFF for s in samples), bytes(s >> 8 for s in samples)
+
+
+_DECODE_TABLES = {
+    RTPPayloadType.HYTERA_PCMU: _tables(_ulaw_to_linear),
+    RTPPayloadType.HYTERA_PCMA: _tables(_alaw_to_linear),
+}
+
+
+def g711_decode(payload, payloadType=RTPPayloadType.HYTERA_PCMU):
+    """
+    Decode G.711 audio to signed 16-bit little-endian PCM
+
+    :param payload: G.711 samples (bytes)
+    :param payloadType: RTPPayloadType.HYTERA_PCMU (mu-law) or HYTERA_PCMA (A-law)
+    """
+    lo, hi = _DECODE_TABLES[payloadType]
+    pcm = bytearray(len(payload) * 2)
+    pcm[0::2] = payload.translate(lo)
+    pcm[1::2] = payload.translate(hi)
+    return pcm
+
+
+def pcm_stream_name(repeater, prefix=PCM_NAME_PREFIX):
+    """ Shared memory block name for a repeater's stream """
+    return '%s-%d' % (prefix, repeater)
+
+
+class PCMStream(object):
+    """ Writer side of one shared-memory PCM ring buffer """
+
+    def __init__(self, name, repeater=0, seconds=PCM_BUFFER_SECONDS):
+        """
+        Create a ring buffer. An existing block with the same name (left behind by a crashed writer) is replaced.
+
+        :param name: Shared memory block name
+        :param repeater: Repeater radio ID, stored in the header
+        :param seconds: Buffer size (seconds of audio)
+        """
+        self.name = name
+        self.capacity = int(seconds * PCM_SAMPLE_RATE) * PCM_SAMPLE_BYTES
+        size = _HEADER_SIZE + self.capacity
+        try:
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+        except FileExistsError:
+            old = shared_memory.SharedMemory(name)
+            old.close()
+            old.unlink()
+            self._shm = shared_memory.SharedMemory(name, create=True, size=size)
+
+        self._buf = self._shm.buf
+        self._data = self._buf[_HEADER_SIZE:_HEADER_SIZE + self.capacity]
+        self.writePos = 0
+        self.frames = 0
+        self._metaSeq = 0
+        self.meta = {'seq': 0, 'payloadType': 0, 'timestamp': 0, 'ssrc': 0, 'repeater': repeater,
+                     'callType': 0, 'srcID': 0, 'destID': 0}
+        _HEADER.pack_into(self._buf, 0, PCM_MAGIC, _HEADER_SIZE, self.capacity, PCM_SAMPLE_RATE, 0, 0, 0, 0.0,
+                          0, 0, 0, 0, repeater, 0, 0, 0)
+
+    def close(self):
+        """ Close and remove the shared memory block. Readers which still have it open can finish reading. """
+        if self._shm is None:
+            return
+        self._data.release()
+        self._buf = None
+        self._shm.close()
+        try:
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+        self._shm = None
+
+    def write(self, pcm, **meta):
+        """
+        Append audio, and update the metadata
+
+        :param pcm: 16-bit PCM samples (bytes-like)
+        :param meta: Metadata fields to update (seq, payloadType, timestamp, ssrc, callType, srcID, destID)
+        """
+        n = len(pcm)
+        if n > self.capacity:
+            pcm = pcm[-self.capacity:]
+            self.writePos += n - self.capacity
+            n = self.capacity
+
+        # Audio first...
+        ofs = self.writePos % self.capacity
+        first = min(n, self.capacity - ofs)
+        self._data[ofs:ofs + first] = pcm[:first]
+        if first < n:
+            self._data[:n - first] = pcm[first:]
+        self.frames += 1
+        self.meta.update(meta)
+        self._publish()
+
+        # ...then the write position, so readers never see audio which hasn't been written yet
+        self.writePos += n
+        _U64.pack_into(self._buf, _OFS_WRITEPOS, self.writePos)
+
+    def update(self, **meta):
+        """ Update the metadata without writing any audio """
+        self.meta.update(meta)
+        self._publish()
+
+    def _publish(self):
+        m = self.meta
+        self._metaSeq += 1
+        _U32.pack_into(self._buf, _OFS_METASEQ, self._metaSeq)
+        _META.pack_into(self._buf, _OFS_META, self.frames, time.time(), m['seq'] & 0xFFFF, m['payloadType'],
+                        m['timestamp'] & 0xFFFFFFFF, m['ssrc'], m['repeater'], m['callType'], m['srcID'],
+                        m['destID'])
+        self._metaSeq += 1
+        _U32.pack_into(self._buf, _OFS_METASEQ, self._metaSeq)
+
+
+class PCMReader(object):
+    """ Reader side of a shared-memory PCM ring buffer. Use from any process. """
+
+    def __init__(self, name, from_start=False):
+        """
+        Attach to a ring buffer
+
+        :param name: Shared memory block name (see pcm_stream_name)
+        :param from_start: True to start with the oldest audio in the buffer, False to start with new audio
+        """
+        self.name = name
+        self._shm = _attach(name)
+        self._buf = self._shm.buf
+
+        magic, hdrSize, self.capacity, self.sampleRate = struct.unpack_from('<8sLLL', self._buf)
+        if magic != PCM_MAGIC:
+            self.close()
+            raise ValueError("%s is not a hylink PCM stream" % name)
+        self._data = self._buf[hdrSize:hdrSize + self.capacity]
+
+        writePos = self._write_pos()
+        self.readPos = max(0, writePos - self.capacity) if from_start else writePos
+        # Bytes skipped because the writer lapped the reader
+        self.overrun = 0
+
+    def close(self):
+        """ Detach from the ring buffer """
+        if self._shm is None:
+            return
+        if getattr(self, '_data', None) is not None:
+            self._data.release()
+            self._data = None
+        self._buf = None
+        self._shm.close()
+        self._shm = None
+
+    def _write_pos(self):
+        return _U64.unpack_from(self._buf, _OFS_WRITEPOS)[0]
+
+    def available(self):
+        """ Returns the number of bytes waiting to be read """
+        return min(self._write_pos() - self.readPos, self.capacity)
+
+    def peek(self, max_bytes=None):
+        """
+        Get the waiting audio without copying it. Returns a list of zero, one or two memoryviews into the
+        ring buffer (two if the audio wraps round the end of the buffer); call advance() when done with them.
+        The writer may overwrite the audio if it isn't consumed promptly -- check lapped() afterwards.
+
+        :param max_bytes: Maximum number of bytes to return
+        """
+        writePos = self._write_pos()
+        if writePos - self.readPos > self.capacity:
+            self.overrun += writePos - self.capacity - self.readPos
+            self.readPos = writePos - self.capacity
+        n = writePos - self.readPos
+        if max_bytes is not None:
+            n = min(n, max_bytes - max_bytes % PCM_SAMPLE_BYTES)
+        if n <= 0:
+            return []
+        ofs = self.readPos % self.capacity
+        first = min(n, self.capacity - ofs)
+        views = [self._data[ofs:ofs + first]]
+        if first < n:
+            views.append(self._data[:n - first])
+        return views
+
+    def advance(self, n):
+        """ Move the read position on by n bytes (after peek()) """
+        self.readPos += n
+
+    def lapped(self):
+        """ Returns True if the writer has overwritten audio at the read position """
+        return self._write_pos() - self.readPos > self.capacity
+
+    def read(self, max_bytes=None):
+        """
+        Read (copy) the waiting audio. Returns bytes, empty if there's nothing new.
+
+        :param max_bytes: Maximum number of bytes to read
+        """
+        views = self.peek(max_bytes)
+        data = b''.join(views)
+        for v in views:
+            v.release()
+        if self.lapped():
+            # Overwritten while being copied -- discard it and catch up
+            writePos = self._write_pos()
+            self.overrun += writePos - self.capacity - self.readPos
+            self.readPos = writePos - self.capacity
+            return b''
+        self.advance(len(data))
+        return data
+
+    def metadata(self):
+        """ Returns the current stream metadata, as a dict """
+        while True:
+            seq = _U32.unpack_from(self._buf, _OFS_METASEQ)[0]
+            if seq & 1:
+                # Update in progress
+                continue
+            values = _META.unpack_from(self._buf, _OFS_META)
+            if _U32.unpack_from(self._buf, _OFS_METASEQ)[0] == seq:
+                meta = dict(zip(_META_FIELDS, values))
+                meta['writePos'] = self._write_pos()
+                return meta
+
+
+def _attach(name):
+    """ Open an existing shared memory block without letting this process's resource tracker remove it """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        pass
+
+    # Before Python 3.13, opening a block registers it with the resource tracker, which unlinks it when the
+    # process exits -- pulling it out from under the writer. Unregistering afterwards isn't safe either, as
+    # forked processes share their parent's tracker, so skip the registration altogether.
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args, **kwargs: None
+    try:
+        return shared_memory.SharedMemory(name)
+    finally:
+        resource_tracker.register = register
+
+
+class PCMBus(object):
+    """ Publishes the audio received on an RTP socket to shared-memory ring buffers, one per repeater """
+
+    def __init__(self, rtp, rcp=None, prefix=PCM_NAME_PREFIX, seconds=PCM_BUFFER_SECONDS):
+        """
+        Create a PCM bus
+
+        :param rtp: ADKSocket bound to the repeaters' RTP port
+        :param rcp: ADKSocket bound to the repeaters' RCP port, for call metadata (or None)
+        :param prefix: Shared memory block name prefix
+        :param seconds: Size of each ring buffer (seconds of audio)
+        """
+        self._rtp = rtp
+        self._rcp = rcp
+        self.prefix = prefix
+        self.seconds = seconds
+
+        # Streams by repeater radio ID. The RTP and RCP sockets call back on different threads, but each stream
+        # must only have one writer -- _lock guards creating and writing to the streams.
+        self._lock = threading.Lock()
+        self._streams = {}
+
+        # Counters
+        self.frames = 0
+        self.unsupported = 0
+        self.concealed = 0
+
+        rtp.add_rtp_listener(self._rtp_frame)
+        if rcp is not None:
+            rcp.add_msg_listener(self._msg)
+
+    def close(self):
+        """ Detach from the sockets and remove the ring buffers """
+        self._rtp.remove_rtp_listener(self._rtp_frame)
+        if self._rcp is not None:
+            self._rcp.remove_msg_listener(self._msg)
+        with self._lock:
+            for stream in self._streams.values():
+                stream.close()
+            self._streams = {}
+
+    def streams(self):
+        """ Returns a dict of repeater radio ID -> shared memory block name """
+        with self._lock:
+            return {rpt: s.name for rpt, s in self._streams.items()}
+
+    def _stream(self, repeater):
+        """ Get a repeater's stream, creating it if need be. Caller must hold _lock. """
+        stream = self._streams.get(repeater)
+        if stream is None:
+            stream = PCMStream(pcm_stream_name(repeater, self.prefix), repeater, self.seconds)
+            self._streams[repeater] = stream
+            log.info("Publishing repeater %d audio to shared memory '%s'", repeater, stream.name)
+        return stream
+
+    def _rtp_frame(self, p):
+        tables = _DECODE_TABLES.get(p.payloadType)
+        if tables is None:
+            self.unsupported += 1
+            return
+
+        conn = getattr(p, 'repeater', None)
+        repeater = conn.radioID if conn is not None and conn.radioID is not None else 0
+        pcm = g711_decode(p.payload, p.payloadType)
+
+        with self._lock:
+            stream = self._stream(repeater)
+            meta = stream.meta
+            if stream.frames and meta['ssrc'] == p.ssrc:
+                # Fill short gaps left by lost frames with silence, so the audio keeps its timing
+                lost = (p.seq - meta['seq'] - 1) & 0xFFFF
+                if 0 < lost <= PCM_MAX_GAP_FRAMES:
+                    self.concealed += lost
+                    pcm = bytes(len(pcm) * lost) + pcm
+
+            stream.write(pcm, seq=p.seq, payloadType=p.payloadType, timestamp=p.timestamp, ssrc=p.ssrc)
+            self.frames += 1
+
+    def _msg(self, p):
+        txc = p.txCtrl
+        if not isinstance(txc, RCPRepeaterBroadcastTransmitStatus):
+            return
+        conn = getattr(p, 'repeater', None)
+        repeater = conn.radioID if conn is not None and conn.radioID is not None else 0
+        with self._lock:
+            self._stream(repeater).update(callType=int(txc.callType), srcID=txc.senderID, destID=txc.targetID)
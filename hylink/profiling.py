@@ -0,0 +1,153 @@
+"""
+
+ADK Repeater Interface
+
+Hot-path profiling
+
+A StageProfiler timestamps each stage of the receive and transmit pipelines with time.perf_counter_ns(),
+for a sampled subset of packets. Per-stage latencies are aggregated into histograms, and traces of packets
+which took longer than a threshold end to end are kept for dumping.
+
+Packets which aren't sampled cost one counter increment, so the profiler can be left enabled in production.
+
+    prof = StageProfiler(sample_rate=0.01)
+    sock = ADKSocket(ADKDefaultPorts.RCP1, profiler=prof)
+    ...
+    print(prof.dump_slow())
+
+"""
+
+import collections
+import threading
+import time
+from enum import IntEnum
+
+from . import packet
+from .metrics import Histogram
+
+
+# Default stage latency histogram buckets (seconds)
+STAGE_BUCKETS = (1e-6, 2.5e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 0.1)
+
+
+class Stage(IntEnum):
+    """ Pipeline stages """
+    # Receive wakeups
+    SELECT          = 0     # Waiting in select()
+    RECV            = 1     # Draining the socket (recvmsg_into/recvfrom_into for the whole batch)
+    # Received packets
+    DECODE          = 2     # HYTPacket.decode / RTPPacket, including TxCtrlBase.factory
+    FACTORY         = 3     # TxCtrlBase.factory alone
+    HANDLE          = 4     # Protocol handling (session lookup, SYN/ACK processing)
+    ACK             = 5     # Sending the ACK for a HSTRPFromRadio
+    DISPATCH_WAIT   = 6     # Waiting in the callback dispatcher's queue
+    CALLBACK        = 7     # User callbacks and listeners
+    # Transmitted packets
+    TX_WAIT         = 8     # Waiting in the transmit queue
+    SEND            = 9     # Serialising and sendto()
+
+
+class Trace(object):
+    """ Stage timings for one sampled packet or receive wakeup """
+
+    __slots__ = ('kind', 'start', 'last', 'stages', 'info')
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.start = self.last = time.perf_counter_ns()
+        self.stages = []
+        self.info = None
+
+    def mark(self, stage):
+        """ Record the end of a stage (the stage started at the previous mark) """
+        now = time.perf_counter_ns()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def add(self, stage, elapsed_ns):
+        """ Record a stage which was timed separately """
+        self.stages.append((stage, elapsed_ns))
+
+    def total_ns(self):
+        return self.last - self.start
+
+    def __repr__(self):
+        return "<%s %s: %.1f us total: %s%s>" % \
+               (type(self).__name__, self.kind, self.total_ns() / 1000.,
+                ', '.join('%s %.1f us' % (st.name, ns / 1000.) for st, ns in self.stages),
+                '' if self.info is None else ' -- %s' % (self.info,))
+
+
+# The trace (if any) of the packet each thread is currently decoding -- used by the TxCtrlBase.factory hook
+_current = threading.local()
+
+
+def _factory_hook(elapsed_ns):
+    trace = getattr(_current, 'trace', None)
+    if trace is not None:
+        trace.add(Stage.FACTORY, elapsed_ns)
+
+
+class StageProfiler(object):
+    """ Sampled per-stage latency profiler """
+
+    def __init__(self, sample_rate=0.01, slow_threshold=0.005, keep_slow=100, buckets=STAGE_BUCKETS):
+        """
+        Create a profiler
+
+        :param sample_rate: Fraction of packets to trace (e.g. 0.01 traces one packet in every hundred)
+        :param slow_threshold: Packets which take longer than this (seconds) end to end are kept as slow traces
+        :param keep_slow: Number of slow traces to keep (oldest are discarded)
+        :param buckets: Stage latency histogram buckets (seconds)
+        """
+        if not 0 < sample_rate <= 1:
+            raise ValueError("sample_rate must be > 0 and <= 1")
+
+        self._interval = max(1, int(round(1. / sample_rate)))
+        self._counter = 0
+        self.slowThreshold = int(slow_threshold * 1e9)
+        self.slow = collections.deque(maxlen=keep_slow)
+        self._lock = threading.Lock()
+        self._buckets = buckets
+        self.histograms = {}
+
+        # Time TxCtrlBase.factory() separately from the rest of the decode
+        packet.FACTORY_PROFILE_HOOK = _factory_hook
+
+    def sample(self, kind):
+        """ Returns a new Trace if this packet should be traced, otherwise None """
+        self._counter += 1
+        if self._counter < self._interval:
+            return None
+        self._counter = 0
+        return Trace(kind)
+
+    def begin_decode(self, trace):
+        """ Attribute TxCtrlBase.factory calls on this thread to a trace, until end_decode() """
+        _current.trace = trace
+
+    def end_decode(self):
+        _current.trace = None
+
+    def finish(self, trace):
+        """ Add a completed trace to the stage histograms """
+        with self._lock:
+            for stage, ns in trace.stages:
+                h = self.histograms.get(stage)
+                if h is None:
+                    h = self.histograms[stage] = Histogram(self._buckets)
+                h.observe(ns / 1e9)
+
+            if trace.total_ns() >= self.slowThreshold:
+                self.slow.append((time.time(), trace))
+
+    def snapshot(self):
+        """ Return a dict of stage name -> histogram snapshot (values in seconds) """
+        with self._lock:
+            return {stage.name: h.snapshot() for stage, h in sorted(self.histograms.items())}
+
+    def dump_slow(self):
+        """ Format the slow-packet traces as a string """
+        with self._lock:
+            slow = list(self.slow)
+        return '\n'.join('%s %r' % (time.strftime('%H:%M:%S', time.localtime(ts)), trace) for ts, trace in slow)
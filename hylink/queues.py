@@ -0,0 +1,153 @@
+"""
+
+ADK Repeater Interface
+
+Bounded multi-lane priority queue
+
+A LaneQueue is a set of bounded FIFO lanes. get() always takes from the highest-priority (lowest-numbered)
+lane which has an item waiting. Each lane has its own depth limit and overflow policy, and items may carry
+a deadline after which they are discarded instead of being returned.
+
+"""
+
+import collections
+import queue
+import threading
+from enum import IntEnum
+
+from .clock import SYSTEM_CLOCK
+from .exceptions import ADKQueueFull
+
+
+class OverflowPolicy(IntEnum):
+    """ What to do when an item is added to a full lane """
+    DROP_NEWEST = 0         # Discard the item being added
+    DROP_OLDEST = 1         # Discard the oldest item in the lane to make room
+    BLOCK       = 2         # Wait for space (applies backpressure to the caller)
+    RAISE       = 3         # Raise ADKQueueFull
+
+
+class LaneQueue(object):
+    """ Priority queue made of bounded FIFO lanes. Lane 0 has the highest priority. """
+
+    def __init__(self, depths, policies, clock=None):
+        """
+        Create a lane queue
+
+        :param depths: Sequence of maximum depths, one per lane
+        :param policies: Sequence of OverflowPolicy values, one per lane
+        :param clock: hylink.clock.Clock for deadlines and timeouts (defaults to the system clock)
+        """
+        if len(depths) != len(policies):
+            raise ValueError("Need one overflow policy per lane")
+
+        self._lanes = [collections.deque() for _ in depths]
+        self._depths = list(depths)
+        self._policies = [OverflowPolicy(x) for x in policies]
+        self._clock = clock if clock is not None else SYSTEM_CLOCK
+
+        self._lock = threading.Lock()
+        self._notEmpty = threading.Condition(self._lock)
+        self._notFull = threading.Condition(self._lock)
+        self._count = 0
+        self._closed = False
+
+        # Per-lane counters: items dropped on overflow, items discarded after their deadline passed
+        self.dropped = [0] * len(depths)
+        self.expired = [0] * len(depths)
+
+    def __len__(self):
+        return self._count
+
+    def depth(self, lane=None):
+        """ Return the number of items waiting in a lane, or in all lanes if lane is None """
+        if lane is None:
+            return self._count
+        return len(self._lanes[lane])
+
+    def put(self, item, lane, deadline=None, timeout=None):
+        """
+        Add an item to a lane
+
+        :param item: Item to add
+        :param lane: Lane number (0 = highest priority)
+        :param deadline: Clock monotonic() value after which the item is discarded instead of returned
+        :param timeout: Maximum time to wait for space if the lane's policy is BLOCK (None = wait forever)
+        :return: True if the item was queued, False if it was dropped
+        """
+        q = self._lanes[lane]
+        with self._lock:
+            if len(q) >= self._depths[lane]:
+                policy = self._policies[lane]
+
+                if policy == OverflowPolicy.DROP_NEWEST:
+                    self.dropped[lane] += 1
+                    return False
+
+                elif policy == OverflowPolicy.DROP_OLDEST:
+                    q.popleft()
+                    self._count -= 1
+                    self.dropped[lane] += 1
+
+                elif policy == OverflowPolicy.BLOCK:
+                    if not self._clock.wait_for(self._notFull, lambda: len(q) < self._depths[lane] or self._closed,
+                                                timeout):
+                        raise ADKQueueFull("Queue lane %d is full" % lane)
+
+                else:
+                    raise ADKQueueFull("Queue lane %d is full" % lane)
+
+            if self._closed:
+                return False
+
+            q.append((deadline, item))
+            self._count += 1
+            self._notEmpty.notify()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest item from the highest-priority lane which isn't empty.
+
+        Items whose deadline has passed are discarded and counted in 'expired'.
+
+        Raises queue.Empty if no item arrives within 'timeout' seconds (None = wait forever).
+        Returns None once the queue has been closed.
+        """
+        clock = self._clock
+        endtime = None if timeout is None else clock.monotonic() + timeout
+
+        with self._lock:
+            while True:
+                if self._closed:
+                    return None
+
+                if self._count == 0:
+                    remaining = None if endtime is None else endtime - clock.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty()
+                    clock.wait(self._notEmpty, remaining)
+                    continue
+
+                now = None
+                for lane, q in enumerate(self._lanes):
+                    while q:
+                        deadline, item = q.popleft()
+                        self._count -= 1
+                        self._notFull.notify_all()
+
+                        if deadline is not None:
+                            if now is None:
+                                now = clock.monotonic()
+                            if now > deadline:
+                                self.expired[lane] += 1
+                                continue
+
+                        return item
+
+    def close(self):
+        """ Close the queue. Waiting and future get() calls return None. """
+        with self._lock:
+            self._closed = True
+            self._notEmpty.notify_all()
+            self._notFull.notify_all()
@@ -0,0 +1,336 @@
+"""
+
+ADK Repeater Interface
+
+RCP request/response correlation
+
+An RCPCorrelator sends RCP requests through an ADKSocket and matches them with their responses. Each
+request returns a concurrent.futures.Future, which completes with an RCPReply (the decoded response
+and its result code) when the response arrives, or fails with RCPTimeout if it doesn't:
+
+    rcp = RCPCorrelator(rcpSocket)
+    reply = rcp.call(CallType.GROUP, 10000).result()
+    if reply.result == ResultCode.OK:
+        rcp.ptt(True)
+
+    # Pipelined: send several requests, then collect the replies
+    futures = [rcp.call(CallType.PRIVATE, radio, repeater=100) for radio in radios]
+    replies = [f.result() for f in futures]
+
+A response's opcode is its request's opcode with the top bit set (RCPCallRequest 0x0841 is answered by
+RCPCallResponse 0x8841). Responses don't carry a sequence number, but a repeater answers its requests
+in order, so requests are queued per repeater and response opcode, and each response completes the
+oldest request waiting for it. Any number of requests can be outstanding at once.
+
+When a request times out, its response may still turn up later. As it would otherwise complete the next
+request waiting on the same repeater and opcode (with the wrong reply), the timed-out request leaves a
+tombstone behind, which absorbs the next response for up to RCP_LATE_WINDOW seconds (counted in 'late').
+If the response was really lost, the next request's reply is absorbed instead, and that request times out,
+rather than completing with another request's reply. As its own reply was the one absorbed, it doesn't
+leave a tombstone, so one lost response costs at most one more request.
+
+"""
+
+import asyncio
+import collections
+import heapq
+import logging
+import threading
+from concurrent.futures import Future
+
+from .clock import SYSTEM_CLOCK
+from .exceptions import ADKException
+from .packet import HSTRPToRadio, RCPButtonRequest, RCPCallRequest, RCPChannelStatusOrParameterCheckRequest
+from .types import ButtonOperation, ButtonTarget, MessageHeader, ResultCode, StatusValueType
+
+log = logging.getLogger(__name__)
+
+
+# Default time to wait for a response (seconds)
+RCP_RESPONSE_TIMEOUT = 5.0
+
+# How long after a request times out a response is treated as its late answer (seconds)
+RCP_LATE_WINDOW = 5.0
+
+# Bit set in a response opcode
+RCP_RESPONSE_BIT = 0x8000
+
+
+class RCPError(ADKException):
+    """ An RCP request failed """
+    pass
+
+
+class RCPTimeout(RCPError):
+    """ An RCP request wasn't answered in time """
+    pass
+
+
+# Reply to an RCP request: the decoded response (a TxCtrlBase subclass), and its result code --
+# a ResultCode or SuccessFailResult where the response has one, otherwise None
+RCPReply = collections.namedtuple('RCPReply', 'response result')
+
+
+def result_code(response):
+    """ Get the result code from an RCP response, converting plain ints to ResultCode where possible """
+    result = getattr(response, 'result', None)
+    if type(result) is not int:
+        # Already an enum (or None)
+        return result
+    try:
+        return ResultCode(result)
+    except ValueError:
+        return result
+
+
+class _Pending(object):
+    """ A request waiting for its response """
+
+    __slots__ = ('key', 'future', 'deadline', 'request', 'absorbed')
+
+    def __init__(self, key, future, deadline, request):
+        self.key = key
+        self.future = future
+        self.deadline = deadline
+        self.request = request
+        # True if a tombstone absorbed a response while this was the oldest request waiting (so it may have
+        # been this request's answer)
+        self.absorbed = False
+
+
+class RCPCorrelator(object):
+    """ Sends RCP requests and matches them with their responses """
+
+    def __init__(self, sock, timeout=RCP_RESPONSE_TIMEOUT, clock=None):
+        """
+        Create a correlator and start its timeout thread
+
+        :param sock: ADKSocket bound to the repeaters' RCP port
+        :param timeout: Default time to wait for a response (seconds)
+        :param clock: hylink.clock.Clock for the timeouts (defaults to the socket's clock)
+        """
+        self._sock = sock
+        self.timeout = timeout
+        self.clock = clock if clock is not None else getattr(sock, 'clock', SYSTEM_CLOCK)
+
+        self._cond = threading.Condition()
+        # Requests waiting for a response, oldest first: (repeater connection, response opcode) -> deque
+        self._pending = {}
+        # Timeout heap: (deadline, count, pending)
+        self._timers = []
+        self._timerCount = 0
+        # Tombstones of timed-out requests: key -> deque of expiry times, oldest first
+        self._late = {}
+
+        # Counters
+        self.requests = 0
+        self.responses = 0
+        self.timeouts = 0
+        self.unmatched = 0
+        self.late = 0
+
+        sock.add_msg_listener(self._msg)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="RCPCorrelator", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """ Detach from the socket, and fail any requests which are still waiting """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._sock.remove_msg_listener(self._msg)
+
+        with self._cond:
+            waiting = [p for q in self._pending.values() for p in q]
+            self._pending = {}
+            self._timers = []
+            self._late = {}
+        for p in waiting:
+            _fail(p.future, RCPError("Correlator closed"))
+
+    def outstanding(self):
+        """ Returns the number of requests waiting for a response """
+        with self._cond:
+            return sum(len(q) for q in self._pending.values())
+
+    ################################
+    # Requests
+    ################################
+
+    def request(self, txc, repeater=None, timeout=None, callback=None):
+        """
+        Send an RCP request. Returns a Future, which completes with an RCPReply.
+
+        :param txc: Request (a TxCtrlBase subclass, e.g. RCPCallRequest)
+        :param repeater: Repeater to send to (see ADKSocket.get_session)
+        :param timeout: Time to wait for the response (seconds); defaults to the correlator's timeout
+        :param callback: If given, called as callback(future) when the request completes or fails
+        """
+        if txc.txcMsgHdr != MessageHeader.RCP:
+            raise ValueError("Not an RCP request: %r" % txc)
+
+        fut = Future()
+        if callback is not None:
+            fut.add_done_callback(callback)
+
+        conn = self._sock.get_session(repeater)
+        if conn is None:
+            _fail(fut, RCPError("Not connected to repeater %s" % repeater))
+            return fut
+
+        if timeout is None:
+            timeout = self.timeout
+        key = (conn, txc.txcOpcode | RCP_RESPONSE_BIT)
+        pending = _Pending(key, fut, self.clock.monotonic() + timeout, txc)
+
+        # Register the request before sending it, so the response can't arrive first
+        with self._cond:
+            self._pending.setdefault(key, collections.deque()).append(pending)
+            self._timerCount += 1
+            heapq.heappush(self._timers, (pending.deadline, self._timerCount, pending))
+            self._cond.notify_all()
+        self.requests += 1
+
+        p = HSTRPToRadio()
+        p.txCtrl = txc
+        if self._sock.send(p, callback=_ignore_ack, repeater=conn) is None:
+            # Dropped (the repeater disconnected in the meantime)
+            if self._discard(pending):
+                _fail(fut, RCPError("Not connected to repeater %s" % repeater))
+        return fut
+
+    def request_async(self, txc, repeater=None, timeout=None):
+        """ Send an RCP request. Returns an asyncio awaitable, which completes with an RCPReply. """
+        return asyncio.wrap_future(self.request(txc, repeater, timeout))
+
+    def call(self, callType, destId, repeater=None, timeout=None):
+        """ Send an RCPCallRequest. Returns a Future for the RCPCallResponse. """
+        txc = RCPCallRequest()
+        txc.callType = callType
+        txc.destId = destId
+        return self.request(txc, repeater, timeout)
+
+    def ptt(self, pressed, target=ButtonTarget.FRONT_PTT, repeater=None, timeout=None):
+        """ Press or release a repeater button. Returns a Future for the RCPButtonResponse. """
+        txc = RCPButtonRequest()
+        txc.pttTarget = target
+        txc.pttOperation = ButtonOperation.PRESS if pressed else ButtonOperation.RELEASE
+        return self.request(txc, repeater, timeout)
+
+    def channel_status(self, target, value_type=StatusValueType.LEVEL, repeater=None, timeout=None):
+        """ Request a channel status or parameter. Returns a Future for the RCPChannelStatusOrParameterCheckResponse. """
+        txc = RCPChannelStatusOrParameterCheckRequest()
+        txc.target = target
+        txc.valueType = value_type
+        return self.request(txc, repeater, timeout)
+
+    ################################
+    # Responses and timeouts
+    ################################
+
+    def _discard(self, pending):
+        """ Remove a request from its queue. Returns False if it had already been removed. """
+        with self._cond:
+            q = self._pending.get(pending.key)
+            if q is None:
+                return False
+            try:
+                q.remove(pending)
+            except ValueError:
+                return False
+            if not q:
+                del self._pending[pending.key]
+            return True
+
+    def _msg(self, p):
+        txc = p.txCtrl
+        if txc is None or txc.txcMsgHdr != MessageHeader.RCP or not (txc.txcOpcode & RCP_RESPONSE_BIT):
+            return
+
+        key = (getattr(p, 'repeater', None), txc.txcOpcode)
+        with self._cond:
+            if self._absorb_late(key):
+                q = self._pending.get(key)
+                if q:
+                    q[0].absorbed = True
+                self.late += 1
+                log.debug("Late response %r ignored", txc)
+                return
+            q = self._pending.get(key)
+            if not q:
+                # A broadcast, or a response to a request which has timed out or was sent by someone else
+                if key[1] in _RESPONSE_OPCODES:
+                    self.unmatched += 1
+                return
+            pending = q.popleft()
+            if not q:
+                del self._pending[key]
+
+        self.responses += 1
+        if not pending.future.done():
+            pending.future.set_result(RCPReply(txc, result_code(txc)))
+
+    def _bury(self, pending):
+        """ Leave a tombstone for a timed-out request, to absorb its late response. Caller must hold _cond. """
+        now = self.clock.monotonic()
+        for key in [k for k, q in self._late.items() if q[-1] <= now]:
+            del self._late[key]
+        self._late.setdefault(pending.key, collections.deque()).append(now + RCP_LATE_WINDOW)
+
+    def _absorb_late(self, key):
+        """ Use up a tombstone for a response. Returns True if there was one. Caller must hold _cond. """
+        stones = self._late.get(key)
+        if not stones:
+            return False
+        now = self.clock.monotonic()
+        while stones and stones[0] <= now:
+            stones.popleft()
+        found = bool(stones)
+        if found:
+            stones.popleft()
+        if not stones:
+            del self._late[key]
+        return found
+
+    def _thread_proc(self):
+        while True:
+            expired = []
+            with self._cond:
+                if not self._running:
+                    return
+                now = self.clock.monotonic()
+                while self._timers and self._timers[0][0] <= now:
+                    expired.append(heapq.heappop(self._timers)[2])
+                if not expired:
+                    self.clock.wait(self._cond, self._timers[0][0] - now if self._timers else None)
+                    continue
+
+            for pending in expired:
+                # Requests which have been answered are no longer queued
+                if self._discard(pending):
+                    if not pending.absorbed:
+                        with self._cond:
+                            self._bury(pending)
+                    self.timeouts += 1
+                    log.debug("RCP request %r timed out", pending.request)
+                    _fail(pending.future, RCPTimeout("No response to %r" % pending.request))
+
+
+# Opcodes of the responses to the requests hylink can send; other RCP opcodes with the top bit set are broadcasts
+_RESPONSE_OPCODES = frozenset(c.OPCODE | RCP_RESPONSE_BIT
+                              for c in (RCPButtonRequest, RCPCallRequest, RCPChannelStatusOrParameterCheckRequest))
+
+
+def _fail(fut, exc):
+    if not fut.done():
+        fut.set_exception(exc)
+
+
+def _ignore_ack(_seq):
+    """ ACK callback for requests (keeps send() from blocking) """
+    pass
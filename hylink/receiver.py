@@ -0,0 +1,102 @@
+"""
+
+ADK Repeater Interface
+
+Batched datagram receiver
+
+Drains every datagram waiting on a non-blocking UDP socket in one pass, receiving into a pool of
+preallocated buffers instead of allocating a fresh one per recvfrom() call.
+
+"""
+
+import errno
+import logging
+import socket
+
+log = logging.getLogger(__name__)
+
+
+# Default largest datagram we expect to receive (bytes).
+# Hytera frames are much smaller than this, but anything up to a full UDP datagram can be received without truncation.
+RX_MAX_DATAGRAM = 2048
+
+# Default maximum number of datagrams to pull from the socket on each wakeup
+RX_BATCH_SIZE = 64
+
+
+class BatchReceiver(object):
+    """ Receive datagrams from a socket in batches, using a pool of reusable buffers """
+
+    def __init__(self, sock, max_datagram=RX_MAX_DATAGRAM, batch_size=RX_BATCH_SIZE, rcvbuf=None):
+        """
+        Create a batched receiver.
+
+        :param sock: UDP socket to receive from. This will be switched to non-blocking mode.
+        :param max_datagram: Size of each receive buffer (largest datagram which can be received intact)
+        :param batch_size: Maximum number of datagrams to return from a single drain() call
+        :param rcvbuf: If not None, set the kernel receive buffer size (SO_RCVBUF) to this many bytes
+        """
+        if max_datagram <= 0:
+            raise ValueError("max_datagram must be > 0")
+        if batch_size <= 0:
+            raise ValueError("batch_size must be > 0")
+
+        self._sock = sock
+        self._sock.setblocking(False)
+
+        if rcvbuf is not None:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            log.debug("SO_RCVBUF requested %d, kernel granted %d",
+                      rcvbuf, self._sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
+
+        self.maxDatagram = max_datagram
+        self.batchSize = batch_size
+
+        # Allocate the buffer pool once. Each buffer is reused on every drain() call.
+        self._buffers = [bytearray(max_datagram) for _ in range(batch_size)]
+        self._views = [memoryview(b) for b in self._buffers]
+
+        # recvmsg_into can tell us when a datagram was truncated; it isn't available on all platforms
+        self._useRecvmsg = hasattr(sock, 'recvmsg_into') and hasattr(socket, 'MSG_TRUNC')
+
+        # Number of datagrams which were too big for the receive buffers
+        self.truncated = 0
+
+    def _recv_one(self, view):
+        """ Receive one datagram into a buffer. Returns (nbytes, address, truncated). """
+        if self._useRecvmsg:
+            nbytes, _anc, flags, addr = self._sock.recvmsg_into([view])
+            return nbytes, addr, (flags & socket.MSG_TRUNC) != 0
+        else:
+            nbytes, addr = self._sock.recvfrom_into(view)
+            return nbytes, addr, False
+
+    def drain(self):
+        """
+        Receive every datagram waiting on the socket, up to batchSize.
+
+        Returns a list of (data, address) tuples. 'data' is a bytes object holding an exact-sized copy of the
+        datagram, so it remains valid after the receive buffers are reused.
+        """
+        batch = []
+
+        for view in self._views:
+            try:
+                nbytes, addr, truncated = self._recv_one(view)
+            except (BlockingIOError, InterruptedError):
+                # Nothing more waiting
+                break
+            except OSError as e:
+                # ICMP errors from a previous sendto() show up here on some platforms -- skip them
+                if e.errno in (errno.ECONNREFUSED, errno.ECONNRESET):
+                    continue
+                raise
+
+            if truncated:
+                self.truncated += 1
+                log.warning("Discarded truncated datagram from %s (larger than %d bytes)", addr, self.maxDatagram)
+                continue
+
+            batch.append((bytes(view[:nbytes]), addr))
+
+        return batch
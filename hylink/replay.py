@@ -0,0 +1,340 @@
+"""
+
+ADK Repeater Interface
+
+Capture replay
+
+Plays a pcap or pcapng capture of Hytera traffic through the same callback API as ADKSocket, so an
+application can be regression-tested or profiled against recorded traffic:
+
+    replay = CaptureReplay('site.pcapng', ports=[ADKDefaultPorts.RCP1, ADKDefaultPorts.RTP1], speed=1.0)
+    replay.set_msg_callback(on_message)
+    replay.set_rtp_callback(on_audio)
+    replay.run()
+
+The capture is streamed, so captures larger than memory can be replayed. Packets are delivered as fast
+as possible (speed=None), or paced to the capture timestamps (speed=1.0 is real time, 2.0 twice as fast).
+
+Repeaters are identified from the traffic itself: the sender of a SYN or HSTRPFromRadio, or the recipient
+of a SYN-ACK or HSTRPToRadio, is a repeater. Each gets a RepeaterConnection, which is attached to the
+packets it sends (packet.repeater) and reported to the connection listeners. As on a live socket, a
+repeater is disconnected when nothing has been heard from it for HEARTBEAT_TIMEOUT seconds of capture time.
+
+Only the traffic the repeaters sent is delivered to the msg/RTP callbacks, as ADKSocket would see it.
+Every decoded packet, in both directions, can be seen with set_packet_callback().
+
+"""
+
+import collections
+import logging
+import threading
+
+from .clock import SYSTEM_CLOCK
+from .dispatch import CallbackDispatcher, PacketClass
+from .packet import *
+from .pcap import CaptureReader, frame_to_udp
+from .ports import ADKDefaultPorts
+from .rtp import RTPPacket
+from .socket import RepeaterConnection
+from .trace import LazyHex
+
+log = logging.getLogger(__name__)
+
+
+# How often (in capture time, seconds) to check for repeaters which have gone quiet
+WATCHDOG_INTERVAL = 1.0
+
+
+def port_name(port):
+    """ Return the ADKDefaultPorts name of a UDP port, or the port number if it isn't a Hytera port """
+    try:
+        return ADKDefaultPorts(port).name
+    except ValueError:
+        return str(port)
+
+
+class CaptureReplay(object):
+    """ Replays a packet capture through the ADKSocket callback API """
+
+    def __init__(self, filename, ports=None, repeaters=None, classes=None, speed=None, dispatcher=None,
+                 clock=None):
+        """
+        Create a capture replay
+
+        :param filename: pcap or pcapng file name, or a binary file object
+        :param ports: UDP ports to replay (traffic to or from any of them). Defaults to every ADKDefaultPorts port.
+        :param repeaters: IP addresses of the repeaters to replay (traffic to or from any of them), or None for all
+        :param classes: Packet classes to deliver, e.g. (RTPPacket, RCPRepeaterBroadcastTransmitStatus). HYT packets
+            match on either the packet class or their txCtrl class. None delivers everything.
+        :param speed: Replay speed relative to the capture timestamps (1.0 = real time), or None for as fast as possible
+        :param dispatcher: CallbackDispatcher which runs the callbacks. If None, callbacks are called inline by the
+            replay thread, so no packets are dropped however slow they are.
+        :param clock: hylink.clock.Clock which paces the replay when a speed is given (defaults to the system clock)
+        """
+        if speed is not None and speed <= 0:
+            raise ValueError("speed must be > 0")
+
+        self.filename = filename
+        self.ports = frozenset(int(x) for x in (ports if ports is not None else ADKDefaultPorts))
+        self.repeaters = frozenset(repeaters) if repeaters is not None else None
+        self.classes = tuple(classes) if classes is not None else None
+        self.speed = speed
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        if dispatcher is None:
+            self._dispatcher = CallbackDispatcher(workers=0)
+            self._ownDispatcher = True
+        else:
+            self._dispatcher = dispatcher
+            self._ownDispatcher = False
+
+        # Repeaters seen in the capture: socket address -> RepeaterConnection, and the set of their IP addresses
+        self._sessions = {}
+        self._repeaterHosts = set()
+        self._nextWatchdog = None
+
+        # Callbacks and listeners, as ADKSocket
+        self._rcpRxCallback = None
+        self._rtpRxCallback = None
+        self._packetCallback = None
+        self._msgListeners = []
+        self._rtpListeners = []
+        self._connListeners = []
+
+        # Counters: 'datagrams', 'filtered', 'undecodable', and delivered packets per class name
+        self.stats = collections.Counter()
+
+        self._running = False
+        self._thread = None
+
+    ################################
+    # Running the replay
+    ################################
+
+    def run(self):
+        """ Replay the whole capture on the calling thread. Returns the stats Counter. """
+        self._running = True
+        wallStart = captureStart = None
+
+        with CaptureReader(self.filename) as reader:
+            for frame in reader:
+                if not self._running:
+                    break
+
+                dgram = frame_to_udp(frame)
+                if dgram is None:
+                    continue
+                self.stats['datagrams'] += 1
+
+                if not self._match(dgram):
+                    self.stats['filtered'] += 1
+                    continue
+
+                # Pace the replay to the capture timestamps
+                if self.speed is not None:
+                    if wallStart is None:
+                        wallStart, captureStart = self.clock.monotonic(), dgram.timestamp
+                    self.clock.sleep(wallStart + (dgram.timestamp - captureStart) / self.speed -
+                                     self.clock.monotonic())
+
+                self._replay_datagram(dgram)
+
+        # Disconnect any repeaters which were still connected at the end of the capture
+        for conn in list(self._sessions.values()):
+            self._disconnect(conn)
+
+        self._running = False
+        if self._ownDispatcher:
+            self._dispatcher.stop()
+        return self.stats
+
+    def start(self):
+        """ Start replaying the capture on a background thread """
+        self._thread = threading.Thread(target=self.run, name="CaptureReplay", daemon=True)
+        self._thread.start()
+
+    def join(self, timeout=None):
+        """ Wait for a replay started with start() to finish """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def stop(self):
+        """ Stop the replay after the current packet """
+        self._running = False
+        self.join()
+
+    def _match(self, dgram):
+        """ Apply the port and repeater filters to a datagram """
+        if dgram.sport not in self.ports and dgram.dport not in self.ports:
+            return False
+        if self.repeaters is not None and dgram.src not in self.repeaters and dgram.dst not in self.repeaters:
+            return False
+        return True
+
+    def _match_class(self, p):
+        """ Apply the packet class filter to a decoded packet """
+        if self.classes is None:
+            return True
+        return isinstance(p, self.classes) or isinstance(getattr(p, 'txCtrl', None), self.classes)
+
+    ################################
+    # Packet handling
+    ################################
+
+    def _decode(self, data):
+        """ Decode a datagram as a HYTPacket or RTPPacket. Returns None if it can't be decoded. """
+        # noinspection PyBroadException
+        try:
+            return HYTPacket.decode(data)
+        except HYTBadSignature:
+            try:
+                return RTPPacket(data)
+            except Exception:
+                pass
+        except Exception:
+            pass
+        self.stats['undecodable'] += 1
+        log.debug("Undecodable datagram: { %s }", LazyHex(data))
+        return None
+
+    def _replay_datagram(self, dgram):
+        if not dgram.payload:
+            return
+
+        p = self._decode(dgram.payload)
+        if p is None:
+            return
+
+        src = (dgram.src, dgram.sport)
+        dst = (dgram.dst, dgram.dport)
+        p.captureTime = dgram.timestamp
+
+        # Work out who the repeaters are
+        if isinstance(p, HSTRPSyn):
+            conn = self._sessions.get(src)
+            if conn is not None and conn.radioID != p.rptHeader.synRepeaterRadioID:
+                self._disconnect(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect(src, dgram.timestamp, p.rptHeader.synRepeaterRadioID, p.rptHeader.synTimeslot)
+        elif isinstance(p, HSTRPFromRadio) and src not in self._sessions:
+            # Capture started after the SYN -- identify the repeater from the message's repeater header
+            self._connect(src, dgram.timestamp, p.rptHeader.synRepeaterRadioID, p.rptHeader.synTimeslot)
+        elif isinstance(p, (HSTRPSynAck, HSTRPToRadio)) and dst not in self._sessions:
+            self._connect(dst, dgram.timestamp)
+
+        conn = self._sessions.get(src)
+        if conn is not None:
+            conn.rx_activity(dgram.timestamp)
+        self._watchdog(dgram.timestamp)
+
+        # Sent by a repeater?
+        fromRepeater = conn is not None or (isinstance(p, RTPPacket) and dgram.src in self._repeaterHosts)
+        p.repeater = conn
+
+        if not self._match_class(p):
+            return
+
+        if self._packetCallback is not None:
+            self._packetCallback(dgram, p)
+
+        if not fromRepeater:
+            return
+
+        if isinstance(p, RTPPacket):
+            if self._rtpRxCallback is not None or self._rtpListeners:
+                self.stats[type(p).__name__] += 1
+                self._dispatcher.submit(PacketClass.RTP, self._deliver_rtp, p)
+        elif isinstance(p, HSTRPFromRadio):
+            if self._rcpRxCallback is not None or self._msgListeners:
+                self.stats[type(p.txCtrl).__name__] += 1
+                self._dispatcher.submit(PacketClass.RCP, self._deliver_msg, p)
+
+    def _connect(self, addr, now, radioID=None, timeslot=None):
+        conn = RepeaterConnection(addr, radioID, timeslot)
+        # Run the watchdog on capture time
+        conn.rx_activity(now)
+        self._sessions[addr] = conn
+        self._repeaterHosts.add(addr[0])
+        log.debug("Repeater %s at %s:%d", radioID, *addr)
+        self._notify_connection(conn, True)
+        return conn
+
+    def _disconnect(self, conn):
+        conn.connected = False
+        if self._sessions.get(conn.addr) is conn:
+            del self._sessions[conn.addr]
+        self._notify_connection(conn, False)
+
+    def _watchdog(self, now):
+        """ Disconnect repeaters which haven't been heard from for HEARTBEAT_TIMEOUT seconds of capture time """
+        if self._nextWatchdog is not None and now < self._nextWatchdog:
+            return
+        self._nextWatchdog = now + WATCHDOG_INTERVAL
+        for conn in list(self._sessions.values()):
+            if conn.expired(now):
+                self._disconnect(conn)
+
+    ################################
+    # Delivery
+    ################################
+
+    def _notify_connection(self, conn, connected):
+        if self._connListeners:
+            self._dispatcher.submit(PacketClass.EVENT, self._deliver_connection, (conn, connected))
+
+    def _deliver_connection(self, event):
+        for listener in list(self._connListeners):
+            listener(*event)
+
+    def _deliver_msg(self, p):
+        for listener in list(self._msgListeners):
+            listener(p)
+        if self._rcpRxCallback is not None:
+            self._rcpRxCallback(p)
+
+    def _deliver_rtp(self, p):
+        for listener in list(self._rtpListeners):
+            listener(p)
+        if self._rtpRxCallback is not None:
+            self._rtpRxCallback(p)
+
+    ################################
+    # Callbacks (see ADKSocket)
+    ################################
+
+    def set_msg_callback(self, callback):
+        """ Set the callback for HSTRPFromRadio packets (see ADKSocket.set_msg_callback) """
+        self._rcpRxCallback = callback
+
+    def set_rtp_callback(self, callback):
+        """ Set the callback for RTP packets sent by the repeaters (see ADKSocket.set_rtp_callback) """
+        self._rtpRxCallback = callback
+
+    def set_packet_callback(self, callback):
+        """
+        Set a callback for every decoded packet in the capture, in both directions.
+
+        It is called on the replay thread as callback(datagram, packet), where "datagram" is the
+        hylink.pcap.UDPDatagram the packet was decoded from.
+        """
+        self._packetCallback = callback
+
+    def add_msg_listener(self, listener):
+        self._msgListeners.append(listener)
+
+    def remove_msg_listener(self, listener):
+        self._msgListeners.remove(listener)
+
+    def add_rtp_listener(self, listener):
+        self._rtpListeners.append(listener)
+
+    def remove_rtp_listener(self, listener):
+        self._rtpListeners.remove(listener)
+
+    def add_connection_listener(self, listener):
+        """ Add a connection listener, called as listener(conn, connected) (see ADKSocket.add_connection_listener) """
+        self._connListeners.append(listener)
+
+    def remove_connection_listener(self, listener):
+        self._connListeners.remove(listener)
@@ -0,0 +1,418 @@
+"""
+
+ADK Repeater Interface
+
+Online radio registry
+
+A RadioRegistry follows the RRS (radio registration service) traffic on one or more ADKSockets, and keeps
+a table of the radios which are online: their DMR IP address, the repeater and timeslot they registered
+through, when they were last heard from, and when their registration expires.
+
+    registry = RadioRegistry([rrsSocket1, rrsSocket2], snapshot='radios.json')
+    if 1001 in registry:
+        print(registry.get(1001))
+    for entry in registry.online(repeater=100):
+        ...
+    registry.close()
+
+Lookups by radio ID are dictionary lookups, and each repeater has its own index of the radios registered
+through it, so listing a repeater's radios doesn't scan the whole table.
+
+Registrations which aren't renewed expire. Expiry times are kept in a timer wheel (a ring of buckets,
+one per tick), so expiring radios costs the same however many are registered. Radios which send an
+RRSOffline are removed straight away.
+
+With a snapshot file, the table is saved periodically and on close(), and loaded when the registry is
+created, so a restart doesn't lose track of the radios which were already online.
+
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+from .clock import SYSTEM_CLOCK
+from .packet import RRSOffline, RRSRegister
+from .utils import dmr_id_to_ip, dmr_ip_to_str
+
+log = logging.getLogger(__name__)
+
+
+# Time a registration stays valid without being renewed (seconds)
+RRS_REGISTRATION_VALIDITY = 1800
+
+# Timer wheel resolution (seconds) and size (number of buckets). Expiry times more than one revolution
+# away stay in their bucket until the wheel comes round to them again.
+RRS_WHEEL_TICK = 1.0
+RRS_WHEEL_SLOTS = 4096
+
+# Interval between snapshot saves (seconds)
+RRS_SNAPSHOT_INTERVAL = 60
+
+# Snapshot format version
+_SNAPSHOT_VERSION = 1
+
+
+class RadioEntry(object):
+    """ One online radio """
+
+    __slots__ = ('radioID', 'radioIP', 'repeater', 'timeslot', 'registered', 'lastSeen', 'expires', '_slot')
+
+    def __init__(self, radioID, radioIP, repeater, timeslot, registered, lastSeen, expires):
+        self.radioID = radioID
+        self.radioIP = radioIP
+        # Radio ID of the repeater the radio registered through, and the repeater timeslot
+        self.repeater = repeater
+        self.timeslot = timeslot
+        # Time of the first registration, the most recent registration, and the registration expiry
+        # (time.time() values)
+        self.registered = registered
+        self.lastSeen = lastSeen
+        self.expires = expires
+        # Timer wheel bucket the entry is in
+        self._slot = None
+
+    def as_dict(self):
+        return {'radioID': self.radioID, 'radioIP': self.radioIP, 'repeater': self.repeater,
+                'timeslot': self.timeslot, 'registered': self.registered, 'lastSeen': self.lastSeen,
+                'expires': self.expires}
+
+    def __repr__(self):
+        return "<%s: radio ID %d (%s), repeater %s timeslot %s, last seen %s, expires in %.0fs>" % \
+               (type(self).__name__, self.radioID, dmr_ip_to_str(self.radioIP), self.repeater, self.timeslot,
+                time.strftime('%H:%M:%S', time.localtime(self.lastSeen)), self.expires - time.time())
+
+
+class RadioRegistry(object):
+    """ Table of online radios, fed by RRS registrations """
+
+    def __init__(self, socks=(), validity=RRS_REGISTRATION_VALIDITY, snapshot=None,
+                 snapshot_interval=RRS_SNAPSHOT_INTERVAL, tick=RRS_WHEEL_TICK, slots=RRS_WHEEL_SLOTS, clock=None):
+        """
+        Create a radio registry and start its expiry thread
+
+        :param socks: ADKSockets bound to repeaters' RRS ports (more can be added with attach())
+        :param validity: Time a registration stays valid without being renewed (seconds)
+        :param snapshot: Snapshot file name, or None for no snapshots
+        :param snapshot_interval: Interval between snapshot saves (seconds)
+        :param tick: Timer wheel resolution (seconds)
+        :param slots: Timer wheel size (number of buckets)
+        :param clock: hylink.clock.Clock for registration times and expiry (defaults to the system clock)
+        """
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self.validity = validity
+        self.snapshot = snapshot
+        self.snapshotInterval = snapshot_interval
+
+        self._lock = threading.RLock()
+        # Radio ID -> RadioEntry
+        self._radios = {}
+        # Repeater radio ID -> {radio ID: RadioEntry}
+        self._byRepeater = {}
+
+        # Timer wheel: a ring of buckets, each a set of radio IDs. _wheelTick is the last tick processed.
+        self._tick = tick
+        self._wheel = [set() for _ in range(slots)]
+        self._wheelTick = int(self.clock.time() / tick)
+
+        self._listeners = []
+        self._socks = []
+        self._dirty = False
+
+        # Counters
+        self.registrations = 0
+        self.offlines = 0
+        self.expiries = 0
+
+        if snapshot is not None and os.path.exists(snapshot):
+            try:
+                self.load(snapshot)
+            except (OSError, ValueError, KeyError) as e:
+                log.warning("Couldn't load radio registry snapshot %s: %s", snapshot, e)
+
+        for sock in socks:
+            self.attach(sock)
+
+        # Wakes the expiry thread to stop
+        self._cond = threading.Condition()
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="RadioRegistry", daemon=True)
+        self._thread.start()
+
+    def attach(self, sock):
+        """
+        Follow the RRS traffic on a socket
+
+        :param sock: ADKSocket bound to a repeater's RRS port
+        """
+        sock.add_msg_listener(self._msg)
+        self._socks.append(sock)
+
+    def close(self):
+        """ Detach the registry from its sockets, stop the expiry thread and save a final snapshot """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        for sock in self._socks:
+            sock.remove_msg_listener(self._msg)
+        self._socks = []
+        if self.snapshot is not None:
+            self.save(self.snapshot)
+
+    def add_listener(self, listener):
+        """
+        Add a registration listener, called when a radio comes online or goes offline
+
+        :param listener: Function, called as listener(entry, online). 'online' is True for a new
+            registration, and False when the radio goes offline or its registration expires.
+        """
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """ Remove a listener added by add_listener() """
+        self._listeners.remove(listener)
+
+    ################################
+    # Queries
+    ################################
+
+    def __len__(self):
+        return len(self._radios)
+
+    def __contains__(self, radioID):
+        return radioID in self._radios
+
+    def get(self, radioID):
+        """ Returns the RadioEntry for a radio, or None if it isn't online """
+        return self._radios.get(radioID)
+
+    def online(self, repeater=None):
+        """
+        Returns a list of the online radios
+
+        :param repeater: Repeater radio ID, to list only the radios registered through that repeater
+        """
+        with self._lock:
+            if repeater is None:
+                return list(self._radios.values())
+            return list(self._byRepeater.get(repeater, {}).values())
+
+    def repeaters(self):
+        """ Returns a dict of repeater radio ID -> number of radios registered through it """
+        with self._lock:
+            return {rpt: len(radios) for rpt, radios in self._byRepeater.items() if radios}
+
+    ################################
+    # Updates
+    ################################
+
+    def register(self, radioID, radioIP=None, repeater=None, timeslot=None, now=None, expires=None):
+        """
+        Register a radio, or renew its registration. Returns its RadioEntry.
+
+        :param radioID: Radio ID
+        :param radioIP: Radio DMR IP address (defaults to the usual address for the radio ID)
+        :param repeater: Radio ID of the repeater the radio registered through
+        :param timeslot: Repeater timeslot
+        :param now: Registration time (a clock time() value; defaults to now)
+        :param expires: Registration expiry time (defaults to now plus the registration validity)
+        """
+        if now is None:
+            now = self.clock.time()
+        if expires is None:
+            expires = now + self.validity
+        if radioIP is None:
+            radioIP = dmr_id_to_ip(radioID)
+
+        with self._lock:
+            entry = self._radios.get(radioID)
+            new = entry is None
+            if new:
+                entry = RadioEntry(radioID, radioIP, repeater, timeslot, now, now, expires)
+                self._radios[radioID] = entry
+            else:
+                # The radio may have moved to another repeater
+                if entry.repeater != repeater:
+                    self._unindex(entry)
+                entry.radioIP = radioIP
+                entry.repeater = repeater
+                entry.timeslot = timeslot
+                entry.lastSeen = now
+                entry.expires = expires
+            self._byRepeater.setdefault(repeater, {})[radioID] = entry
+            self._schedule(entry)
+            self._dirty = True
+
+        if new:
+            log.debug("Radio %d online via repeater %s", radioID, repeater)
+            self._notify(entry, True)
+        return entry
+
+    def unregister(self, radioID):
+        """ Remove a radio from the table. Returns its RadioEntry, or None if it wasn't online. """
+        with self._lock:
+            entry = self._remove(radioID)
+        if entry is not None:
+            log.debug("Radio %d offline", radioID)
+            self._notify(entry, False)
+        return entry
+
+    def _remove(self, radioID):
+        """ Remove a radio from the table and the indexes. Caller must hold _lock. """
+        entry = self._radios.pop(radioID, None)
+        if entry is None:
+            return None
+        self._unindex(entry)
+        if entry._slot is not None:
+            self._wheel[entry._slot].discard(radioID)
+            entry._slot = None
+        self._dirty = True
+        return entry
+
+    def _unindex(self, entry):
+        radios = self._byRepeater.get(entry.repeater)
+        if radios is not None:
+            radios.pop(entry.radioID, None)
+            if not radios:
+                del self._byRepeater[entry.repeater]
+
+    def _notify(self, entry, online):
+        for listener in self._listeners:
+            # noinspection PyBroadException
+            try:
+                listener(entry, online)
+            except Exception:
+                log.exception("Exception in radio registry listener")
+
+    def _msg(self, p):
+        txc = p.txCtrl
+        if isinstance(txc, RRSRegister):
+            # The repeater ID and timeslot come from the repeater header, or failing that, the SYN
+            hdr = p.rptHeader
+            conn = getattr(p, 'repeater', None)
+            repeater = hdr.synRepeaterRadioID
+            timeslot = hdr.synTimeslot
+            if repeater is None and conn is not None:
+                repeater = conn.radioID
+            if timeslot is None and conn is not None:
+                timeslot = conn.timeslot
+            self.registrations += 1
+            self.register(txc.radioID, txc.radioIP, repeater, timeslot)
+        elif isinstance(txc, RRSOffline):
+            self.offlines += 1
+            self.unregister(txc.radioID)
+
+    ################################
+    # Expiry
+    ################################
+
+    def _schedule(self, entry):
+        """ Put an entry in the timer wheel bucket for its expiry time. Caller must hold _lock. """
+        if entry._slot is not None:
+            self._wheel[entry._slot].discard(entry.radioID)
+        # Bucket n is processed once the time reaches tick n, so an entry goes in the bucket after the one
+        # containing its expiry time. Entries which have already expired go in the next bucket to be processed.
+        tick = max(int(entry.expires / self._tick) + 1, self._wheelTick + 1)
+        entry._slot = tick % len(self._wheel)
+        self._wheel[entry._slot].add(entry.radioID)
+
+    def expire(self, now=None):
+        """
+        Remove the radios whose registrations have expired. Called by the expiry thread. Returns the
+        expired entries.
+
+        :param now: Current time (a clock time() value; defaults to now)
+        """
+        if now is None:
+            now = self.clock.time()
+        expired = []
+        with self._lock:
+            target = int(now / self._tick)
+            # After a long pause (or at startup) there's no point going round the wheel more than once
+            first = max(self._wheelTick + 1, target - len(self._wheel) + 1)
+            for tick in range(first, target + 1):
+                bucket = self._wheel[tick % len(self._wheel)]
+                if not bucket:
+                    continue
+                for radioID in list(bucket):
+                    entry = self._radios[radioID]
+                    # Entries a revolution or more in the future stay where they are
+                    if entry.expires <= now:
+                        expired.append(self._remove(radioID))
+            self._wheelTick = max(self._wheelTick, target)
+
+        for entry in expired:
+            self.expiries += 1
+            log.debug("Radio %d registration expired", entry.radioID)
+            self._notify(entry, False)
+        return expired
+
+    def _thread_proc(self):
+        clock = self.clock
+        lastSave = clock.monotonic()
+        while True:
+            # noinspection PyBroadException
+            try:
+                self.expire()
+                if self.snapshot is not None and self._dirty and \
+                        clock.monotonic() - lastSave >= self.snapshotInterval:
+                    self.save(self.snapshot)
+                    lastSave = clock.monotonic()
+            except Exception:
+                log.exception("Radio registry housekeeping failed")
+
+            with self._cond:
+                if not self._running:
+                    return
+                clock.wait(self._cond, self._tick)
+
+    ################################
+    # Snapshots
+    ################################
+
+    def save(self, filename):
+        """
+        Save a snapshot of the table. The snapshot is written to a temporary file which then replaces
+        the old snapshot, so a crash never leaves a partial file behind.
+
+        :param filename: Snapshot file name
+        """
+        with self._lock:
+            radios = [e.as_dict() for e in self._radios.values()]
+            self._dirty = False
+
+        tmp = filename + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'version': _SNAPSHOT_VERSION, 'time': self.clock.time(), 'radios': radios}, f)
+        os.replace(tmp, filename)
+        log.debug("Saved %d radios to %s", len(radios), filename)
+
+    def load(self, filename):
+        """
+        Load a snapshot saved by save(). Registrations which have expired since the snapshot was taken
+        are skipped; the rest are merged into the table.
+
+        :param filename: Snapshot file name
+        """
+        with open(filename) as f:
+            snap = json.load(f)
+        if snap.get('version') != _SNAPSHOT_VERSION:
+            raise ValueError("Unsupported snapshot version %r" % snap.get('version'))
+
+        now = self.clock.time()
+        loaded = 0
+        with self._lock:
+            for r in snap['radios']:
+                if r['expires'] <= now or r['radioID'] in self._radios:
+                    continue
+                entry = self.register(r['radioID'], r['radioIP'], r['repeater'], r['timeslot'],
+                                      now=r['lastSeen'], expires=r['expires'])
+                entry.registered = r['registered']
+                loaded += 1
+        log.info("Loaded %d online radios from %s", loaded, filename)
+        return loaded
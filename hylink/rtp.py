@@ -45,12 +45,16 @@ class RTPPacket(object):
         flags, timestamp, ssrc = struct.unpack_from('!LLL', data)
 
         self.rtpVersion     = (flags >> 30) & 0x03
-        padding             = (flags & 0x200000) != 0
-        extension           = (flags & 0x100000) != 0
+        padding             = (flags & 0x20000000) != 0
+        extension           = (flags & 0x10000000) != 0
         csrc_count          = (flags >> 24) & 0x0F
         self.marker         = (flags & 0x800000) != 0
         self.payloadType    = (flags >> 16) & 0x7F
         self.seq            = (flags & 0xFFFF)
+        self.timestamp      = timestamp
+        self.ssrc           = ssrc
+        self.csrc           = []
+        self.extension      = None
 
         # Calculate payload start offset
         payload_start = 12
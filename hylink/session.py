@@ -0,0 +1,236 @@
+"""
+
+ADK Repeater Interface
+
+High-level repeater session
+
+A RepeaterSession follows one repeater on a pair of ADKSockets (one RCP port, and optionally the matching
+RTP port). Connection, disconnection and call-state changes can be waited for, rather than polled:
+
+    session = RepeaterSession(rcpPort, rtpPort)
+    session.wait_connected()
+    session.call(CallType.GROUP, 10000)
+    session.ptt(True)
+    session.wait_call_status(TxCallStatus.REMOTE_PTT_TX, timeout=2)
+
+The same states are available as asyncio awaitables (connected(), disconnected(), call_status()), which
+must be created from a coroutine running in the event loop which awaits them.
+
+State changes are driven by the repeater's SYNs, the socket watchdogs and RCPRepeaterBroadcastTransmitStatus
+broadcasts.
+
+"""
+
+import asyncio
+import logging
+import threading
+
+from .packet import HSTRPToRadio, RCPButtonRequest, RCPCallRequest, RCPRepeaterBroadcastTransmitStatus
+from .types import ButtonOperation, ButtonTarget
+
+log = logging.getLogger(__name__)
+
+
+class RepeaterSession(object):
+    """ Event-driven interface to one repeater """
+
+    def __init__(self, rcp, rtp=None, repeater=None):
+        """
+        Create a repeater session
+
+        :param rcp: ADKSocket bound to the repeater's RCP port
+        :param rtp: ADKSocket bound to the repeater's RTP port, or None if audio isn't needed
+        :param repeater: Radio ID of the repeater to follow. If None, the session follows the first repeater
+            to connect to the RCP socket.
+        """
+        self._rcp = rcp
+        self._rtp = rtp
+        self.radioID = repeater
+
+        # Connections to the repeater on each socket (RepeaterConnection, or None if not connected)
+        self._rcpConn = None
+        self._rtpConn = None
+
+        # Call state -- the last RCPRepeaterBroadcastTransmitStatus, and its status field
+        self.transmitStatus = None
+        self.callStatus = None
+
+        self._cond = threading.Condition()
+        # Asyncio waiters: list of (predicate, result, loop, future)
+        self._asyncWaiters = []
+
+        # Pick up any repeater which connected before the session was created
+        for sock, attr in ((rcp, '_rcpConn'), (rtp, '_rtpConn')):
+            if sock is None:
+                continue
+            conn = sock.get_session(self.radioID)
+            if conn is not None and (self.radioID is None or conn.radioID == self.radioID):
+                self.radioID = conn.radioID
+                setattr(self, attr, conn)
+
+        rcp.add_connection_listener(self._rcp_connection)
+        rcp.add_msg_listener(self._msg)
+        if rtp is not None:
+            rtp.add_connection_listener(self._rtp_connection)
+
+    def close(self):
+        """ Detach the session from its sockets """
+        self._rcp.remove_connection_listener(self._rcp_connection)
+        self._rcp.remove_msg_listener(self._msg)
+        if self._rtp is not None:
+            self._rtp.remove_connection_listener(self._rtp_connection)
+
+    def __repr__(self):
+        return "<%s: repeater ID %s, %s, call status %s>" % \
+               (type(self).__name__, self.radioID, "connected" if self.is_connected() else "disconnected",
+                self.callStatus)
+
+    ################################
+    # State
+    ################################
+
+    def is_connected(self):
+        """ Returns True if the repeater is connected on the RCP port (and RTP port, if there is one) """
+        return self._rcpConn is not None and (self._rtp is None or self._rtpConn is not None)
+
+    def _changed(self):
+        """ Wake up anything waiting for a state change. Caller must hold _cond. """
+        self._cond.notify_all()
+
+        waiters = []
+        for w in self._asyncWaiters:
+            predicate, result, loop, fut = w
+            if predicate():
+                loop.call_soon_threadsafe(_set_future, fut, result())
+            else:
+                waiters.append(w)
+        self._asyncWaiters = waiters
+
+    def _connection(self, conn, connected, attr):
+        with self._cond:
+            if connected:
+                # Follow the first repeater to connect, if we weren't told which one to follow
+                if self.radioID is None:
+                    self.radioID = conn.radioID
+                if conn.radioID != self.radioID:
+                    return
+                setattr(self, attr, conn)
+                log.info("Session %s: repeater connected on port %d", self.radioID, conn.addr[1])
+            else:
+                if getattr(self, attr) is not conn:
+                    return
+                setattr(self, attr, None)
+                log.info("Session %s: repeater disconnected", self.radioID)
+            self._changed()
+
+    def _rcp_connection(self, conn, connected):
+        self._connection(conn, connected, '_rcpConn')
+
+    def _rtp_connection(self, conn, connected):
+        self._connection(conn, connected, '_rtpConn')
+
+    def _msg(self, p):
+        if p.repeater is not self._rcpConn or not isinstance(p.txCtrl, RCPRepeaterBroadcastTransmitStatus):
+            return
+
+        with self._cond:
+            self.transmitStatus = p.txCtrl
+            self.callStatus = p.txCtrl.status
+            self._changed()
+
+    ################################
+    # Blocking waits
+    ################################
+
+    def _wait(self, predicate, timeout):
+        with self._cond:
+            return self._cond.wait_for(predicate, timeout)
+
+    def wait_connected(self, timeout=None):
+        """ Wait for the repeater to connect. Returns True if connected, False on timeout. """
+        return self._wait(self.is_connected, timeout)
+
+    def wait_disconnected(self, timeout=None):
+        """ Wait for the repeater to disconnect. Returns True if disconnected, False on timeout. """
+        return self._wait(lambda: not self.is_connected(), timeout)
+
+    def wait_call_status(self, statuses, timeout=None):
+        """
+        Wait for the repeater to report one of a set of call states.
+
+        :param statuses: A TxCallStatus, or a collection of them
+        :param timeout: Timeout in seconds, or None to wait forever
+        :return: The TxCallStatus reported, or None on timeout
+        """
+        statuses = _status_set(statuses)
+        if self._wait(lambda: self.callStatus in statuses, timeout):
+            return self.callStatus
+        return None
+
+    ################################
+    # Asyncio awaitables
+    ################################
+
+    def _future(self, predicate, result):
+        # The awaitables belong to the caller's event loop, so they must be created from a coroutine
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        with self._cond:
+            if predicate():
+                fut.set_result(result())
+            else:
+                self._asyncWaiters.append((predicate, result, loop, fut))
+        return fut
+
+    def connected(self):
+        """ Return an awaitable which completes when the repeater is connected """
+        return self._future(self.is_connected, lambda: True)
+
+    def disconnected(self):
+        """ Return an awaitable which completes when the repeater is disconnected """
+        return self._future(lambda: not self.is_connected(), lambda: True)
+
+    def call_status(self, statuses):
+        """ Return an awaitable which completes with the TxCallStatus when the repeater reports one of 'statuses' """
+        statuses = _status_set(statuses)
+        return self._future(lambda: self.callStatus in statuses, lambda: self.callStatus)
+
+    ################################
+    # Commands
+    ################################
+
+    def send(self, packet, callback=None):
+        """ Send a packet to the repeater's RCP port (see ADKSocket.send) """
+        return self._rcp.send(packet, callback, repeater=self.radioID)
+
+    def send_rtp(self, packet):
+        """ Send an RTP packet to the repeater's RTP port """
+        return self._rtp.send(packet, repeater=self.radioID)
+
+    def call(self, callType, destId, callback=None):
+        """ Send an RCP call request, selecting who the next transmission is addressed to """
+        htc = HSTRPToRadio()
+        htc.txCtrl = RCPCallRequest()
+        htc.txCtrl.callType = callType
+        htc.txCtrl.destId = destId
+        return self.send(htc, callback)
+
+    def ptt(self, pressed, target=ButtonTarget.FRONT_PTT, callback=None):
+        """ Press or release the repeater's PTT button """
+        htc = HSTRPToRadio()
+        htc.txCtrl = RCPButtonRequest()
+        htc.txCtrl.pttTarget = target
+        htc.txCtrl.pttOperation = ButtonOperation.PRESS if pressed else ButtonOperation.RELEASE
+        return self.send(htc, callback)
+
+
+def _status_set(statuses):
+    try:
+        return frozenset(statuses)
+    except TypeError:
+        return frozenset((statuses,))
+
+
+def _set_future(fut, result):
+    if not fut.done():
+        fut.set_result(result)
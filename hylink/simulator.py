@@ -0,0 +1,555 @@
+"""
+
+ADK Repeater Interface
+
+Repeater simulator and load generator
+
+Simulates any number of Hytera repeaters over UDP, so hylink can be load-tested without real hardware.
+Each simulated repeater connects to the RCP port (and optionally the RTP port) of an ADKSocket from its own
+socket, sends SYNs until it gets a SYN-ACK, keeps up heartbeats, ACKs HSTRPToRadio messages, and sends RCP
+transmit status broadcasts and RTP voice frames at configurable rates. Loss, reordering and duplication can
+be injected into everything it sends.
+
+All the repeaters run on one thread, driven by a timer heap and a selector. If the simulator itself can't
+keep up with the configured rates, the report shows it as scheduling lag.
+
+The simulator's timers run on a hylink.clock.Clock. With a VirtualClock (shared with the ADKSockets under
+test), another thread moves the clock on with advance() while run() is going, and the simulated
+repeaters' SYNs, heartbeats and traffic follow it; the sockets are then polled every SIM_SELECT_INTERVAL
+seconds of real time. Latencies are measured on the clock too.
+
+Latency is measured two ways: the round trip from sending a HSTRPFromRadio to receiving its ACK (works
+against any hylink application), and -- if the simulator is attached to ADKSockets in the same process --
+from sending a packet to its delivery to the msg/RTP listeners.
+
+    python -m hylink.simulator --repeaters 20 --rtp-rate 50 --rcp-rate 5 --duration 10
+    python -m hylink.simulator --repeaters 20 --sweep           # double the rates until hylink saturates
+
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import random
+import selectors
+import socket
+import struct
+
+from . import synth
+from .clock import SYSTEM_CLOCK
+from .rtp import RTPPacket
+from .types import CallType, TxCallStatus
+
+log = logging.getLogger(__name__)
+
+
+# Simulated repeater timing (seconds)
+SYN_INTERVAL = 1.0              # SYN retry interval while not connected
+HEARTBEAT_INTERVAL = 2.0        # Heartbeat interval while connected
+REPEATER_TIMEOUT = 60.0         # Go back to sending SYNs if nothing is heard from hylink for this long
+
+# Longest real time (seconds) the simulator waits for datagrams at once when it isn't using the system
+# clock (a virtual clock can move on without it being woken)
+SIM_SELECT_INTERVAL = 0.01
+
+# Maximum number of latency samples kept per measurement (for the percentiles)
+MAX_LATENCY_SAMPLES = 200000
+
+
+def _percentiles(samples):
+    """ Return latency percentiles (microseconds) of a list of samples (seconds) """
+    if not samples:
+        return None
+    s = sorted(samples)
+    pick = lambda q: s[min(len(s) - 1, int(q * len(s)))] * 1e6
+    return {'count': len(s), 'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': s[-1] * 1e6}
+
+
+class _Link(object):
+    """ One simulated repeater's connection to one hylink port """
+
+    def __init__(self, sim, repeater, kind, dest):
+        self.sim = sim
+        self.repeater = repeater
+        self.kind = kind                # 'rcp' or 'rtp'
+        self.dest = dest
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((sim.bindHost, 0))
+        self.sock.setblocking(False)
+        self.addr = self.sock.getsockname()
+
+        self.connected = False
+        self.lastRx = 0
+        self._seq = 0
+        # Datagram held back to be sent after the next one (reordering)
+        self.held = None
+        # Send times of HSTRPFromRadio packets waiting for an ACK: seq -> time
+        self.pending = {}
+
+    def next_seq(self):
+        self._seq = (self._seq + 1) & 0xFFFF
+        return self._seq
+
+    def close(self):
+        self.sock.close()
+
+
+class SimulatedRepeater(object):
+    """ State of one simulated repeater """
+
+    def __init__(self, radioID, timeslot):
+        self.radioID = radioID
+        self.timeslot = timeslot
+        self.links = []
+        self.ssrc = 0
+        self.rtpSeq = 0
+        self.rtpTimestamp = 0
+        self.statusIdx = 0
+
+
+class RepeaterSimulator(object):
+    """ Simulates a set of repeaters talking to a hylink application """
+
+    def __init__(self, host, rcpPort, rtpPort=None, repeaters=1, baseRadioID=100, timeslot=1,
+                 rtpRate=50., rcpRate=1., loss=0., duplicate=0., reorder=0., seed=0, clock=None):
+        """
+        Create a simulator
+
+        :param host: Address of the hylink application
+        :param rcpPort: hylink's RCP port
+        :param rtpPort: hylink's RTP port, or None to send no audio
+        :param repeaters: Number of repeaters to simulate
+        :param baseRadioID: Radio ID of the first repeater; the rest are numbered consecutively
+        :param timeslot: Timeslot the repeaters announce in their SYNs
+        :param rtpRate: RTP frames per second sent by each repeater (50 is one continuous voice call)
+        :param rcpRate: RCP transmit status broadcasts per second sent by each repeater
+        :param loss: Probability that a datagram is lost
+        :param duplicate: Probability that a datagram is sent twice
+        :param reorder: Probability that a datagram is held back and sent after the next one
+        :param seed: Random seed for the impairments
+        :param clock: hylink.clock.Clock which drives the simulated repeaters (defaults to the system clock)
+        """
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+        self._selectMax = None if clock is None else SIM_SELECT_INTERVAL
+        self.bindHost = '127.0.0.1' if host in ('127.0.0.1', 'localhost', '') else ''
+        self.loss = loss
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self._rand = random.Random(seed)
+
+        self._sel = selectors.DefaultSelector()
+        self._timers = []
+        self._timerCount = 0
+
+        self.repeaters = []
+        for i in range(repeaters):
+            r = SimulatedRepeater(baseRadioID + i, timeslot)
+            r.ssrc = self._rand.randrange(0x100000000)
+            r.rtpSeq = self._rand.randrange(0x10000)
+            for kind, port in (('rcp', rcpPort), ('rtp', rtpPort)):
+                if port is None:
+                    continue
+                link = _Link(self, r, kind, (host, port))
+                r.links.append(link)
+                self._sel.register(link.sock, selectors.EVENT_READ, link)
+                self._schedule(self.clock.monotonic(), self._tx_syn, link)
+            self.repeaters.append(r)
+
+        self.rtpRate = self.rcpRate = 0
+        self.set_rates(rtpRate, rcpRate)
+
+        # Send times of packets awaiting delivery to an attached ADKSocket's listeners: key -> time
+        self._sentAt = {}
+        self._attached = []
+
+        # Start time of the current run -- timers due before this don't count as lag
+        self._runStart = 0
+        self._reset_stats()
+
+    def close(self):
+        """ Close the simulated repeaters' sockets, and detach from any ADKSockets """
+        for sock in list(self._attached):
+            self.detach(sock)
+        for r in self.repeaters:
+            for link in r.links:
+                self._sel.unregister(link.sock)
+                link.close()
+        self._sel.close()
+
+    ################################
+    # Configuration
+    ################################
+
+    def set_rates(self, rtpRate=None, rcpRate=None):
+        """ Change the per-repeater RTP frame rate and RCP broadcast rate (packets per second) """
+        now = self.clock.monotonic()
+        for attr, rate, kind, fn in (('rtpRate', rtpRate, 'rtp', self._tx_rtp),
+                                     ('rcpRate', rcpRate, 'rcp', self._tx_rcp)):
+            if rate is None:
+                continue
+            old = getattr(self, attr)
+            setattr(self, attr, rate)
+            if old == 0 and rate > 0:
+                # Start the traffic, spreading the repeaters across the first interval
+                for r in self.repeaters:
+                    for link in r.links:
+                        if link.kind == kind:
+                            self._schedule(now + self._rand.random() / rate, fn, link)
+
+    def attach(self, sock):
+        """ Measure delivery latency to an ADKSocket in the same process (through its msg/RTP listeners) """
+        sock.add_msg_listener(self._delivered_msg)
+        sock.add_rtp_listener(self._delivered_rtp)
+        self._attached.append(sock)
+
+    def detach(self, sock):
+        sock.remove_msg_listener(self._delivered_msg)
+        sock.remove_rtp_listener(self._delivered_rtp)
+        self._attached.remove(sock)
+
+    ################################
+    # Running
+    ################################
+
+    def connect(self, timeout=10.):
+        """ Run until every simulated repeater has been acknowledged by hylink. Returns True on success. """
+        end = self.clock.monotonic() + timeout
+        while not all(link.connected for r in self.repeaters for link in r.links):
+            if self.clock.monotonic() >= end:
+                return False
+            self._poll(min(end, self.clock.monotonic() + 0.1))
+        return True
+
+    def run(self, duration):
+        """
+        Run the simulation for a period, and return a report of what happened in it.
+
+        Repeaters stay connected between runs, so rates can be changed (set_rates) and the simulation run again.
+        """
+        if not self.connect():
+            log.warning("Not every simulated repeater connected")
+
+        self._reset_stats()
+        start = self._runStart = self.clock.monotonic()
+        end = start + duration
+        while self.clock.monotonic() < end:
+            self._poll(end)
+
+        # Give the last packets a moment to be acknowledged / delivered
+        self._poll(self.clock.monotonic() + 0.2, traffic=False)
+        return self._report(self.clock.monotonic() - start)
+
+    def _poll(self, until, traffic=True):
+        """ Run the timers and handle received datagrams until a deadline """
+        while True:
+            now = self.clock.monotonic()
+            if now >= until:
+                return
+
+            # Run any timers which are due
+            while self._timers and self._timers[0][0] <= now:
+                due, _, fn, link = heapq.heappop(self._timers)
+                lag = now - due
+                if lag > self.stats['maxLag'] and due >= self._runStart:
+                    self.stats['maxLag'] = lag
+                if traffic or fn not in (self._tx_rtp, self._tx_rcp):
+                    fn(link, due)
+                else:
+                    # Not sending traffic -- try again later
+                    self._schedule(until, fn, link)
+
+            timeout = until - self.clock.monotonic()
+            if self._timers:
+                timeout = min(timeout, self._timers[0][0] - self.clock.monotonic())
+            if self._selectMax is not None:
+                timeout = min(timeout, self._selectMax)
+            for key, _ in self._sel.select(max(0., timeout)):
+                self._rx(key.data)
+
+    def _schedule(self, when, fn, link):
+        self._timerCount += 1
+        heapq.heappush(self._timers, (when, self._timerCount, fn, link))
+
+    ################################
+    # Transmit
+    ################################
+
+    def _send(self, link, data, kind):
+        """ Send a datagram, applying the impairments """
+        stats = self.stats
+        stats['sent'][kind] = stats['sent'].get(kind, 0) + 1
+        r = self._rand
+
+        if self.loss and r.random() < self.loss:
+            stats['lost'] += 1
+            return
+
+        copies = 1
+        if self.duplicate and r.random() < self.duplicate:
+            stats['duplicated'] += 1
+            copies = 2
+
+        if self.reorder and link.held is None and r.random() < self.reorder:
+            stats['reordered'] += 1
+            link.held = data
+            return
+
+        try:
+            for _ in range(copies):
+                link.sock.sendto(data, link.dest)
+            if link.held is not None:
+                link.sock.sendto(link.held, link.dest)
+                link.held = None
+        except (BlockingIOError, ConnectionRefusedError):
+            stats['sendErrors'] += 1
+
+    def _tx_syn(self, link, due):
+        if link.connected:
+            return
+        rpt = link.repeater
+        self._send(link, synth.syn_frame(rpt.radioID, rpt.timeslot, link.next_seq()), 'syn')
+        self._schedule(self.clock.monotonic() + SYN_INTERVAL, self._tx_syn, link)
+
+    def _tx_heartbeat(self, link, due):
+        if not link.connected:
+            return
+        now = self.clock.monotonic()
+        if now - link.lastRx > REPEATER_TIMEOUT:
+            # hylink has gone away -- go back to sending SYNs
+            log.info("Simulated repeater %d: connection to port %d timed out", link.repeater.radioID, link.dest[1])
+            link.connected = False
+            self._schedule(now, self._tx_syn, link)
+            return
+        self._send(link, synth.heartbeat_frame(), 'heartbeat')
+        self._schedule(due + HEARTBEAT_INTERVAL, self._tx_heartbeat, link)
+
+    def _tx_rcp(self, link, due):
+        if self.rcpRate <= 0:
+            return
+        if link.connected:
+            rpt = link.repeater
+            rpt.statusIdx += 1
+            txc = synth.transmit_status(TxCallStatus.LOCAL_REPEATING if rpt.statusIdx & 1 else
+                                        TxCallStatus.LOCAL_HANG_TIME, CallType.GROUP, 1, rpt.radioID)
+            seq = link.next_seq()
+            now = self.clock.monotonic()
+            link.pending[seq] = now
+            if self._attached:
+                self._sentAt[('rcp', rpt.radioID, seq)] = now
+            self._send(link, synth.from_radio_frame(rpt.radioID, seq, txc, rpt.timeslot), 'rcp')
+        self._schedule(due + 1. / self.rcpRate, self._tx_rcp, link)
+
+    def _tx_rtp(self, link, due):
+        if self.rtpRate <= 0:
+            return
+        if link.connected:
+            rpt = link.repeater
+            rpt.rtpSeq = (rpt.rtpSeq + 1) & 0xFFFF
+            rpt.rtpTimestamp = (rpt.rtpTimestamp + synth.RTP_FRAME_SAMPLES) & 0xFFFFFFFF
+            if self._attached:
+                self._sentAt[('rtp', rpt.ssrc, rpt.rtpSeq)] = self.clock.monotonic()
+            self._send(link, synth.rtp_frame(rpt.rtpSeq, rpt.rtpTimestamp, rpt.ssrc), 'rtp')
+        self._schedule(due + 1. / self.rtpRate, self._tx_rtp, link)
+
+    ################################
+    # Receive
+    ################################
+
+    def _rx(self, link):
+        """ Handle every datagram waiting on a link's socket """
+        while True:
+            try:
+                data, _addr = link.sock.recvfrom(2048)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            now = self.clock.monotonic()
+            link.lastRx = now
+
+            if data[:3] != synth.HYT_SIGNATURE or len(data) < 6:
+                # RTP from hylink
+                self.stats['received']['rtp'] = self.stats['received'].get('rtp', 0) + 1
+                continue
+
+            pkttype, seq = struct.unpack_from('>BH', data, 3)
+            if pkttype == synth.HYT_SYNACK:
+                self._count_rx('synack')
+                if not link.connected:
+                    link.connected = True
+                    self._schedule(now + HEARTBEAT_INTERVAL, self._tx_heartbeat, link)
+            elif pkttype == synth.HYT_ACK:
+                self._count_rx('ack')
+                sent = link.pending.pop(seq, None)
+                if sent is not None:
+                    self._sample('ackLatency', now - sent)
+            elif pkttype == synth.HYT_HEARTBEAT:
+                self._count_rx('heartbeat')
+            elif pkttype == synth.HYT_TO_RADIO:
+                # Acknowledge messages from hylink
+                self._count_rx('toRadio')
+                self._send(link, synth.ack_frame(seq), 'ack')
+            else:
+                self._count_rx('other')
+
+    def _count_rx(self, kind):
+        received = self.stats['received']
+        received[kind] = received.get(kind, 0) + 1
+
+    def _sample(self, name, value):
+        samples = self.stats[name]
+        if len(samples) < MAX_LATENCY_SAMPLES:
+            samples.append(value)
+
+    ################################
+    # Delivery (attached ADKSockets -- called on their dispatcher threads)
+    ################################
+
+    def _delivered(self, key):
+        sent = self._sentAt.pop(key, None)
+        if sent is None:
+            return
+        self._sample('deliveryLatency', self.clock.monotonic() - sent)
+        delivered = self.stats['delivered']
+        delivered[key[0]] = delivered.get(key[0], 0) + 1
+
+    def _delivered_msg(self, p):
+        self._delivered(('rcp', p.rptHeader.synRepeaterRadioID, p.hytSeqID))
+
+    def _delivered_rtp(self, p):
+        if isinstance(p, RTPPacket):
+            self._delivered(('rtp', p.ssrc, p.seq))
+
+    ################################
+    # Reporting
+    ################################
+
+    def _reset_stats(self):
+        self.stats = {
+            'sent': {}, 'received': {}, 'delivered': {},
+            'lost': 0, 'duplicated': 0, 'reordered': 0, 'sendErrors': 0,
+            'ackLatency': [], 'deliveryLatency': [],
+            'maxLag': 0.,
+        }
+        # Forget anything still outstanding from the last run
+        for r in self.repeaters:
+            for link in r.links:
+                link.pending.clear()
+        self._sentAt.clear()
+
+    def _report(self, elapsed):
+        s = self.stats
+        sentRcp = s['sent'].get('rcp', 0)
+        sentRtp = s['sent'].get('rtp', 0)
+        report = {
+            'duration': elapsed,
+            'repeaters': len(self.repeaters),
+            'connected': sum(1 for r in self.repeaters if all(link.connected for link in r.links)),
+            'rates': {'rtp': self.rtpRate, 'rcp': self.rcpRate},
+            'sent': dict(s['sent']),
+            'received': dict(s['received']),
+            'impairments': {'lost': s['lost'], 'duplicated': s['duplicated'], 'reordered': s['reordered']},
+            'send_errors': s['sendErrors'],
+            'offered_pps': (sentRcp + sentRtp) / elapsed,
+            'ack_latency_us': _percentiles(s['ackLatency']),
+            'unacked': sum(len(link.pending) for r in self.repeaters for link in r.links),
+            'max_lag_ms': s['maxLag'] * 1e3,
+        }
+        if self._attached:
+            delivered = dict(s['delivered'])
+            report['delivered'] = delivered
+            report['delivered_pps'] = sum(delivered.values()) / elapsed
+            report['delivery_ratio'] = sum(delivered.values()) / max(1, sentRcp + sentRtp)
+            report['delivery_latency_us'] = _percentiles(s['deliveryLatency'])
+        return report
+
+
+def _print_report(report):
+    print("%d/%d repeaters connected, rates rtp %.0f/s rcp %.0f/s per repeater, %.1f s" %
+          (report['connected'], report['repeaters'], report['rates']['rtp'], report['rates']['rcp'],
+           report['duration']))
+    print("  offered    %10.0f packets/s   sent %s" % (report['offered_pps'], report['sent']))
+    if 'delivered_pps' in report:
+        print("  delivered  %10.0f packets/s   (%.2f%%) %s" %
+              (report['delivered_pps'], report['delivery_ratio'] * 100, report['delivered']))
+    for name in ('ack_latency_us', 'delivery_latency_us'):
+        p = report.get(name)
+        if p:
+            print("  %-20s p50 %.0f  p90 %.0f  p99 %.0f  max %.0f" % (name, p['p50'], p['p90'], p['p99'], p['max']))
+    print("  unacked %d, impairments %s, simulator max lag %.1f ms" %
+          (report['unacked'], report['impairments'], report['max_lag_ms']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate Hytera repeaters talking to a hylink application")
+    parser.add_argument('--repeaters', '-n', type=int, default=1, help="Number of repeaters to simulate")
+    parser.add_argument('--rtp-rate', type=float, default=50., help="RTP frames/s per repeater (default 50)")
+    parser.add_argument('--rcp-rate', type=float, default=1., help="RCP broadcasts/s per repeater (default 1)")
+    parser.add_argument('--duration', '-d', type=float, default=10., help="Seconds to run each step")
+    parser.add_argument('--loss', type=float, default=0., help="Probability of losing a datagram")
+    parser.add_argument('--duplicate', type=float, default=0., help="Probability of duplicating a datagram")
+    parser.add_argument('--reorder', type=float, default=0., help="Probability of reordering a datagram")
+    parser.add_argument('--external', metavar='HOST', help="Load-test a hylink application on this host, instead "
+                                                           "of an ADKSocket in this process")
+    parser.add_argument('--rcp-port', type=int, default=0, help="hylink RCP port (default: any free port)")
+    parser.add_argument('--rtp-port', type=int, default=0, help="hylink RTP port (default: any free port)")
+    parser.add_argument('--no-rtp', action='store_true', help="Don't send RTP")
+    parser.add_argument('--sweep', action='store_true',
+                        help="Double the rates each step until less than 99%% of packets are delivered")
+    parser.add_argument('--max-steps', type=int, default=10, help="Maximum number of sweep steps")
+    parser.add_argument('--json', action='store_true', help="Print the reports as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)-7s] (%(threadName)s) %(message)s', level=logging.WARNING)
+
+    sockets = []
+    host = args.external
+    rcpPort, rtpPort = args.rcp_port, None if args.no_rtp else args.rtp_port
+    if host is None:
+        from .socket import ADKSocket
+
+        host = '127.0.0.1'
+        ports = []
+        for port in (rcpPort, rtpPort):
+            if port is None:
+                ports.append(None)
+                continue
+            if port == 0:
+                s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                s.bind((host, 0))
+                port = s.getsockname()[1]
+                s.close()
+            sockets.append(ADKSocket(port, name="SimTarget", host=host, rcvbuf=8 << 20))
+            ports.append(port)
+        rcpPort, rtpPort = ports
+    elif rcpPort == 0 or rtpPort == 0:
+        parser.error("--rcp-port and --rtp-port (or --no-rtp) are required with --external")
+
+    sim = RepeaterSimulator(host, rcpPort, rtpPort, repeaters=args.repeaters, rtpRate=args.rtp_rate,
+                            rcpRate=args.rcp_rate, loss=args.loss, duplicate=args.duplicate, reorder=args.reorder)
+    for s in sockets:
+        sim.attach(s)
+
+    reports = []
+    try:
+        scale = 1
+        for _ in range(args.max_steps if args.sweep else 1):
+            sim.set_rates(args.rtp_rate * scale, args.rcp_rate * scale)
+            report = sim.run(args.duration)
+            reports.append(report)
+            if not args.json:
+                _print_report(report)
+            if args.sweep and report.get('delivery_ratio', 1.) < 0.99:
+                break
+            scale *= 2
+    finally:
+        sim.close()
+        for s in sockets:
+            s.stop()
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -4,38 +4,73 @@ ADK Repeater Interface
 
 Socket protocol helper
 
+One ADKSocket can serve any number of repeaters. Each repeater which sends us a SYN gets its own
+RepeaterConnection, which holds its sequence counter, pending-ack table, watchdog deadline and heartbeat
+schedule. Connections are looked up by socket address (for incoming packets) or repeater radio ID.
+
 TODO: Implement retry timer for HSTRPToRadio (dispatch -> radio message)
     The radio should ack these. Keep retrying every {T} seconds until it does, or until {R} retries
     (e.g. 2 seconds and 5 retries)
 
-TODO: Review the log messages, log switches and other debugging code. Aim to reduce the log spam a bit.
+Logging: general messages go to the 'hylink.socket' logger. Per-packet messages go to child loggers which
+are set to INFO by default, so they stay quiet until enabled -- e.g.
+logging.getLogger('hylink.socket.rx').setLevel(logging.DEBUG):
+
+    hylink.socket.rx            Packets received
+    hylink.socket.tx            Packets transmitted
+    hylink.socket.heartbeat     SYNs, ACKs and heartbeats (rx)
+    hylink.socket.ignored       Packets from repeaters which aren't connected
+
+Each socket also keeps the last few datagrams in a PacketTrace ring buffer (see hylink.trace), which is
+dumped to the 'hylink.socket.trace' logger at DEBUG level when a packet fails to decode. For a complete
+record of the traffic, set_capture() writes every datagram to a pcapng file (see hylink.capture).
+
+Session resumption: if an ADKSocket is given a state file, it saves its sessions (repeater address, radio
+ID, timeslot and sequence counter) there, and resumes them when it's next started. After a restart, the
+repeaters keep sending heartbeats rather than SYNs -- without the saved state they would be ignored until
+the repeaters gave up and reconnected, which takes about a minute. A resumed session is live straight
+away; if its repeater doesn't send anything within RESUME_TIMEOUT, it's dropped and the socket waits for
+a SYN as usual.
 
-TODO: Keep track of more than one repeater -- track them via Radio ID or IP address.
-    Will need to refactor the socket interface to manage the state of more than one repeater.
-    Possibly add a RepeaterConnection class on top of
+Timers (heartbeats, the watchdog, ACK timeouts and transmit deadlines) run on a hylink.clock.Clock, which
+can be swapped for a VirtualClock to fast-forward through them in tests and simulations.
 
-TODO: Higher-level repeater interface to sit on top of this (and make programming easier and more Pythonic)
+To drop traffic from unexpected hosts before it's decoded, and rate-limit the logging of undecodable
+datagrams, attach an IngressFilter with set_ingress_filter() (see hylink.ingress).
+
+For a higher-level, event-driven interface to a repeater, see hylink.session.RepeaterSession.
 
 """
 
+import json
 import os
 import queue
 import socket
 import select
 import threading
+from enum import IntEnum
 
+from . import metrics
+from .clock import SYSTEM_CLOCK
+from .dispatch import CallbackDispatcher, PacketClass
 from .packet import *
+from .profiling import Stage
+from .queues import LaneQueue, OverflowPolicy
+from .receiver import BatchReceiver, RX_MAX_DATAGRAM, RX_BATCH_SIZE
 from .rtp import RTPPacket
+from .trace import LazyHex, PacketTrace, PACKET_TRACE_SIZE
 
 log = logging.getLogger(__name__)
 
-# Log packets being tx'd/rx'd
-LOG_PACKET_RX = False
-LOG_PACKET_TX = False
-# Log heartbeats
-LOG_HEARTBEATS = False
-# Log non-SYN packets in DISCONNECTED state
-LOG_NONSYN = False
+# Per-packet loggers -- quiet unless their level is lowered to DEBUG
+log_rx = logging.getLogger(__name__ + '.rx')
+log_tx = logging.getLogger(__name__ + '.tx')
+log_heartbeat = logging.getLogger(__name__ + '.heartbeat')
+log_ignored = logging.getLogger(__name__ + '.ignored')
+log_trace = logging.getLogger(__name__ + '.trace')
+for _l in (log_rx, log_tx, log_heartbeat, log_ignored, log_trace):
+    if _l.level == logging.NOTSET:
+        _l.setLevel(logging.INFO)
 
 
 # Terminate the connection if there are no packets received in this amount of time (seconds)
@@ -44,61 +79,250 @@ HEARTBEAT_TIMEOUT = 30
 # Interval (in seconds) between heartbeats
 HEARTBEAT_INTERVAL = 2
 
+# Maximum interval (in seconds) between checks of the heartbeat schedules and watchdogs
+HOUSEKEEPING_INTERVAL = 0.5
 
-class Watchdog(object):
-    """ Watchdog timer """
+# Sessions saved more than this long ago (seconds) aren't resumed -- a repeater whose heartbeats go
+# unanswered goes back to sending SYNs after about a minute
+RESUME_MAX_AGE = 90
 
-    def __init__(self, timeout, user_handler=None):  # timeout in seconds
-        """ Create a Watchdog Timer """
-        self.timeout = timeout
-        self.handler = user_handler if user_handler is not None else self.default_handler
-        self.timer = threading.Timer(self.timeout, self.handler)
+# A resumed session is dropped if the repeater doesn't send anything within this time (seconds)
+RESUME_TIMEOUT = 10
 
-    def reset(self):
-        """ Restart the timer """
-        self.timer.cancel()
-        self.timer = threading.Timer(self.timeout, self.handler)
-        self.timer.start()
+# Sequence IDs skipped when a session is resumed, in case packets were sent after the state was last saved
+RESUME_SEQ_SKIP = 1024
 
-    def stop(self):
-        """ Stop the watchdog """
-        self.timer.cancel()
+# Interval (in seconds) between state file saves while sequence counters are changing
+STATE_SAVE_INTERVAL = 5
+
+_STATE_VERSION = 1
+
+# Minimum interval (in seconds) between log messages about packets which couldn't be sent
+TX_ERROR_LOG_INTERVAL = 10
 
-    def default_handler(self):
-        """ Default watchdog handler """
-        raise self
+# Default time (in seconds) after which a queued RTP frame is stale and will be dropped instead of sent
+RTP_TX_DEADLINE = 0.06
+
+
+class TxLane(IntEnum):
+    """ Transmit priority lanes, highest priority first """
+    ACK         = 0         # ACK and SYN-ACK
+    RTP         = 1         # RTP voice
+    RCP         = 2         # Commands to the repeater (HSTRPToRadio)
+    HEARTBEAT   = 3         # Heartbeats
+
+
+# Maximum depth and overflow policy of each transmit lane
+TX_LANE_DEPTHS = {
+    TxLane.ACK:         256,
+    TxLane.RTP:         64,         # 64 frames is ~1.3 seconds of audio
+    TxLane.RCP:         256,
+    TxLane.HEARTBEAT:   16,
+}
+TX_LANE_POLICIES = {
+    TxLane.ACK:         OverflowPolicy.DROP_OLDEST,
+    TxLane.RTP:         OverflowPolicy.DROP_OLDEST,
+    TxLane.RCP:         OverflowPolicy.BLOCK,       # Never drop commands, make the sender wait instead
+    TxLane.HEARTBEAT:   OverflowPolicy.DROP_NEWEST,
+}
+
+
+class RepeaterConnection(object):
+    """ Connection state for one repeater attached to an ADKSocket """
+
+    def __init__(self, addr, radioID=None, timeslot=None, seq=0, clock=None):
+        """
+        Create a repeater connection
+
+        :param addr: Socket address (host, port) of the repeater
+        :param radioID: Repeater radio ID, from the SYN
+        :param timeslot: Repeater timeslot, from the SYN
+        :param seq: Initial sequence ID
+        :param clock: hylink.clock.Clock the socket's timers run on (defaults to the system clock)
+        """
+        self.addr = addr
+        self.radioID = radioID
+        self.timeslot = timeslot
+
+        # Sequence counter
+        self._seq = seq
+        self._seqLock = threading.Lock()
+
+        # Pending-ack table (seq -> callback) and ack queue for blocking sends
+        self.ackCallbacks = {}
+        self.ackQueue = queue.Queue()
+        # Transmit times of packets waiting for an ACK (seq -> clock monotonic()), for the ACK RTT metric
+        self.ackSent = {}
+
+        # Watchdog deadline and heartbeat schedule (clock monotonic() values)
+        now = (clock if clock is not None else SYSTEM_CLOCK).monotonic()
+        self.lastRx = now
+        self.nextHeartbeat = now + HEARTBEAT_INTERVAL
+
+        self.connected = True
+        # True if the connection was restored from the state file, and the repeater hasn't been heard from since
+        self.resumed = False
+
+    def __repr__(self):
+        return "<%s: addr %s, radio ID %s, timeslot %s%s%s>" % \
+               (type(self).__name__, self.addr, self.radioID, self.timeslot,
+                ", resumed" if self.resumed else "", "" if self.connected else ", disconnected")
+
+    def next_seq(self):
+        """ Get the sequence ID then increment it """
+        with self._seqLock:
+            x = self._seq
+            self._seq = (self._seq + 1) & 0xFFFF
+        return x
+
+    def peek_seq(self):
+        """ Get the next sequence ID, without incrementing it """
+        return self._seq
+
+    def reset_seq(self, seq):
+        """ Reset the sequence ID (e.g. on receipt of a SYN) """
+        with self._seqLock:
+            self._seq = seq & 0xFFFF
+
+    def rx_activity(self, now):
+        """ A packet was received from the repeater -- push back the watchdog """
+        self.lastRx = now
+
+    def tx_activity(self, now):
+        """ A packet was sent to the repeater -- push back the next heartbeat """
+        self.nextHeartbeat = now + HEARTBEAT_INTERVAL
+
+    def expired(self, now):
+        """
+        Returns True if the watchdog has expired (no packets for HEARTBEAT_TIMEOUT seconds, or RESUME_TIMEOUT
+        seconds for a resumed connection the repeater hasn't answered)
+        """
+        return (now - self.lastRx) >= (RESUME_TIMEOUT if self.resumed else HEARTBEAT_TIMEOUT)
 
 
 class ADKSocket(object):
 
-    def __init__(self, port, name="ADKSocket", host=''):
-        # Initialise sequence ID and repeater ID
-        self._seq = 0
-        self._repeaterAddr = None
+    def __init__(self, port, name="ADKSocket", host='', max_datagram=RX_MAX_DATAGRAM, rx_batch=RX_BATCH_SIZE,
+                 rcvbuf=None, reuse_port=False, dispatcher=None, profiler=None, trace_size=PACKET_TRACE_SIZE,
+                 state_file=None, clock=None):
+        """
+        Create an ADK socket and start its receive and transmit threads.
+
+        :param port: UDP port number to bind
+        :param name: Name used for the rx/tx thread names
+        :param host: Local address to bind
+        :param max_datagram: Size of each receive buffer (largest datagram which can be received)
+        :param rx_batch: Maximum number of datagrams to process on each receive wakeup
+        :param rcvbuf: Kernel receive buffer size (SO_RCVBUF), or None to leave the system default
+        :param reuse_port: Set SO_REUSEPORT, so several processes can bind the same port (see hylink.workers)
+        :param dispatcher: CallbackDispatcher which runs the msg/RTP callbacks. If None, the socket creates its
+            own with one worker thread. A dispatcher may be shared between sockets.
+        :param profiler: Optional hylink.profiling.StageProfiler to time the rx/tx pipeline stages
+        :param trace_size: Number of datagrams kept in the packet trace ring buffer (0 to disable)
+        :param state_file: File to save sessions in, so they can be resumed after a restart (None to disable).
+            Each socket needs its own file.
+        :param clock: hylink.clock.Clock for the protocol timers (defaults to the system clock; see VirtualClock)
+        """
+        self.port = port
+        self.clock = clock if clock is not None else SYSTEM_CLOCK
+
+        # Repeater connections, keyed by socket address and by repeater radio ID
+        self._sessions = {}
+        self._sessionsById = {}
+        self._sessionLock = threading.Lock()
+        # Most recently connected repeater -- used when send() isn't told which repeater to talk to
+        self._defaultSession = None
+        # Radio IDs of every repeater which has ever connected (to spot reconnections)
+        self._seenRepeaters = set()
 
         # Initialise default ACK timeout
         self.ackTimeout = 2
 
+        # RTP frames which have been queued for longer than this (seconds) are dropped instead of sent
+        self.rtpDeadline = RTP_TX_DEADLINE
+
+        # Number of packets dropped because the repeater wasn't connected
+        self.txDroppedDisconnected = 0
+        self._warnedDisconnected = False
+
+        # When a transmit error was last logged (clock monotonic()), and the errors since then which weren't
+        self._txErrorLogged = None
+        self._txErrorsSuppressed = 0
+
         # Initialise callbacks
         self._rcpRxCallback = None
         self._rtpRxCallback = None
 
+        # Listeners -- these are called in addition to the callbacks, and there can be any number of them
+        self._msgListeners = []
+        self._rtpListeners = []
+        self._connListeners = []
+
+        # Callbacks run on the dispatcher's threads, so a slow callback doesn't hold up the receive thread
+        if dispatcher is None:
+            self._dispatcher = CallbackDispatcher(name="%s-cb.%d" % (name, port))
+            self._ownDispatcher = True
+        else:
+            self._dispatcher = dispatcher
+            self._ownDispatcher = False
+
         # Create a pipe to use for killing the rx thread
         self._r_pipe, self._w_pipe = os.pipe()
 
-        # Create the transmit queue
-        self._txqueue = queue.Queue()
+        # Ring buffer of recent raw datagrams (None if disabled)
+        self.packetTrace = PacketTrace(trace_size, "%s.%d" % (name, port)) if trace_size else None
+
+        # Capture tap interface (None if not capturing -- see set_capture)
+        self._name = name
+        self._capture = None
+
+        # Ingress filter (None to accept everything -- see set_ingress_filter)
+        self._ingress = None
+
+        # Hot-path profiler (None if disabled), and the trace of the packet the rx thread is handling (if sampled)
+        self._profiler = profiler
+        self._rxTrace = None
+
+        # Session state file (None if disabled), whether the sessions have changed since it was saved, when
+        # it was last saved (clock monotonic()), and the sequence counters saved
+        self.stateFile = state_file
+        self._stateDirty = False
+        self._stateSaved = 0
+        self._stateSeqs = {}
 
-        # Create the ack queue and callback table
-        self._ackqueue = queue.Queue()
-        self._ackcallbacks = {}
+        # Create the transmit scheduler. Entries are (packet, RepeaterConnection, profiler trace) tuples.
+        self._txqueue = LaneQueue([TX_LANE_DEPTHS[x] for x in TxLane], [TX_LANE_POLICIES[x] for x in TxLane],
+                                  self.clock)
 
         # Open the socket
+        if reuse_port and not hasattr(socket, 'SO_REUSEPORT'):
+            raise OSError("SO_REUSEPORT is not supported on this platform")
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self._sock.bind((host, port))
 
-        # Set up the Heartbeat timer
-        self._wdt = Watchdog(HEARTBEAT_TIMEOUT, self._heartbeat_expired)
+        # Set up the batched receiver (switches the socket to non-blocking mode)
+        self._receiver = BatchReceiver(self._sock, max_datagram=max_datagram, batch_size=rx_batch, rcvbuf=rcvbuf)
+
+        # Set up the metrics, and publish them in the global registry
+        self.metrics = metrics.SocketMetrics()
+        self.metrics.gauges.update({
+            'sessions': lambda: len(self._sessions),
+            'rx_truncated': lambda: self._receiver.truncated,
+            'tx_queue_depth': lambda: {x.name: self._txqueue.depth(x) for x in TxLane},
+            'tx_dropped': lambda: {x.name: self._txqueue.dropped[x] for x in TxLane},
+            'tx_expired': lambda: {x.name: self._txqueue.expired[x] for x in TxLane},
+            'tx_dropped_disconnected': lambda: self.txDroppedDisconnected,
+            'dispatch_queue_depth': lambda: {k: v['depth'] for k, v in self._dispatcher.stats().items()},
+            'dispatch_dropped': lambda: {k: v['dropped'] for k, v in self._dispatcher.stats().items()},
+        })
+        self._metricsName = "%s.%d" % (name, port)
+        metrics.REGISTRY.register(self._metricsName, self.metrics)
+
+        # Pick up where the last run left off
+        if state_file is not None:
+            self._resume()
 
         # Create and start the receive and transmit threads
         self._running = False
@@ -107,19 +331,70 @@ class ADKSocket(object):
         self._rxthread.start()
         self._txthread.start()
 
-    def is_connected(self):
-        """ Returns true if the repeater is connected, otherwise false """
-        return self._repeaterAddr is not None
+    def is_connected(self, repeater=None):
+        """
+        Returns true if the repeater is connected, otherwise false
+
+        If 'repeater' is None, returns true if any repeater is connected.
+        """
+        if repeater is None:
+            return len(self._sessions) > 0
+        return self.get_session(repeater) is not None
+
+    def sessions(self):
+        """ Return a list of the currently connected repeaters """
+        with self._sessionLock:
+            return list(self._sessions.values())
+
+    def get_session(self, repeater=None):
+        """
+        Find a connected repeater.
+
+        :param repeater: A RepeaterConnection, a socket address tuple, or a repeater radio ID.
+            If None, the most recently connected repeater is returned.
+        :return: The RepeaterConnection, or None if the repeater isn't connected.
+        """
+        if repeater is None:
+            conn = self._defaultSession
+        elif isinstance(repeater, RepeaterConnection):
+            conn = repeater
+        elif isinstance(repeater, tuple):
+            conn = self._sessions.get(repeater)
+        else:
+            conn = self._sessionsById.get(repeater)
 
-    def send(self, packet, callback=None):
-        """ Send a packet to the repeater """
+        if conn is not None and conn.connected:
+            return conn
+        return None
+
+    def send(self, packet, callback=None, repeater=None):
+        """
+        Send a packet to a repeater
+
+        :param packet: Packet to send (HYTPacket subclass or RTPPacket). An RTP frame which has already been
+            serialised can be passed as bytes or bytearray (it mustn't be modified after it's been queued).
+        :param callback: Ack callback for HSTRPToRadio packets, called on the callback dispatcher as callback(seq)
+            when the packet is acked, or callback(None) if it couldn't be sent. If None, send() blocks until the
+            packet is acked.
+        :param repeater: Repeater to send to (see get_session). Defaults to the most recently connected repeater.
+        """
         if packet is None:
             raise ValueError("Cannot send a null packet")
 
+        conn = self.get_session(repeater)
+        if conn is None:
+            # Only warn once per disconnection, rather than once per packet
+            self.txDroppedDisconnected += 1
+            if not self._warnedDisconnected:
+                self._warnedDisconnected = True
+                log.warning("Can't send -- not connected to repeater %s. Dropping packets until it connects.",
+                            repeater)
+            return None
+
         # Is this an RTP packet?
-        if isinstance(packet, RTPPacket):
+        if isinstance(packet, (RTPPacket, bytes, bytearray)):
             # RTP packet -- send as is. Doesn't require acknowledgement.
-            self._txqueue.put(packet)
+            self._enqueue(packet, conn, TxLane.RTP)
             return None
 
         # Will this packet result in an acknowledgement?
@@ -128,81 +403,278 @@ class ADKSocket(object):
             ack_req = True
 
         # Hytera form packet -- update the sequence ID
-        packet.hytSeqID = self._getseq()
+        packet.hytSeqID = conn.next_seq()
         # If ack callback is needed, store it in the sequence list
         if ack_req and (callback is not None):
-            self._ackcallbacks[packet.hytSeqID] = callback
+            conn.ackCallbacks[packet.hytSeqID] = callback
         # Send the packet
-        self._txqueue.put(packet)
+        if isinstance(packet, (HSTRPAck, HSTRPSynAck)):
+            self._enqueue(packet, conn, TxLane.ACK)
+        elif isinstance(packet, HSTRPHeartbeat):
+            self._enqueue(packet, conn, TxLane.HEARTBEAT)
+        else:
+            self._enqueue(packet, conn, TxLane.RCP)
 
         # If this is a blocking operation -- wait for the ack
         if ack_req and (callback is None):
             # Wait for the Ack
-            ackn = self.wait_ack(self.ackTimeout)
-            log.debug("  Blocking send acknowledged, sent seq=%d, ack=%d" % (packet.hytSeqID, ackn))
+            ackn = self.wait_ack(self.ackTimeout, conn)
+            log.debug("  Blocking send acknowledged, sent seq=%d, ack=%s", packet.hytSeqID, ackn)
             # TODO validate the sequence number of the acknowledgement
 
         return packet.hytSeqID
 
-    def _heartbeat_expired(self):
+    def _enqueue(self, packet, conn, lane):
+        """ Add a packet to a transmit lane. RTP frames are given a deadline. """
+        deadline = None
+        if lane == TxLane.RTP and self.rtpDeadline is not None:
+            deadline = self.clock.monotonic() + self.rtpDeadline
+        trace = self._profiler.sample('tx') if self._profiler is not None else None
+        return self._txqueue.put((packet, conn, trace), lane, deadline)
+
+    def _connect(self, addr, syn):
+        """ Create (or reset) the connection for a repeater which has sent us a SYN """
+        radioID = syn.rptHeader.synRepeaterRadioID
+        old = None
+
+        with self._sessionLock:
+            conn = self._sessions.get(addr)
+            if conn is None:
+                # A repeater which reconnects from a different address replaces its old connection
+                old = self._sessionsById.get(radioID) if radioID is not None else None
+                if old is not None:
+                    log.info("Repeater id %d moved from %s to %s", radioID, old.addr, addr)
+                    self._remove_session(old)
+
+                conn = RepeaterConnection(addr, radioID, syn.rptHeader.synTimeslot, clock=self.clock)
+                self._sessions[addr] = conn
+            else:
+                conn.radioID = radioID
+                conn.timeslot = syn.rptHeader.synTimeslot
+
+            if radioID is not None:
+                self._sessionsById[radioID] = conn
+                if radioID in self._seenRepeaters:
+                    self.metrics.reconnects += 1
+                self._seenRepeaters.add(radioID)
+            self._defaultSession = conn
+            self.metrics.connects += 1
+            self._warnedDisconnected = False
+            self._stateDirty = True
+
+        if self._ingress is not None:
+            self._ingress.learn_host(addr[0])
+
+        # Notify the listeners outside the lock
+        if old is not None:
+            self._notify_connection(old, False)
+        self._notify_connection(conn, True)
+
+        return conn
+
+    def _remove_session(self, conn):
+        """ Remove a connection from the session tables. Caller must hold _sessionLock. """
+        conn.connected = False
+        self._stateDirty = True
+        if self._sessions.get(conn.addr) is conn:
+            del self._sessions[conn.addr]
+        if conn.radioID is not None and self._sessionsById.get(conn.radioID) is conn:
+            del self._sessionsById[conn.radioID]
+        if self._defaultSession is conn:
+            # Fall back to any other connected repeater
+            self._defaultSession = next(iter(self._sessions.values()), None)
+
+    def _heartbeat_expired(self, conn):
         """
-        Called by the Watchdog task when we haven't received a packet in a while.
+        Called by the transmit thread when we haven't received a packet from a repeater in a while.
         """
-        log.error("WATCHDOG: No packets in %d seconds -- disconnecting" % HEARTBEAT_TIMEOUT)
-        self._repeaterAddr = None
+        if conn.resumed:
+            log.warning("Resumed session %s wasn't answered in %d seconds -- waiting for a SYN", conn, RESUME_TIMEOUT)
+        else:
+            log.error("WATCHDOG: No packets from %s in %d seconds -- disconnecting", conn, HEARTBEAT_TIMEOUT)
+            self.metrics.watchdogExpiries += 1
+        with self._sessionLock:
+            self._remove_session(conn)
+        self._notify_connection(conn, False)
+
+    def _notify_connection(self, conn, connected):
+        """ Pass a connect/disconnect event to the connection listeners """
+        if self._connListeners:
+            # The events queue never blocks -- this is called from the transmit thread (by the watchdog)
+            self._dispatcher.submit(PacketClass.EVENT, self._deliver_connection, (conn, connected))
+
+    def _deliver_connection(self, event):
+        for listener in list(self._connListeners):
+            listener(*event)
+
+    def _submit(self, pclass, fn, p):
+        """ Pass a received packet to the callback dispatcher """
+        trace = self._rxTrace
+        if trace is None:
+            return self._dispatcher.submit(pclass, fn, p)
+
+        # Sampled packet -- the dispatcher's worker finishes the trace
+        self._rxTrace = None
+        trace.info = p
+        return self._dispatcher.submit(pclass, lambda x: self._deliver_traced(fn, x, trace), p)
+
+    def _deliver_traced(self, fn, p, trace):
+        trace.mark(Stage.DISPATCH_WAIT)
+        try:
+            fn(p)
+        finally:
+            trace.mark(Stage.CALLBACK)
+            self._profiler.finish(trace)
+
+    def _deliver_msg(self, p):
+        for listener in list(self._msgListeners):
+            listener(p)
+        if self._rcpRxCallback is not None:
+            self._rcpRxCallback(p)
+
+    def _deliver_rtp(self, p):
+        for listener in list(self._rtpListeners):
+            listener(p)
+        if self._rtpRxCallback is not None:
+            self._rtpRxCallback(p)
 
     def stop(self):
         """ Shut down the tx/rx threads """
-        # Stop the watchdog timer
-        self._wdt.stop()
-
         # Shut down the tx thread
-        self._txqueue.put(None)
+        self._txqueue.close()
 
         # Shut down the rx thread and join it
         self._running = False
         os.write(self._w_pipe, "I".encode())    # data isn't important
         self._rxthread.join()
+        self._txthread.join()
+
+        if self.stateFile is not None:
+            self._save_state_safe()
+
+        # Shut down the callback dispatcher, unless it's shared with other sockets
+        if self._ownDispatcher:
+            self._dispatcher.stop()
+
+        metrics.REGISTRY.unregister(self._metricsName)
 
     # Shutdown method is from:
     # https://stackoverflow.com/questions/7449247/how-do-i-abort-a-socket-recvfrom-from-another-thread-in-python
 
-    def _getseq(self):
-        """ Get the sequence ID then increment it """
-        x = self._seq
-        self._seq = (self._seq + 1) & 0xFFFF
-        return x
+    def _housekeeping(self, now):
+        """
+        Check every repeater's watchdog and heartbeat schedule.
+
+        Heartbeats are only sent to repeaters which haven't had any other packet from us for HEARTBEAT_INTERVAL,
+        so a packet will be sent at least once every HEARTBEAT_INTERVAL to keep each connection alive.
+        """
+        for conn in self.sessions():
+            # Forget transmit times of packets which were never acknowledged
+            if conn.ackSent:
+                for seq, sent in list(conn.ackSent.items()):
+                    if now - sent > HEARTBEAT_TIMEOUT:
+                        conn.ackSent.pop(seq, None)
+
+            if conn.expired(now):
+                self._heartbeat_expired(conn)
+            elif now >= conn.nextHeartbeat:
+                # Heartbeats go in the lowest-priority lane; any other packet keeps the connection alive too
+                self._enqueue(HSTRPHeartbeat(), conn, TxLane.HEARTBEAT)
+                conn.tx_activity(now)
+
+        # Save the sessions when they change, and now and then while the sequence counters are moving
+        if self.stateFile is not None and \
+                (self._stateDirty or now - self._stateSaved >= STATE_SAVE_INTERVAL):
+            self._save_state_safe(now)
+
+    def _transmit(self, p, conn, now):
+        """ Send a packet to a repeater """
+        log_tx.debug("Packet send: %s -> %s", p, conn.addr)
+
+        # Pre-serialised RTP frames (see send()) go out as they are
+        raw = isinstance(p, (bytes, bytearray))
+        data = p if raw else bytes(p)
+        try:
+            self._sock.sendto(data, conn.addr)
+        except OSError as e:
+            # The socket is non-blocking (see BatchReceiver), so a full kernel send buffer fails too. Nothing
+            # can be allowed to escape: ACKs are sent from the receive thread.
+            self._tx_error(p, conn, now, e)
+            return
+        conn.tx_activity(now)
+
+        if self.packetTrace is not None:
+            self.packetTrace.record('tx', conn.addr, data)
+        if self._capture is not None:
+            self._capture.record('tx', conn.addr, data)
+
+        pclass = 'RTPPacket' if raw else type(p).__name__
+        self.metrics.txPackets[pclass] += 1
+        self.metrics.txBytes[pclass] += len(data)
+        if isinstance(p, HSTRPToRadio):
+            conn.ackSent[p.hytSeqID] = now
+
+    def _tx_error(self, p, conn, now, e):
+        """ Handle a packet which couldn't be sent: count it, log it (rate-limited) and fail its ACK """
+        self.metrics.txErrors[type(e).__name__] += 1
+        if self._txErrorLogged is None or now - self._txErrorLogged >= TX_ERROR_LOG_INTERVAL:
+            if self._txErrorsSuppressed:
+                log.warning("Dropped packet to %s (%s): %s (and %d more send errors)",
+                            conn.addr, e, p, self._txErrorsSuppressed)
+            else:
+                log.warning("Dropped packet to %s (%s): %s", conn.addr, e, p)
+            self._txErrorLogged = now
+            self._txErrorsSuppressed = 0
+        else:
+            self._txErrorsSuppressed += 1
+
+        # There will be no ACK -- tell whoever is waiting for one now, rather than leaving them to time out
+        if isinstance(p, HSTRPToRadio):
+            callback = conn.ackCallbacks.pop(p.hytSeqID, None)
+            if callback is not None:
+                self._dispatcher.submit(PacketClass.EVENT, callback, None)
+            else:
+                conn.ackQueue.put(None)
 
     def _tx_thread_proc(self):
         """ Transmit thread function """
         log.debug("TxThread running")
 
+        clock = self.clock
+        next_housekeeping = clock.monotonic() + HOUSEKEEPING_INTERVAL
+
         while True:
             try:
-                p = self._txqueue.get(timeout=HEARTBEAT_INTERVAL)
+                item = self._txqueue.get(timeout=max(0., next_housekeeping - clock.monotonic()))
             except queue.Empty:
-                # Queue was empty for HEARTBEAT_INTERVAL, transmit a Heartbeat instead (but only if connected)
-                # This means a packet will be sent at least once every HEARTBEAT_INTERVAL to keep the connection alive.
-                if self._repeaterAddr is not None:
-                    p = HSTRPHeartbeat()
-                else:
-                    # Repeater not connected, don't send a heartbeat!
-                    continue
+                item = ()
 
-            # If there was a null/None in the queue, exit the loop and shut down the thread
-            if p is None:
+            # If the queue has been closed, exit the loop and shut down the thread
+            if item is None:
                 break
 
-            # Don't allow send if we're not connected to the repeater
-            if self._repeaterAddr is None:
-                log.warning("Can't send -- not connected to repeater. packet=%s" % p)
-                continue
+            now = clock.monotonic()
 
-            if LOG_PACKET_TX:
-                log.debug("Packet send: %s" % p)
+            if item:
+                p, conn, trace = item
 
-            # Send the packet
-            self._sock.sendto(bytes(p), self._repeaterAddr)
+                # Don't allow send if the repeater has disconnected since the packet was queued
+                if conn.connected:
+                    if trace is not None:
+                        trace.mark(Stage.TX_WAIT)
+                    self._transmit(p, conn, now)
+                    if trace is not None:
+                        trace.mark(Stage.SEND)
+                        trace.info = p
+                        self._profiler.finish(trace)
+                else:
+                    self.txDroppedDisconnected += 1
+                    log.debug("Can't send -- repeater %s disconnected. packet=%s", conn, p)
+
+            # Service heartbeats and watchdogs
+            if now >= next_housekeeping:
+                self._housekeeping(now)
+                next_housekeeping = now + HOUSEKEEPING_INTERVAL
 
         log.info("TxThread shutting down...")
 
@@ -212,131 +684,337 @@ class ADKSocket(object):
 
         log.debug("RxThread running")
 
+        prof = self._profiler
+
         while self._running:
+            wakeup = prof.sample('wakeup') if prof is not None else None
+
             # Trigger on either a byte in the pipe or a received packet.
             # The data in the pipe is ignored, but _running will be False so the 'continue' breaks us out of the loop.
             read, _w, errors = select.select([self._r_pipe, self._sock], [], [self._sock])
             if self._sock not in read:
                 continue
 
-            # Receive a packet
-            data, addr = self._sock.recvfrom(1024)
-            if data is None or len(data) == 0:
-                log.warning("Null Packet received -- %s from %s" % (data, addr))
-                continue
+            # Receive every datagram that's waiting, then process them as a batch
+            if wakeup is not None:
+                wakeup.mark(Stage.SELECT)
+            batch = self._receiver.drain()
+            if wakeup is not None:
+                wakeup.mark(Stage.RECV)
+                wakeup.info = '%d datagrams' % len(batch)
+                prof.finish(wakeup)
+
+            for data, addr in batch:
+                if prof is not None:
+                    self._rxTrace = prof.sample('rx')
+
+                # An exception mustn't stop the socket receiving from every other repeater
+                # noinspection PyBroadException
+                try:
+                    self._rx_packet(data, addr)
+                except Exception:
+                    log.exception("Error handling packet from %s", addr)
+
+                # Finish the trace, unless it was handed over to the dispatcher
+                if self._rxTrace is not None:
+                    self._rxTrace.mark(Stage.HANDLE)
+                    prof.finish(self._rxTrace)
+                    self._rxTrace = None
+
+        log.info("RxThread shutting down...")
 
-            # noinspection PyBroadException,PyPep8
+    def _decode(self, data, addr):
+        """ Decode a received datagram as a HYTPacket or RTPPacket. Returns None if it can't be decoded. """
+        # noinspection PyBroadException,PyPep8
+        try:
+            return HYTPacket.decode(data)
+        except HYTBadSignature:
+            # Bad Signature -- try to decode as RTP
+            # TODO - check if the radio is advertising RTP support for this port
             try:
-                p = HYTPacket.decode(data)
-            except HYTBadSignature:
-                # Bad Signature -- try to decode as RTP
-                # TODO - check if the radio is advertising RTP support for this port
-                p = RTPPacket(data)
-                log.debug("RTP packet received, %s" % p)
-
-                # Pass it onto the RTP callback, if any
-                if self._rtpRxCallback is not None:
-                    self._rtpRxCallback(p)
-            except:
-                # Garbage packet. Log it, then carry on
+                return RTPPacket(data)
+            except Exception as e:
+                self.metrics.decodeErrors[type(e).__name__] += 1
+                if self._ingress is None or self._ingress.decode_error(addr):
+                    log.error('Undecodable packet from %s (not HYT or RTP): { %s }', addr, LazyHex(data))
+                    self._dump_trace()
+                return None
+        except Exception as e:
+            # Garbage packet. Log it (unless the ingress filter says this source has had its share), then carry on
+            self.metrics.decodeErrors[type(e).__name__] += 1
+            if self._ingress is None or self._ingress.decode_error(addr):
                 log.exception('Exception in receive packet hander')
-                log.error('Packet data for preceding exception: { %s }' % ' '.join(['%02X' % x for x in data]))
-                continue
+                log.error('Packet data for preceding exception (from %s): { %s }', addr, LazyHex(data))
+                self._dump_trace()
+            return None
 
-            if LOG_PACKET_RX:
-                if (not isinstance(p, (HSTRPHeartbeat, HSTRPSyn, HSTRPAck))) or LOG_HEARTBEATS:
-                    log.debug("Packet received, addr='%s', data=%s" % (addr, p))
+    def _dump_trace(self):
+        """ Dump the packet trace (the datagrams leading up to a decode error), if trace logging is enabled """
+        if self.packetTrace is not None and log_trace.isEnabledFor(logging.DEBUG):
+            log_trace.debug("%s", self.packetTrace.dump())
 
-            # Non-SYN packet while disconnected? If so, ignore it.
-            if self._repeaterAddr is None and not isinstance(p, HSTRPSyn) and LOG_NONSYN:
-                log.warning("Ignored non-SYN packet while disconnected: %s" % p)
-                continue
+    ################################
+    # Session state file
+    ################################
 
-            # Is this a SYN?
-            if isinstance(p, HSTRPSyn):
-                log.debug("SYN... Repeater is id %d, sockaddr %s" % (p.rptHeader.synRepeaterRadioID, addr))
-
-                # Save the repeater address
-                self._repeaterAddr = addr
-
-                # SYN means we need to reset the sequence id
-                self._seq = p.hytSeqID
-
-                # Acknowledge the SYN with a SYN-ACK
-                p = HSTRPSynAck()
-                p.hytSeqID = self._getseq()
-                self._txqueue.put(p)
-
-                # At this point, the repeater will begin sending Heartbeat messages
-                #
-                # The repeater will give up and go back to sening SYNs when
-                # it's sent ten heartbeats on a 6-sec interval, without
-                # receiving a heartbeat from us.
-
-            # Is this a Heartbeat?
-            elif isinstance(p, HSTRPHeartbeat):
-                # Sequence ID always seems to be zero
-
-                # If we have an app crash and restart, the repeater will keep sending
-                # us Heartbeats, expecting us to reciprocate.
-                # As we don't know the repeater's identity (which is in the SYN)
-                # we ignore it until it times out and reverts to sending SYNs.
-
-                if self._repeaterAddr is not None:
-                    if LOG_HEARTBEATS:
-                        log.debug("   Heartbeat/keepalive received.")
-
-            # Is this an acknowledgement?
-            elif isinstance(p, HSTRPAck):
-                # Is there an ACK callback registered for this sequence ID?
-                if p.hytSeqID in self._ackcallbacks:
-                    # Callback registered, call it and remove it from the list
-                    self._ackcallbacks[p.hytSeqID](p.hytSeqID)
-                    del self._ackcallbacks[p.hytSeqID]
-                else:
-                    # No callback, put the ack in the queue (for waitAck)
-                    self._ackqueue.put(p.hytSeqID)
-
-            # Is this a message from the radio?
-            elif isinstance(p, HSTRPFromRadio):
-                # Don't ack the message if the repeater is not connected
-                if self._repeaterAddr is not None:
-                    # Acknowledge the message
-                    ack = HSTRPAck()
-                    ack.hytSeqID = p.hytSeqID
-                    self._txqueue.put(ack)
-                else:
-                    # Repeater not connected, discard the message
-                    log.debug("RX: Discarded packet (repeater not connected): %s" % p)
-                    continue
+    def save_state(self):
+        """
+        Save the sessions to the state file. The state is written to a temporary file which then replaces
+        the old one, so a crash never leaves a partial file behind. Called automatically when sessions
+        change, every STATE_SAVE_INTERVAL while they're active, and by stop().
+        """
+        sessions = self.sessions()
+        seqs = {c.addr: c.peek_seq() for c in sessions}
+        self._stateDirty = False
+        self._stateSaved = self.clock.monotonic()
+        if seqs == self._stateSeqs and os.path.exists(self.stateFile):
+            return
+        self._stateSeqs = seqs
+
+        state = {
+            'version': _STATE_VERSION,
+            'time': self.clock.time(),
+            'port': self.port,
+            'sessions': [{'addr': list(c.addr), 'radioID': c.radioID, 'timeslot': c.timeslot, 'seq': seqs[c.addr]}
+                         for c in sessions],
+        }
+        tmp = self.stateFile + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.stateFile)
+
+    def _save_state_safe(self, now=None):
+        # noinspection PyBroadException
+        try:
+            self.save_state()
+        except Exception:
+            log.exception("Error saving session state to %s", self.stateFile)
+            # Don't try again until the next interval
+            self._stateDirty = False
+            self._stateSaved = now if now is not None else self.clock.monotonic()
+
+    def _resume(self):
+        """ Restore the sessions saved in the state file by the last run """
+        try:
+            with open(self.stateFile) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            log.warning("Can't read session state from %s (%s) -- waiting for SYNs", self.stateFile, e)
+            return
+
+        if state.get('version') != _STATE_VERSION or state.get('port') != self.port:
+            log.warning("Session state in %s doesn't match this socket -- waiting for SYNs", self.stateFile)
+            return
+        age = self.clock.time() - state.get('time', 0)
+        if not 0 <= age <= RESUME_MAX_AGE:
+            log.info("Session state in %s is %.0f seconds old -- waiting for SYNs", self.stateFile, age)
+            return
+
+        now = self.clock.monotonic()
+        for s in state['sessions']:
+            addr = tuple(s['addr'])
+            conn = RepeaterConnection(addr, s['radioID'], s['timeslot'], (s['seq'] + RESUME_SEQ_SKIP) & 0xFFFF,
+                                      self.clock)
+            conn.resumed = True
+            # Send a heartbeat straight away, so the repeater knows we're back
+            conn.nextHeartbeat = now
+
+            with self._sessionLock:
+                self._sessions[addr] = conn
+                if conn.radioID is not None:
+                    self._sessionsById[conn.radioID] = conn
+                    self._seenRepeaters.add(conn.radioID)
+                self._defaultSession = conn
+            self.metrics.resumes += 1
+            log.info("Resumed session with %s from %s", conn, self.stateFile)
+            self._notify_connection(conn, True)
+
+    def set_capture(self, tap):
+        """
+        Write every datagram sent and received to a capture file.
 
-                # Pass the message onto the callback if there is one
-                if self._rcpRxCallback is not None:
-                    self._rcpRxCallback(p)
-                else:
-                    log.info("RX: No callback registered for packet: %s" % p)
+        :param tap: A hylink.capture.CaptureTap (which may be shared with other sockets), or None to stop capturing
+        """
+        if tap is None:
+            self._capture = None
+        else:
+            self._capture = tap.interface("%s.%d" % (self._name, self.port), self._sock.getsockname())
 
-            # Some other packet type?
-            else:
-                log.warning("Rx packet, unrecognised: %s" % p)
+    def set_ingress_filter(self, ingress):
+        """
+        Filter received datagrams by source address before decoding them, and rate-limit decode error logging.
 
-            # Start/Reset the watchdog timer (rx'd packet)
-            self._wdt.reset()
+        :param ingress: A hylink.ingress.IngressFilter (which may be shared with other sockets), or None to
+            accept everything
+        """
+        if ingress is not None:
+            # Repeaters which are already connected stay allowed
+            for addr in list(self._sessions):
+                ingress.learn_host(addr[0])
+        self._ingress = ingress
+
+    def dump_packet_trace(self, decode=True):
+        """ Return the packet trace (the most recent datagrams sent and received) formatted as a string """
+        if self.packetTrace is None:
+            return ''
+        return self.packetTrace.dump(decode)
+
+    def _rx_packet(self, data, addr):
+        """ Decode and handle a single received datagram """
+        # Drop unwanted traffic before doing anything else with it
+        if self._ingress is not None and not self._ingress.accept(data, addr):
+            return
+
+        if self.packetTrace is not None:
+            self.packetTrace.record('rx', addr, data)
+        if self._capture is not None:
+            self._capture.record('rx', addr, data)
+
+        if len(data) == 0:
+            log.warning("Null Packet received from %s", addr)
+            return
+
+        trace = self._rxTrace
+        if trace is not None:
+            self._profiler.begin_decode(trace)
+            try:
+                p = self._decode(data, addr)
+            finally:
+                self._profiler.end_decode()
+            trace.mark(Stage.DECODE)
+        else:
+            p = self._decode(data, addr)
+
+        if p is None:
+            return
+
+        # Find the connection for the repeater which sent this packet (None if it isn't connected). Only a
+        # packet which decodes pushes back its watchdog, so a stream of garbage can't keep a dead session alive.
+        conn = self._sessions.get(addr)
+        if conn is not None:
+            conn.rx_activity(self.clock.monotonic())
+            if conn.resumed:
+                conn.resumed = False
+                self.metrics.resumesConfirmed += 1
+                log.info("Resumed session %s answered by the repeater", conn)
+
+        pclass = type(p).__name__
+        self.metrics.rxPackets[pclass] += 1
+        self.metrics.rxBytes[pclass] += len(data)
+
+        if isinstance(p, RTPPacket):
+            p.repeater = conn
+            log_rx.debug("RTP packet received, %s", p)
+
+            # Pass it onto the RTP callback, if any
+            if self._rtpRxCallback is not None or self._rtpListeners:
+                if trace is not None:
+                    trace.mark(Stage.HANDLE)
+                self._submit(PacketClass.RTP, self._deliver_rtp, p)
+            return
+
+        if isinstance(p, (HSTRPHeartbeat, HSTRPSyn, HSTRPAck)):
+            log_heartbeat.debug("Packet received, addr='%s', data=%s", addr, p)
+        else:
+            log_rx.debug("Packet received, addr='%s', data=%s", addr, p)
+
+        # Is this a SYN?
+        if isinstance(p, HSTRPSyn):
+            log.debug("SYN... Repeater is id %s, sockaddr %s", p.rptHeader.synRepeaterRadioID, addr)
+
+            # Create or reset the connection for this repeater
+            conn = self._connect(addr, p)
+
+            # SYN means we need to reset the sequence id
+            conn.reset_seq(p.hytSeqID)
+
+            # Acknowledge the SYN with a SYN-ACK
+            p = HSTRPSynAck()
+            p.hytSeqID = conn.next_seq()
+            self._enqueue(p, conn, TxLane.ACK)
+
+            # At this point, the repeater will begin sending Heartbeat messages
+            #
+            # The repeater will give up and go back to sening SYNs when
+            # it's sent ten heartbeats on a 6-sec interval, without
+            # receiving a heartbeat from us.
+            return
+
+        # Non-SYN packet from a repeater which isn't connected? If so, ignore it.
+        if conn is None:
+            # If we have an app crash and restart, the repeater will keep sending
+            # us Heartbeats, expecting us to reciprocate.
+            # As we don't know the repeater's identity (which is in the SYN)
+            # we ignore it until it times out and reverts to sending SYNs --
+            # unless the session was restored from the state file (see _resume).
+            log_ignored.debug("Ignored non-SYN packet from disconnected repeater %s: %s", addr, p)
+            return
+
+        p.repeater = conn
+
+        # Is this a Heartbeat?
+        if isinstance(p, HSTRPHeartbeat):
+            # Sequence ID always seems to be zero
+            pass
+
+        # Is this an acknowledgement?
+        elif isinstance(p, HSTRPAck):
+            # Update the round trip time histogram
+            sent = conn.ackSent.pop(p.hytSeqID, None)
+            if sent is not None:
+                self.metrics.ackRtt.observe(self.clock.monotonic() - sent)
+
+            # Is there an ACK callback registered for this sequence ID?
+            callback = conn.ackCallbacks.pop(p.hytSeqID, None)
+            if callback is not None:
+                # Callback registered (it's already been removed from the list) -- call it on the dispatcher,
+                # so a slow callback doesn't hold up the receive thread
+                self._dispatcher.submit(PacketClass.EVENT, callback, p.hytSeqID)
+            else:
+                # No callback, put the ack in the queue (for waitAck)
+                conn.ackQueue.put(p.hytSeqID)
+
+        # Is this a message from the radio?
+        elif isinstance(p, HSTRPFromRadio):
+            # Acknowledge the message. ACKs are sent straight from the receive thread rather than queued.
+            if trace is not None:
+                trace.mark(Stage.HANDLE)
+            ack = HSTRPAck()
+            ack.hytSeqID = p.hytSeqID
+            self._transmit(ack, conn, self.clock.monotonic())
+            if trace is not None:
+                trace.mark(Stage.ACK)
+
+            # Pass the message onto the callback if there is one
+            if self._rcpRxCallback is not None or self._msgListeners:
+                self._submit(PacketClass.RCP, self._deliver_msg, p)
+            else:
+                log.info("RX: No callback registered for packet: %s", p)
 
-        log.info("RxThread shutting down...")
+        # Some other packet type?
+        else:
+            log.warning("Rx packet, unrecognised: %s", p)
 
-    def wait_ack(self, timeout=None):
+    def wait_ack(self, timeout=None, repeater=None):
         """
-        Wait for the next acknowledgement in the queue and return it
+        Wait for the next acknowledgement in a repeater's queue and return it
 
         Timeout = None is a blocking operation (returns when an ACK is received)
         Timeout = 0 is nonblocking (returns immediately)
         Timeout > 0 is blocking, with a timeout
+
+        'repeater' selects the repeater (see get_session); by default, the most recently connected repeater.
         """
+        conn = self.get_session(repeater)
+        if conn is None:
+            raise queue.Empty()
+
         if timeout is None or timeout > 0:
-            return self._ackqueue.get(timeout=timeout)
+            return self.clock.queue_get(conn.ackQueue, timeout)
         elif timeout == 0:
-            return self._ackqueue.get(block=False)
+            return conn.ackQueue.get(block=False)
         else:
             raise ValueError("Invalid timeout value, must be None or >= 0")
 
@@ -345,13 +1023,15 @@ class ADKSocket(object):
         Set the broadcast callback.
 
         The receive callback is called whenever the repeater sends a broadcast
-        or other unsolicited RCP packet (HSTRPFromRadio type).
+        or other unsolicited RCP packet (HSTRPFromRadio type). It is called
+        from the socket's CallbackDispatcher, not the receive thread.
 
         The callback should be defined as:
 
           def callback(packet):
 
-        "packet" is the HSTRPFromRadio packet.
+        "packet" is the HSTRPFromRadio packet. packet.repeater is the
+        RepeaterConnection of the repeater which sent it.
 
         :param callback: Callback function
 
@@ -363,15 +1043,67 @@ class ADKSocket(object):
         Set the RTP callback.
 
         The RTP callback is called whenever a packet of RTP audio data is
-        received.
+        received. It is called from the socket's CallbackDispatcher, and
+        frames may be dropped if the callback can't keep up.
 
         The callback should be defined as:
 
           def callback(packet):
 
-        "packet" is an rtp.RTPPacket instance.
+        "packet" is an rtp.RTPPacket instance. packet.repeater is the
+        RepeaterConnection of the repeater which sent it, or None if the
+        sender isn't connected.
 
         :param callback: Callback function
         """
         self._rtpRxCallback = callback
 
+    def add_msg_listener(self, listener):
+        """
+        Add a message listener.
+
+        Message listeners are called with every HSTRPFromRadio packet, in the same way as the
+        callback set by set_msg_callback(). Any number of listeners may be added; they are used
+        by the higher-level components in hylink (sessions, registries, correlators and so on).
+
+        :param listener: Function, called as listener(packet)
+        """
+        self._msgListeners.append(listener)
+
+    def remove_msg_listener(self, listener):
+        """ Remove a message listener added by add_msg_listener() """
+        self._msgListeners.remove(listener)
+
+    def add_rtp_listener(self, listener):
+        """
+        Add an RTP listener. This is called with every RTPPacket, in the same way as the callback
+        set by set_rtp_callback().
+
+        :param listener: Function, called as listener(packet)
+        """
+        self._rtpListeners.append(listener)
+
+    def remove_rtp_listener(self, listener):
+        """ Remove an RTP listener added by add_rtp_listener() """
+        self._rtpListeners.remove(listener)
+
+    def add_connection_listener(self, listener):
+        """
+        Add a connection listener.
+
+        The listener is called whenever a repeater connects (sends a SYN) or disconnects (its
+        watchdog expires, or it reconnects from a different address).
+
+        The listener should be defined as:
+
+          def listener(conn, connected):
+
+        "conn" is the RepeaterConnection, "connected" is True on connect and False on disconnect.
+
+        :param listener: Listener function
+        """
+        self._connListeners.append(listener)
+
+    def remove_connection_listener(self, listener):
+        """ Remove a connection listener added by add_connection_listener() """
+        self._connListeners.remove(listener)
@@ -0,0 +1,222 @@
+"""
+
+ADK Repeater Interface
+
+Synthetic traffic
+
+Builds the raw datagrams a Hytera repeater sends -- SYNs, heartbeats, ACKs, HSTRPFromRadio messages
+(RCP, RRS and TMP) and RTP voice frames -- without needing a repeater. Used by the benchmarks and the
+repeater simulator, and handy for testing.
+
+Most of these packet types are receive-only in hylink.packet (they can't be serialised), so the frames
+are assembled here from their wire formats.
+
+"""
+
+import random
+import struct
+
+from .rtp import RTPPayloadType
+from .types import CallType, MessageHeader, TxCallMode, TxCallStatus, TxServiceType
+from .utils import dmr_id_to_ip
+
+
+# HYT packet signature and types
+HYT_SIGNATURE = b'\x32\x42\x00'
+HYT_TO_RADIO    = 0x00
+HYT_ACK         = 0x01
+HYT_HEARTBEAT   = 0x02
+HYT_SYNACK      = 0x05
+HYT_FROM_RADIO  = 0x20
+HYT_SYN         = 0x24
+
+# RTP voice frame parameters: 20ms of 8kHz G.711
+RTP_FRAME_SAMPLES = 160
+RTP_FRAME_INTERVAL = 0.02
+
+# Hytera RTP header extension, as repeaters send it (see RTPPacket.extension)
+RTP_EXTENSION = {'type': 0x15, 'data': (0, 0, 0)}
+
+# G.711 mu-law silence
+PCMU_SILENCE = 0xFF
+
+
+def hyt_frame(pkttype, seq, payload=b''):
+    """ Build a HYT packet """
+    return HYT_SIGNATURE + struct.pack('>BH', pkttype, seq & 0xFFFF) + payload
+
+
+def repeater_header(radioID, timeslot=1, rtp=True):
+    """ Build the repeater header TLVs carried in SYNs and HSTRPFromRadio packets """
+    tlvs = [(3, struct.pack('>L', radioID)), (4, struct.pack('B', timeslot))]
+    if rtp:
+        tlvs.insert(0, (1, b''))
+
+    data = b''
+    for i, (tag, value) in enumerate(tlvs):
+        # Tag OR 0x80 means further TLVs follow
+        if i < len(tlvs) - 1:
+            tag |= 0x80
+        data += struct.pack('BB', tag, len(value)) + value
+    return data
+
+
+def syn_frame(radioID, timeslot=1, seq=0, rtp=True):
+    """ Build a repeater SYN """
+    return hyt_frame(HYT_SYN, seq, repeater_header(radioID, timeslot, rtp))
+
+
+def heartbeat_frame():
+    """ Build a heartbeat (heartbeats always have a zero sequence ID) """
+    return hyt_frame(HYT_HEARTBEAT, 0)
+
+
+def ack_frame(seq):
+    """ Build an ACK """
+    return hyt_frame(HYT_ACK, seq)
+
+
+def txctrl(msghdr, opcode, payload, reliable=False):
+    """ Build a TxCtrl block (the same encoding as TxCtrlBase.__bytes__) """
+    # For some unknown reason, RCP is little-endian while every other protocol is big-endian
+    endian = '<' if msghdr == MessageHeader.RCP else '>'
+    data = struct.pack(endian + 'BHH', msghdr | (0x80 if reliable else 0), opcode, len(payload)) + payload
+    csum = (~(sum(data[1:5]) + sum(payload)) + 0x33) & 0xFF
+    return data + struct.pack('BB', csum, 0x03)
+
+
+def from_radio_frame(radioID, seq, txc, timeslot=1):
+    """ Build a HSTRPFromRadio carrying a TxCtrl block """
+    return hyt_frame(HYT_FROM_RADIO, seq, repeater_header(radioID, timeslot, rtp=False) + txc)
+
+
+def radio_ip(radioID):
+    """ Convert a radio ID to the DMR IP address form used by RRS and TMP (the inverse of utils.dmr_ip_to_id) """
+    return dmr_id_to_ip(radioID)
+
+
+def transmit_status(status=TxCallStatus.LOCAL_REPEATING, callType=CallType.GROUP, targetID=1, senderID=1,
+                    mode=TxCallMode.NORMAL, serviceType=TxServiceType.VOICE):
+    """ Build an RCP repeater broadcast transmit status (RCPRepeaterBroadcastTransmitStatus) TxCtrl block """
+    return txctrl(MessageHeader.RCP, 0xB845,
+                  struct.pack('<HHHHII', mode, status, serviceType, callType, targetID, senderID))
+
+
+def rrs_register(radioID):
+    """ Build an RRS registration (RRSRegister) TxCtrl block """
+    return txctrl(MessageHeader.RRS, 0x0003, struct.pack('>I', radio_ip(radioID)))
+
+
+def rrs_offline(radioID):
+    """ Build an RRS offline (RRSOffline) TxCtrl block """
+    return txctrl(MessageHeader.RRS, 0x0001, struct.pack('>I', radio_ip(radioID)))
+
+
+def tmp_private_message(msgSeq, srcID, destID, message, ack=True):
+    """ Build a TMP private text message (TMPPrivateMessageNeedAck / NoAck) TxCtrl block """
+    return txctrl(MessageHeader.TMP, 0x00A1 if ack else 0x80A1,
+                  struct.pack('>III', msgSeq, radio_ip(destID), radio_ip(srcID)) + message.encode('utf-16le'))
+
+
+def tmp_group_message(msgSeq, srcID, groupID, message):
+    """ Build a TMP group text message (TMPGroupMessage) TxCtrl block """
+    return txctrl(MessageHeader.TMP, 0x00B1,
+                  struct.pack('>III', msgSeq, radio_ip(groupID), radio_ip(srcID)) + message.encode('utf-16le'))
+
+
+def rtp_frame(seq, timestamp, ssrc, payload=None, payloadType=RTPPayloadType.HYTERA_PCMU, marker=False,
+              extension=RTP_EXTENSION):
+    """
+    Build an RTP voice frame. The default payload is 20ms of G.711 silence.
+
+    :param extension: Header extension ({'type': format, 'data': sequence of 32bit uints}), or None for none
+    """
+    if payload is None:
+        payload = bytes([PCMU_SILENCE]) * RTP_FRAME_SAMPLES
+    flags = (2 << 30) | (0x800000 if marker else 0) | (payloadType << 16) | (seq & 0xFFFF)
+    ext = b''
+    if extension is not None:
+        flags |= 0x10000000
+        data = extension['data']
+        ext = struct.pack('!L' + 'L' * len(data), (extension['type'] << 16) | len(data), *data)
+    return struct.pack('!LLL', flags, timestamp & 0xFFFFFFFF, ssrc) + ext + payload
+
+
+###################################################
+#
+# Corpus generator
+#
+###################################################
+
+# Default traffic mix (relative frequencies) -- roughly what a busy repeater with voice traffic sends
+DEFAULT_MIX = {
+    'rtp':          80,
+    'rcp':          6,
+    'heartbeat':    5,
+    'ack':          3,
+    'rrs':          3,
+    'tmp':          2,
+    'syn':          1,
+}
+
+_MESSAGES = ("OK", "Copy that", "Return to base", "Meet at the north gate in 10 minutes",
+             "Vehicle 12 requires assistance at junction 4, southbound carriageway")
+
+
+class Corpus(object):
+    """ Generates a reproducible stream of synthetic repeater datagrams """
+
+    def __init__(self, radioID=100, timeslot=1, mix=None, seed=0):
+        """
+        Create a corpus generator
+
+        :param radioID: Repeater radio ID used in SYNs and repeater headers
+        :param timeslot: Repeater timeslot
+        :param mix: Dict of kind -> relative frequency (see DEFAULT_MIX for the kinds)
+        :param seed: Random seed; the same seed always gives the same corpus
+        """
+        self.radioID = radioID
+        self.timeslot = timeslot
+        self._mix = dict(DEFAULT_MIX if mix is None else mix)
+        self._rand = random.Random(seed)
+        self._seq = 0
+        self._rtpSeq = self._rand.randrange(0x10000)
+        self._rtpTimestamp = self._rand.randrange(0x100000000)
+        self._ssrc = self._rand.randrange(0x100000000)
+
+    def _next_seq(self):
+        self._seq = (self._seq + 1) & 0xFFFF
+        return self._seq
+
+    def frame(self, kind):
+        """ Build one datagram of a kind """
+        r = self._rand
+        if kind == 'rtp':
+            self._rtpSeq = (self._rtpSeq + 1) & 0xFFFF
+            self._rtpTimestamp = (self._rtpTimestamp + RTP_FRAME_SAMPLES) & 0xFFFFFFFF
+            payload = bytes(r.getrandbits(8) for _ in range(RTP_FRAME_SAMPLES))
+            return rtp_frame(self._rtpSeq, self._rtpTimestamp, self._ssrc, payload)
+        if kind == 'rcp':
+            txc = transmit_status(r.choice(list(TxCallStatus)), CallType.GROUP, r.randrange(1, 100),
+                                  r.randrange(1000, 2000))
+        elif kind == 'rrs':
+            fn = rrs_register if r.random() < 0.8 else rrs_offline
+            txc = fn(r.randrange(1000, 2000))
+        elif kind == 'tmp':
+            txc = tmp_private_message(r.randrange(0x10000), r.randrange(1000, 2000), r.randrange(1000, 2000),
+                                      r.choice(_MESSAGES))
+        elif kind == 'heartbeat':
+            return heartbeat_frame()
+        elif kind == 'ack':
+            return ack_frame(r.randrange(0x10000))
+        elif kind == 'syn':
+            return syn_frame(self.radioID, self.timeslot, self._next_seq())
+        else:
+            raise ValueError("Unknown frame kind '%s'" % kind)
+        return from_radio_frame(self.radioID, self._next_seq(), txc, self.timeslot)
+
+    def generate(self, count):
+        """ Return a list of 'count' (kind, datagram) tuples, drawn from the traffic mix """
+        kinds = list(self._mix)
+        kinds = self._rand.choices(kinds, weights=[self._mix[k] for k in kinds], k=count)
+        return [(k, self.frame(k)) for k in kinds]
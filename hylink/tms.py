@@ -0,0 +1,415 @@
+"""
+
+ADK Repeater Interface
+
+Text message (TMS) sender
+
+A TMSSender sends private and group text messages through an ADKSocket bound to a repeater's TMP port,
+as fast as the repeater will take them:
+
+    sender = TMSSender(tmpSocket, srcID=9000)
+    msgs = sender.send_batch([TMSMessage(1001, "Return to base"), TMSMessage(1002, "Return to base"),
+                              TMSMessage(10, "All units: channel 2", group=True)])
+    sender.wait_all()
+    for m in msgs:
+        print(m)
+
+Messages are queued and sent through a bounded window of outstanding requests. Each request carries a
+message sequence number (msgSeq), and is completed by the TMPPrivateMessageAnswer or TMPGroupMessageAnswer
+carrying the same msgSeq and a TMSResultCode. (Private messages sent without an acknowledgement are
+completed when the repeater acknowledges the HYT packet.)
+
+When the repeater answers CHANNEL_BUSY, the message is sent again after a backoff, and the window shrinks;
+it grows again as messages are accepted. This keeps the repeater's queue full without overrunning it.
+
+Message text is encoded (UTF-16LE) once per unique text, however many radios it's sent to.
+
+"""
+
+import collections
+import logging
+import threading
+
+from .clock import SYSTEM_CLOCK
+from .packet import HSTRPToRadio, TMPPrivateMessageNeedAck, TMPPrivateMessageNoAck, TMPGroupMessage, \
+    TMPPrivateMessageAnswer, TMPGroupMessageAnswer
+from .types import TMSResultCode
+
+log = logging.getLogger(__name__)
+
+
+# Maximum number of messages waiting for an answer
+TMS_WINDOW = 16
+
+# Time to wait for an answer before giving up on a message (seconds)
+TMS_ANSWER_TIMEOUT = 10.0
+
+# Number of times a message is resent when the channel is busy, and the backoff between attempts
+# (seconds; doubled on each attempt, up to the maximum)
+TMS_BUSY_RETRIES = 10
+TMS_BUSY_BACKOFF = 0.25
+TMS_BUSY_BACKOFF_MAX = 4.0
+
+
+class TMSMessage(object):
+    """ A text message, and the result of sending it """
+
+    def __init__(self, destID, text, group=False, ack=True, callback=None):
+        """
+        Create a text message
+
+        :param destID: Destination radio ID (or group ID, for a group message)
+        :param text: Message text
+        :param group: True to send a group message
+        :param ack: For private messages, True to ask the radio to acknowledge the message
+        :param callback: Called as callback(message) when the message has been answered, has failed or has timed out
+        """
+        self.destID = destID
+        self.text = text
+        self.group = group
+        self.ack = ack and not group
+        self.callback = callback
+
+        # Message sequence number of the most recent attempt (None if it hasn't been sent yet)
+        self.msgSeq = None
+        # Number of times the message has been sent
+        self.attempts = 0
+        # Result code from the answer; None if the message timed out or was cancelled
+        self.result = None
+        self.timedOut = False
+
+        self._done = threading.Event()
+        self._deadline = None
+
+    def done(self):
+        """ Returns True if the message has completed (successfully or not) """
+        return self._done.is_set()
+
+    def ok(self):
+        """ Returns True if the message was accepted """
+        return self.result == TMSResultCode.OK
+
+    def wait(self, timeout=None):
+        """
+        Wait for the message to complete. Returns the result code (None if the message timed out).
+
+        :param timeout: Time to wait (seconds), or None to wait forever
+        """
+        self._done.wait(timeout)
+        return self.result
+
+    def __repr__(self):
+        if not self.done():
+            state = "pending"
+        elif self.timedOut:
+            state = "timed out"
+        else:
+            state = "result %s" % self.result
+        return "<%s: %s %d, msgseq=%s, attempts %d, %s, text '%s'>" % \
+               (type(self).__name__, "group" if self.group else "radio", self.destID, self.msgSeq,
+                self.attempts, state, self.text)
+
+
+class TMSSender(object):
+    """ Sends batches of text messages through a TMP port, with a bounded window of outstanding messages """
+
+    def __init__(self, sock, srcID, repeater=None, window=TMS_WINDOW, timeout=TMS_ANSWER_TIMEOUT,
+                 busy_retries=TMS_BUSY_RETRIES, backoff=TMS_BUSY_BACKOFF, clock=None):
+        """
+        Create a text message sender and start its thread
+
+        :param sock: ADKSocket bound to the repeater's TMP port
+        :param srcID: Source radio ID the messages are sent from (the dispatcher's ID)
+        :param repeater: Repeater to send through (see ADKSocket.get_session). Defaults to the most recently
+            connected repeater.
+        :param window: Maximum number of messages waiting for an answer
+        :param timeout: Time to wait for an answer (seconds)
+        :param busy_retries: Number of times to resend a message when the repeater reports CHANNEL_BUSY
+        :param backoff: Delay before the first resend (seconds); doubled for each further resend
+        :param clock: hylink.clock.Clock for the timeouts and backoff (defaults to the socket's clock)
+        """
+        self._sock = sock
+        self.srcID = srcID
+        self.repeater = repeater
+        self.window = window
+        self.timeout = timeout
+        self.busyRetries = busy_retries
+        self.backoff = backoff
+        self.clock = clock if clock is not None else getattr(sock, 'clock', SYSTEM_CLOCK)
+
+        # Congestion window: the number of messages allowed in flight, between 1 and window. Shrinks when the
+        # repeater reports a busy channel, and grows as messages are accepted.
+        self._cwnd = float(window)
+
+        self._cond = threading.Condition()
+        # Messages waiting to be sent
+        self._pending = collections.deque()
+        # Messages waiting to be resent: list of (time, message)
+        self._retries = []
+        # Messages in flight (msgSeq -> message)
+        self._outstanding = {}
+        self._msgSeq = 0
+
+        # Counters
+        self.sent = 0
+        self.accepted = 0
+        self.failed = 0
+        self.busy = 0
+        self.timeouts = 0
+
+        sock.add_msg_listener(self._msg)
+
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="TMSSender", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """ Stop sending, and cancel any messages which haven't completed """
+        with self._cond:
+            if not self._running:
+                return
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        self._sock.remove_msg_listener(self._msg)
+
+        with self._cond:
+            cancelled = list(self._pending) + [m for _, m in self._retries] + list(self._outstanding.values())
+            self._pending.clear()
+            self._retries = []
+            self._outstanding.clear()
+            for m in cancelled:
+                self._finish(m, None)
+            self._cond.notify_all()
+        for m in cancelled:
+            self._callback(m)
+
+    ################################
+    # Queueing
+    ################################
+
+    def send(self, message):
+        """
+        Queue a message. Returns the message.
+
+        :param message: TMSMessage to send
+        """
+        return self.send_batch((message,))[0]
+
+    def send_private(self, destID, text, ack=True, callback=None):
+        """
+        Queue a private message. Returns a TMSMessage.
+
+        :param destID: Destination radio ID
+        :param text: Message text
+        :param ack: True to ask the radio to acknowledge the message
+        :param callback: Called as callback(message) when the message completes
+        """
+        return self.send(TMSMessage(destID, text, ack=ack, callback=callback))
+
+    def send_group(self, groupID, text, callback=None):
+        """
+        Queue a group message. Returns a TMSMessage.
+
+        :param groupID: Destination group ID
+        :param text: Message text
+        :param callback: Called as callback(message) when the message completes
+        """
+        return self.send(TMSMessage(groupID, text, group=True, callback=callback))
+
+    def send_batch(self, messages):
+        """
+        Queue a batch of messages. Returns the messages as a list.
+
+        :param messages: Iterable of TMSMessage
+        """
+        messages = list(messages)
+        with self._cond:
+            if not self._running:
+                raise RuntimeError("TMSSender is closed")
+            self._pending.extend(messages)
+            self._cond.notify_all()
+        return messages
+
+    def wait_all(self, timeout=None):
+        """
+        Wait until every queued message has completed. Returns False if the timeout expired first.
+
+        :param timeout: Time to wait (seconds), or None to wait forever
+        """
+        deadline = None if timeout is None else self.clock.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._retries or self._outstanding:
+                remaining = None if deadline is None else deadline - self.clock.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.clock.wait(self._cond, remaining)
+        return True
+
+    def in_flight(self):
+        """ Returns the number of messages waiting for an answer """
+        return len(self._outstanding)
+
+    ################################
+    # Sending
+    ################################
+
+    def _next_msgseq(self):
+        self._msgSeq = (self._msgSeq + 1) & 0xFFFFFFFF
+        return self._msgSeq
+
+    def _build(self, m):
+        """ Build the HSTRPToRadio packet for a message """
+        if m.group:
+            txc = TMPGroupMessage()
+        elif m.ack:
+            txc = TMPPrivateMessageNeedAck()
+        else:
+            txc = TMPPrivateMessageNoAck()
+        txc.msgSeq = m.msgSeq
+        txc.destID = m.destID
+        txc.srcID = self.srcID
+        txc.message = m.text
+
+        p = HSTRPToRadio()
+        p.txCtrl = txc
+        return p
+
+    def _launch(self, now):
+        """ Send queued messages until the window is full. Caller must hold _cond. Returns the messages to send. """
+        # Resends whose backoff has expired go first
+        due = [r for r in self._retries if r[0] <= now]
+        if due:
+            self._retries = [r for r in self._retries if r[0] > now]
+            for _, m in sorted(due, key=lambda r: r[0], reverse=True):
+                self._pending.appendleft(m)
+
+        batch = []
+        while self._pending and len(self._outstanding) < int(self._cwnd):
+            m = self._pending.popleft()
+            m.msgSeq = self._next_msgseq()
+            m.attempts += 1
+            m._deadline = now + self.timeout
+            self._outstanding[m.msgSeq] = m
+            batch.append(m)
+        return batch
+
+    def _transmit(self, m):
+        """ Send a message (called without holding _cond, as send() can block on the socket) """
+        p = self._build(m)
+        # Private messages without an acknowledgement complete when the repeater ACKs the packet
+        if m.ack or m.group:
+            callback = _ignore_ack
+        else:
+            callback = lambda seq, msgSeq=m.msgSeq: self._acked(msgSeq, seq)
+
+        if self._sock.send(p, callback=callback, repeater=self.repeater) is None:
+            # Not connected -- the packet was dropped, and the message will time out
+            log.debug("TMS message %d not sent: repeater not connected", m.msgSeq)
+        self.sent += 1
+
+    def _expire(self, now):
+        """ Find messages which haven't been answered in time. Caller must hold _cond. Returns them. """
+        expired = [m for m in self._outstanding.values() if m._deadline <= now]
+        for m in expired:
+            del self._outstanding[m.msgSeq]
+            m.timedOut = True
+            self._finish(m, None)
+        if expired:
+            # Lost answers usually mean the repeater is overloaded -- start again from a window of one
+            self._cwnd = 1.0
+        return expired
+
+    def _next_wakeup(self):
+        """ Time of the next deadline or resend. Caller must hold _cond. """
+        times = [m._deadline for m in self._outstanding.values()] + [t for t, _ in self._retries]
+        return min(times) if times else None
+
+    def _thread_proc(self):
+        while True:
+            with self._cond:
+                if not self._running:
+                    return
+                now = self.clock.monotonic()
+                expired = self._expire(now)
+                batch = self._launch(now)
+                if expired:
+                    self._cond.notify_all()
+                if not batch and not expired:
+                    wakeup = self._next_wakeup()
+                    self.clock.wait(self._cond, None if wakeup is None else max(0.0, wakeup - now))
+                    continue
+
+            for m in expired:
+                self.timeouts += 1
+                log.warning("TMS message %d to %d timed out after %d attempt(s)", m.msgSeq, m.destID, m.attempts)
+                self._callback(m)
+            for m in batch:
+                # noinspection PyBroadException
+                try:
+                    self._transmit(m)
+                except Exception:
+                    log.exception("Error sending TMS message %d", m.msgSeq)
+
+    ################################
+    # Answers
+    ################################
+
+    def _msg(self, p):
+        txc = p.txCtrl
+        if not isinstance(txc, (TMPPrivateMessageAnswer, TMPGroupMessageAnswer)):
+            return
+        # Answers which don't carry a result are treated as success
+        self._answered(txc.msgSeq, TMSResultCode.OK if txc.result is None else txc.result)
+
+    def _acked(self, msgSeq, seq):
+        """ ACK callback for private messages without an acknowledgement """
+        # seq is None if the packet couldn't be sent -- leave the message to time out
+        if seq is not None:
+            self._answered(msgSeq, TMSResultCode.OK)
+
+    def _answered(self, msgSeq, result):
+        with self._cond:
+            m = self._outstanding.pop(msgSeq, None)
+            if m is None:
+                # Late answer to a message which has timed out, or an answer to another application's message
+                return
+
+            if result == TMSResultCode.CHANNEL_BUSY and m.attempts <= self.busyRetries:
+                # Back off, and shrink the window so the repeater isn't sent more than it can handle
+                self.busy += 1
+                self._cwnd = max(1.0, self._cwnd / 2)
+                delay = min(self.backoff * (2 ** (m.attempts - 1)), TMS_BUSY_BACKOFF_MAX)
+                self._retries.append((self.clock.monotonic() + delay, m))
+                self._cond.notify_all()
+                return
+
+            if result == TMSResultCode.OK:
+                self.accepted += 1
+                # Additive increase: one more message in flight per window's worth of accepted messages
+                self._cwnd = min(float(self.window), self._cwnd + 1 / self._cwnd)
+            else:
+                self.failed += 1
+            self._finish(m, result)
+            self._cond.notify_all()
+
+        self._callback(m)
+
+    def _finish(self, m, result):
+        """ Mark a message as complete. Caller must hold _cond (so wait_all() sees it done once it leaves the queues). """
+        m.result = result
+        m._done.set()
+
+    def _callback(self, m):
+        """ Call a completed message's callback (without holding _cond) """
+        if m.callback is not None:
+            # noinspection PyBroadException
+            try:
+                m.callback(m)
+            except Exception:
+                log.exception("Exception in TMS message callback")
+
+
+def _ignore_ack(_seq):
+    """ ACK callback for messages which complete on their answer (keeps send() from blocking) """
+    pass
@@ -0,0 +1,122 @@
+"""
+
+ADK Repeater Interface
+
+Packet trace ring buffer
+
+A PacketTrace records the last N raw datagrams sent and received by a socket, with timestamps, in a
+fixed-size ring buffer. Recording a datagram only stores references; nothing is decoded or formatted
+until the trace is dumped (for example after a decode error, or on a signal):
+
+    hylink.trace.install_signal_handler()       # dump every socket's trace to the log on SIGUSR1
+
+"""
+
+import itertools
+import logging
+import signal
+import time
+import weakref
+
+log = logging.getLogger(__name__)
+
+
+# Default number of datagrams kept by each socket's packet trace
+PACKET_TRACE_SIZE = 256
+
+# Every live PacketTrace, for the signal handler
+_traces = weakref.WeakSet()
+
+
+class LazyHex(object):
+    """ Hex dump of a byte string, formatted only if it's converted to a string (e.g. by a log message) """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return bytes(self.data).hex(' ').upper()
+
+
+class PacketTrace(object):
+    """ Ring buffer of the most recent raw datagrams """
+
+    def __init__(self, size=PACKET_TRACE_SIZE, name=None):
+        """
+        Create a packet trace
+
+        :param size: Number of datagrams to keep
+        :param name: Name shown when the trace is dumped
+        """
+        if size <= 0:
+            raise ValueError("size must be > 0")
+
+        self.size = size
+        self.name = name
+
+        # Preallocated ring. Each slot is (timestamp, direction, address, data) or None.
+        self._ring = [None] * size
+        # itertools.count is atomic in CPython, so the rx and tx threads can record without a lock
+        self._counter = itertools.count()
+
+        _traces.add(self)
+
+    def record(self, direction, addr, data):
+        """
+        Record a datagram
+
+        :param direction: 'rx' or 'tx'
+        :param addr: Remote socket address
+        :param data: Raw datagram (bytes)
+        """
+        self._ring[next(self._counter) % self.size] = (time.time(), direction, addr, data)
+
+    def entries(self):
+        """ Return the recorded datagrams, oldest first, as (timestamp, direction, address, data) tuples """
+        ring = list(self._ring)
+        entries = [x for x in ring if x is not None]
+        entries.sort(key=lambda x: x[0])
+        return entries
+
+    def dump(self, decode=True):
+        """
+        Format the trace as a string, one datagram per line.
+
+        :param decode: If True, each datagram is also decoded and shown as a packet
+        """
+        # Imported here to avoid a circular import (the socket layer imports this module)
+        from .packet import HYTPacket
+        from .rtp import RTPPacket
+
+        lines = ["Packet trace %s (last %d datagrams):" % (self.name or '', self.size)]
+        for ts, direction, addr, data in self.entries():
+            line = "%s.%06d %s %-21s %s" % (time.strftime('%H:%M:%S', time.localtime(ts)), (ts % 1) * 1e6,
+                                            direction, '%s:%d' % addr[:2], LazyHex(data))
+            if decode:
+                # noinspection PyBroadException
+                try:
+                    p = HYTPacket.decode(data) if data[:3] == b'\x32\x42\x00' else RTPPacket(data)
+                    line += "\n    %r" % (p,)
+                except Exception as e:
+                    line += "\n    (undecodable: %s: %s)" % (type(e).__name__, e)
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def dump_all(logger=log, level=logging.INFO):
+    """ Write every live packet trace to a logger """
+    for t in list(_traces):
+        logger.log(level, "%s", t.dump())
+
+
+def install_signal_handler(signum=signal.SIGUSR1 if hasattr(signal, 'SIGUSR1') else None):
+    """
+    Dump every live packet trace to the log when a signal is received (SIGUSR1 by default).
+
+    Must be called from the main thread.
+    """
+    if signum is None:
+        raise ValueError("No default signal on this platform -- specify one")
+    signal.signal(signum, lambda _signum, _frame: dump_all())
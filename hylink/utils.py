@@ -6,6 +6,11 @@ def dmr_ip_to_id(x):
     return x & 0xFFFFFF
 
 
+def dmr_id_to_ip(x, network=10):
+    # Radios' DMR IP addresses are the radio ID in the low 24 bits of a class A network (10.x.x.x)
+    return ((network & 0xFF) << 24) | (x & 0xFFFFFF)
+
+
 def dmr_ip_to_str(x):
     a = (x >> 24) & 0xFF
     b = (x >> 16) & 0xFF
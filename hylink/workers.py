@@ -0,0 +1,330 @@
+"""
+
+ADK Repeater Interface
+
+Multi-process worker pool
+
+Runs N worker processes which each bind the same hylink ports with SO_REUSEPORT. The kernel hashes each
+repeater's address onto one worker, so a repeater's traffic (and its RepeaterConnection) always lives in
+the same process. Workers decode packets and run the protocol, then forward decoded packets back to the
+coordinator (the process which created the ADKWorkerPool) in batches over a pipe.
+
+Linux-only: SO_REUSEPORT load balancing for UDP is a Linux feature.
+
+Callbacks are called in the coordinator with packet.repeater set to a WorkerRepeater, which can be passed
+back to ADKWorkerPool.send() to transmit to that repeater. An exception raised by a callback is logged, and
+doesn't stop the pool's event thread. If a worker exits (or the pool is stopped) before a packet sent
+through it is acknowledged, its ack callback is called with None.
+
+"""
+
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import pickle
+import threading
+
+log = logging.getLogger(__name__)
+
+
+# Maximum time (seconds) a worker holds decoded events before sending them to the coordinator
+WORKER_FLUSH_INTERVAL = 0.005
+
+# Maximum number of events a worker sends to the coordinator in one batch
+WORKER_FLUSH_BATCH = 256
+
+# Event / command codes used on the pipes between the coordinator and the workers
+_EV_MSG = 0
+_EV_RTP = 1
+_EV_ACK = 2
+_CMD_SEND = 0
+_CMD_STOP = 1
+
+
+class WorkerRepeater(object):
+    """ A repeater connected to one of the pool's worker processes """
+
+    def __init__(self, worker, port, addr, radioID, timeslot):
+        self.worker = worker
+        self.port = port
+        self.addr = addr
+        self.radioID = radioID
+        self.timeslot = timeslot
+
+    def __repr__(self):
+        return "<%s: worker %d, port %d, addr %s, radio ID %s, timeslot %s>" % \
+               (type(self).__name__, self.worker, self.port, self.addr, self.radioID, self.timeslot)
+
+
+class _EventBatcher(object):
+    """ Collects events in a worker and sends them to the coordinator in batches """
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._events = []
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._running = True
+        self._thread = threading.Thread(target=self._thread_proc, name="ADKWorker-flush", daemon=True)
+        self._thread.start()
+
+    def put(self, event):
+        with self._lock:
+            self._events.append(event)
+            if len(self._events) >= WORKER_FLUSH_BATCH:
+                self._cond.notify()
+
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._cond.notify()
+        self._thread.join()
+
+    def _thread_proc(self):
+        while True:
+            with self._lock:
+                if self._running and len(self._events) < WORKER_FLUSH_BATCH:
+                    self._cond.wait(WORKER_FLUSH_INTERVAL)
+                events, self._events = self._events, []
+                running = self._running
+
+            if events:
+                # Pickle once for the whole batch
+                self._conn.send_bytes(pickle.dumps(events, pickle.HIGHEST_PROTOCOL))
+
+            if not running:
+                break
+
+
+def _worker_main(index, ports, host, sock_kwargs, evconn, cmdconn):
+    """ Worker process entry point """
+    # Imported here so the coordinator doesn't need to import the socket layer to create a pool
+    from .socket import ADKSocket
+
+    batcher = _EventBatcher(evconn)
+    socks = {}
+
+    def _event(code, port, p):
+        conn = p.repeater
+        if conn is None:
+            # RTP from a repeater which isn't connected
+            info = None
+        else:
+            info = (conn.addr, conn.radioID, conn.timeslot)
+        # The RepeaterConnection is local to this process -- don't pickle it
+        p.repeater = None
+        batcher.put((code, port, info, p))
+
+    for port in ports:
+        s = ADKSocket(port, name="ADKWorker%d" % index, host=host, reuse_port=True, **sock_kwargs)
+        s.set_msg_callback(lambda p, port=port: _event(_EV_MSG, port, p))
+        s.set_rtp_callback(lambda p, port=port: _event(_EV_RTP, port, p))
+        socks[port] = s
+
+    log.debug("Worker %d (pid %d) running on ports %s", index, os.getpid(), ports)
+
+    # Service commands from the coordinator
+    while True:
+        try:
+            cmd = cmdconn.recv()
+        except EOFError:
+            break
+
+        if cmd[0] == _CMD_STOP:
+            break
+
+        _code, port, addr, packet, token = cmd
+        s = socks.get(port)
+        if s is None:
+            log.warning("Worker %d: send to unknown port %s", index, port)
+            if token is not None:
+                batcher.put((_EV_ACK, port, token, None))
+            continue
+
+        if token is None:
+            # Fire and forget -- ignore the ack
+            callback = _ignore_ack
+        else:
+            def callback(seq, token=token):
+                batcher.put((_EV_ACK, port, token, seq))
+        if s.send(packet, callback=callback, repeater=addr) is None and token is not None:
+            # Not sent (the repeater has disconnected) -- there'll be no ack, so tell the coordinator now
+            batcher.put((_EV_ACK, port, token, None))
+
+    for s in socks.values():
+        s.stop()
+    batcher.stop()
+
+
+def _ignore_ack(seq):
+    pass
+
+
+class ADKWorkerPool(object):
+    """ Serve hylink ports from several processes, sharded by repeater """
+
+    def __init__(self, ports, workers=None, host='', **sock_kwargs):
+        """
+        Create a worker pool. Call start() to start the worker processes.
+
+        :param ports: Iterable of UDP port numbers to bind in every worker
+        :param workers: Number of worker processes (defaults to the number of CPUs)
+        :param host: Local address to bind
+        :param sock_kwargs: Other keyword arguments passed to each worker's ADKSocket
+        """
+        self.ports = list(ports)
+        self.workers = workers if workers is not None else (os.cpu_count() or 1)
+        self.host = host
+        self._sockKwargs = sock_kwargs
+
+        self._rcpRxCallback = None
+        self._rtpRxCallback = None
+
+        self._procs = []
+        self._evconns = []
+        self._cmdconns = []
+        self._cmdLock = threading.Lock()
+
+        # Ack callbacks for sends from the coordinator, keyed by token: (worker index, callback)
+        self._ackcallbacks = {}
+        self._nextToken = 0
+
+        self._thread = None
+
+    def start(self):
+        """ Start the worker processes and the coordinator's event thread """
+        for i in range(self.workers):
+            ev_r, ev_w = multiprocessing.Pipe(duplex=False)
+            cmd_r, cmd_w = multiprocessing.Pipe(duplex=False)
+            proc = multiprocessing.Process(target=_worker_main, name="ADKWorker%d" % i,
+                                           args=(i, self.ports, self.host, self._sockKwargs, ev_w, cmd_r))
+            proc.daemon = True
+            proc.start()
+            # Close our copies of the child's ends
+            ev_w.close()
+            cmd_r.close()
+            self._procs.append(proc)
+            self._evconns.append(ev_r)
+            self._cmdconns.append(cmd_w)
+
+        self._thread = threading.Thread(target=self._event_thread_proc, name="ADKWorkerPool-events")
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the worker processes. Ack callbacks still waiting are called with None. """
+        with self._cmdLock:
+            for c in self._cmdconns:
+                try:
+                    c.send((_CMD_STOP,))
+                except (BrokenPipeError, OSError):
+                    pass
+        for proc in self._procs:
+            proc.join()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._fail_acks()
+
+    def send(self, packet, repeater, port=None, callback=None):
+        """
+        Send a packet to a repeater via the worker which owns it.
+
+        Unlike ADKSocket.send(), this never blocks waiting for an acknowledgement.
+
+        :param packet: Packet to send
+        :param repeater: WorkerRepeater (e.g. packet.repeater from a callback)
+        :param port: Port to send from; defaults to the port the repeater was seen on
+        :param callback: Optional ack callback, called in the coordinator as callback(seq), or as callback(None)
+            if the packet couldn't be sent (e.g. the repeater has disconnected)
+        """
+        token = None
+        with self._cmdLock:
+            if callback is not None:
+                token = self._nextToken
+                self._nextToken += 1
+                self._ackcallbacks[token] = (repeater.worker, callback)
+            try:
+                self._cmdconns[repeater.worker].send(
+                    (_CMD_SEND, port if port is not None else repeater.port, repeater.addr, packet, token))
+                return
+            except (BrokenPipeError, OSError):
+                # The worker has gone
+                log.warning("Worker %d has exited -- packet to %s not sent", repeater.worker, repeater)
+                entry = self._ackcallbacks.pop(token, None)
+        if entry is not None:
+            self._call_ack(entry[1], None)
+
+    def _event_thread_proc(self):
+        """ Receive event batches from the workers and pass them to the callbacks """
+        workers = {c: i for i, c in enumerate(self._evconns)}
+        conns = list(self._evconns)
+
+        while conns:
+            for c in multiprocessing.connection.wait(conns):
+                try:
+                    events = pickle.loads(c.recv_bytes())
+                except EOFError:
+                    # Worker has shut down -- it won't ack anything sent through it
+                    conns.remove(c)
+                    self._fail_acks(workers[c])
+                    continue
+
+                for ev in events:
+                    self._dispatch(workers[c], ev)
+
+        log.info("Worker pool event thread shutting down...")
+
+    def _dispatch(self, worker, ev):
+        code, port = ev[0], ev[1]
+
+        if code == _EV_ACK:
+            with self._cmdLock:
+                entry = self._ackcallbacks.pop(ev[2], None)
+            if entry is not None:
+                self._call_ack(entry[1], ev[3])
+            return
+
+        info, p = ev[2], ev[3]
+        if info is not None:
+            p.repeater = WorkerRepeater(worker, port, *info)
+
+        callback = self._rcpRxCallback if code == _EV_MSG else self._rtpRxCallback
+        if callback is not None:
+            # noinspection PyBroadException
+            try:
+                callback(p)
+            except Exception:
+                log.exception("Exception in %s callback", "message" if code == _EV_MSG else "RTP")
+
+    def _fail_acks(self, worker=None):
+        """ Call the ack callbacks waiting on a worker (or on every worker) with None """
+        with self._cmdLock:
+            tokens = [t for t, (w, _) in self._ackcallbacks.items() if worker is None or w == worker]
+            entries = [self._ackcallbacks.pop(t) for t in tokens]
+        for _, callback in entries:
+            self._call_ack(callback, None)
+
+    @staticmethod
+    def _call_ack(callback, seq):
+        # noinspection PyBroadException
+        try:
+            callback(seq)
+        except Exception:
+            log.exception("Exception in ack callback")
+
+    def set_msg_callback(self, callback):
+        """
+        Set the broadcast callback (see ADKSocket.set_msg_callback).
+
+        packet.repeater is a WorkerRepeater.
+        """
+        self._rcpRxCallback = callback
+
+    def set_rtp_callback(self, callback):
+        """
+        Set the RTP callback (see ADKSocket.set_rtp_callback).
+
+        packet.repeater is a WorkerRepeater, or None if the sender isn't connected.
+        """
+        self._rtpRxCallback = callback
@@ -0,0 +1,93 @@
+"""
+
+RCPCorrelator tests
+
+"""
+
+import unittest
+
+from hylink import synth
+from hylink.clock import VirtualClock
+from hylink.packet import HYTPacket
+from hylink.rcp import RCP_RESPONSE_TIMEOUT, RCPCorrelator, RCPTimeout
+from hylink.types import CallType, MessageHeader
+
+
+class FakeSocket(object):
+    """ Just enough of an ADKSocket for an RCPCorrelator: one connected repeater, and no network """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.conn = object()
+        self.sent = []
+        self._listeners = []
+
+    def get_session(self, repeater=None):
+        return self.conn
+
+    def send(self, packet, callback=None, repeater=None):
+        self.sent.append(packet)
+        return len(self.sent)
+
+    def add_msg_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_msg_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def respond(self, result=0):
+        """ Deliver an RCPCallResponse from the repeater """
+        p = HYTPacket.decode(synth.from_radio_frame(100, len(self.sent),
+                                                    synth.txctrl(MessageHeader.RCP, 0x8841, bytes([result]))))
+        p.repeater = self.conn
+        for callback in list(self._listeners):
+            callback(p)
+
+
+class TestLateResponses(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock()
+        self.sock = FakeSocket(self.clock)
+        self.rcp = RCPCorrelator(self.sock, clock=self.clock)
+
+    def tearDown(self):
+        self.rcp.close()
+
+    def test_lost_then_answered(self):
+        # The first response is lost
+        lost = self.rcp.call(CallType.GROUP, 1)
+        self.clock.advance(RCP_RESPONSE_TIMEOUT + 0.1)
+        self.assertIsInstance(lost.exception(timeout=1), RCPTimeout)
+
+        # Every later request is answered promptly. The next one's reply is taken as the late answer, but the
+        # loss mustn't carry on to the requests after it.
+        results = []
+        for i in range(5):
+            fut = self.rcp.call(CallType.GROUP, 2 + i)
+            self.clock.advance(0.1)
+            self.sock.respond()
+            if not fut.done():
+                self.clock.advance(RCP_RESPONSE_TIMEOUT)
+            results.append(fut.exception(timeout=1) is None)
+
+        self.assertEqual(results, [False, True, True, True, True])
+        self.assertEqual(self.rcp.late, 1)
+        self.assertEqual(self.rcp.timeouts, 2)
+
+    def test_late_answer_absorbed(self):
+        # A late answer mustn't complete the next request
+        first = self.rcp.call(CallType.GROUP, 1)
+        self.clock.advance(RCP_RESPONSE_TIMEOUT + 0.1)
+        self.assertIsInstance(first.exception(timeout=1), RCPTimeout)
+
+        second = self.rcp.call(CallType.GROUP, 2)
+        self.sock.respond(result=1)
+        self.assertFalse(second.done())
+        self.sock.respond(result=0)
+        self.assertEqual(second.result(timeout=1).result, 0)
+        self.assertEqual(self.rcp.late, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
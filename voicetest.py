@@ -7,6 +7,7 @@ import librosa
 
 from hylink.ports import ADKDefaultPorts
 from hylink.socket import ADKSocket
+from hylink.session import RepeaterSession
 from hylink.packet import *
 from hylink.types import *
 from hylink.rtp import RTPPacket, RTPPayloadType
@@ -44,30 +45,20 @@ for p in ADKDefaultPorts:
 # Start RCP and RTP for Slot 1
 rtpPort = ADKSocket(ADKDefaultPorts.RTP1)
 rcpPort = ADKSocket(ADKDefaultPorts.RCP1)
+session = RepeaterSession(rcpPort, rtpPort)
 
-# run for a while
-# TODO -- packet -- make this event driven (wait on an event queue)
 logging.info("Waiting for repeater connection")
-while (not rtpPort.is_connected()) or (not rcpPort.is_connected()):
-    time.sleep(2)
+session.wait_connected()
 logging.info("Repeater connected!")
 
-# send txctrl call request
+# send txctrl call request (blocks until the repeater acknowledges it)
 logging.info("Sending Call request...")
-htc = HSTRPToRadio()
-htc.txCtrl = RCPCallRequest()
-htc.txCtrl.callType = CALLTYPE
-htc.txCtrl.destId = RADIOID
-seqn = rcpPort.send(htc)
-time.sleep(2)
+session.call(CALLTYPE, RADIOID)
 
 logging.info("Keying up...")
-htcButton = HSTRPToRadio()
-htcButton.txCtrl = RCPButtonRequest()
-htcButton.txCtrl.pttTarget = ButtonTarget.FRONT_PTT
-htcButton.txCtrl.pttOperation = ButtonOperation.PRESS
-seqn = rcpPort.send(htcButton)
-time.sleep(2)
+session.ptt(True)
+if session.wait_call_status(TxCallStatus.REMOTE_PTT_TX, timeout=2) is None:
+    logging.warning("Repeater didn't report Remote PTT transmit, continuing anyway")
 
 logging.info("Sending some silence")
 
@@ -105,7 +96,7 @@ def silence(nsecs=1.0):
         _rtptstamp += RTP_FRAMESZ
         pkt.seq = _rtpseq
         pkt.timestamp = _rtptstamp
-        rtpPort.send(pkt)
+        session.send_rtp(pkt)
         time.sleep(RTP_FRAMESZ / SAMPLE_RATE)
 
 
@@ -163,7 +154,7 @@ def wavfile(filename):
         pkt.payload = audioop.lin2ulaw(samp_to_signed_bin(chunk), 2)
 
         # send packet
-        rtpPort.send(pkt)
+        session.send_rtp(pkt)
 
         # wait for next interval
         next_time += pace
@@ -182,11 +173,11 @@ for wav in CFG_DEMO_WAVS:
 silence(0.2)
 
 logging.info("Keying down...")
-htcButton.txCtrl.pttOperation = ButtonOperation.RELEASE
-seqn = rcpPort.send(htcButton)
+session.ptt(False)
 
-# Wait for the last few packets to arrive
-time.sleep(5)
+# Wait for the repeater to finish transmitting
+session.wait_call_status((TxCallStatus.REMOTE_PTT_HANG_TIME, TxCallStatus.REMOTE_PTT_TX_END, TxCallStatus.SLEEP),
+                         timeout=5)
 
 logging.info("Shutting down...")
 